@@ -0,0 +1,193 @@
+import argparse
+import csv
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from const import EN, JA
+
+# 1 レコードの翻訳中に例外が起きたときのエラー番号
+RECORD_ERROR_NO = "e0400"
+
+
+def infer_format(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower().lstrip(".")
+    if extension in ("tsv", "csv", "jsonl"):
+        return extension
+    raise ValueError(f"Unknown file format: {path}")
+
+
+def read_records(path: str, file_format: str, skip: int=0):
+    """
+    Read records from the file one by one, skipping the first `skip` records.
+    TSV and CSV records are lists of columns, and JSONL records are dicts.
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        if file_format == "jsonl":
+            records = (json.loads(line) for line in f if line.strip() != "")
+        else:
+            records = csv.reader(f, delimiter="\t" if file_format == "tsv" else ",")
+        yield from islice(records, skip, None)
+
+
+def join_texts(texts: list, language: str) -> str:
+    return ("" if language == JA else " ").join(texts)
+
+
+class Checkpoint:
+    """
+    Progress of a batch job. It is saved after every chunk is written,
+    with the size of the output file so that a partially written chunk is discarded on resume.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.records_done = 0
+        self.output_size = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.records_done = state["records_done"]
+            self.output_size = state["output_size"]
+
+    def save(self, records_done: int, output_size: int):
+        self.records_done = records_done
+        self.output_size = output_size
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"records_done": records_done, "output_size": output_size}, f)
+        os.replace(tmp_path, self.path)
+
+
+class BatchTranslator:
+    """
+    Translate a TSV, CSV or JSONL file record by record with Translator.translate_by_sentence.
+    The input is read in chunks, and records of a chunk are translated concurrently and written in order,
+    so that memory stays bounded regardless of file size.
+    """
+    def __init__(self, translator, source_language: str, target_language: str, model: str, temperature: float,
+                 text_column, chunk_size: int=100, concurrency: int=8):
+        self.translator = translator
+        self.source_language = source_language
+        self.target_language = target_language
+        self.model = model
+        self.temperature = temperature
+        self.text_column = text_column
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+
+    def run(self, input_path: str, output_path: str, checkpoint_path: str, file_format: str="", log=None):
+        file_format = file_format or infer_format(input_path)
+        checkpoint = Checkpoint(checkpoint_path)
+        if checkpoint.records_done > 0 and (not os.path.exists(output_path) or os.path.getsize(output_path) < checkpoint.output_size):
+            # 出力がないまま再開すると、チェックポイントまでのレコードが失われる
+            raise ValueError(f"The output of the checkpoint is missing or truncated: {output_path}. Remove {checkpoint_path} to start over.")
+        mode = "r+" if checkpoint.records_done > 0 else "w"
+        records = read_records(input_path, file_format, skip=checkpoint.records_done)
+        records_done = checkpoint.records_done
+        failures = 0
+        with open(output_path, mode, newline="", encoding="utf-8") as output, ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as executor:
+            if mode == "r+":
+                output.seek(checkpoint.output_size)
+                output.truncate()
+            writer = csv.writer(output, delimiter="\t" if file_format == "tsv" else ",", lineterminator="\n")
+            while True:
+                chunk = list(islice(records, self.chunk_size))
+                if not chunk:
+                    break
+                for record, translation in zip(chunk, executor.map(self._translate_record, chunk)):
+                    failures += int(translation is not None and translation.error_no != "")
+                    self._write_record(output, writer, file_format, record, translation)
+                output.flush()
+                records_done += len(chunk)
+                checkpoint.save(records_done, output.tell())
+                if log:
+                    log(f"{records_done} records done, {failures} failed")
+        return records_done, failures
+
+    def _get_text(self, record) -> str:
+        """
+        Get the text to translate from a record. A missing key or column is an error, rather than a silently empty record.
+        """
+        if isinstance(record, dict):
+            if self.text_column not in record:
+                raise ValueError(f"Text column not found: {self.text_column!r} is not a key of {record}")
+            text = record[self.text_column]
+        else:
+            index = int(self.text_column)
+            if not record:
+                # 空行
+                return ""
+            if index >= len(record):
+                raise ValueError(f"Text column not found: {self.text_column!r} is out of the {len(record)} columns of {record}")
+            text = record[index]
+        return "" if text is None else str(text)
+
+    def _translate_record(self, record):
+        text = self._get_text(record)
+        if text.strip() == "":
+            return None
+        try:
+            translation = self.translator.translate_by_sentence(self.source_language, self.target_language, text, self.model, self.temperature)
+        except Exception as e:
+            # 1 レコードの失敗でジョブ全体を止めず、エラー番号を付けて書き出す
+            from llm_translator import Translation, BASE_ERROR_MESSAGE
+            return Translation(translated_texts="", is_success=False, error=f"{BASE_ERROR_MESSAGE} {type(e).__name__}: {e}", error_no=RECORD_ERROR_NO)
+        if translation.is_success and not translation.verify_text_pair() and translation.error_no == "":
+            translation.error_no = "e0200"
+        return translation
+
+    def _write_record(self, output, writer, file_format: str, record, translation):
+        translated_text = ""
+        error_no = ""
+        if translation is not None:
+            translated_text = join_texts(translation.translated_texts, self.target_language) if isinstance(translation.translated_texts, list) else translation.translated_texts
+            error_no = translation.error_no
+        if file_format == "jsonl":
+            record = dict(record)
+            record["translation"] = translated_text
+            record["error_no"] = error_no
+            if translation is not None and error_no == "":
+                record["sentence_pairs"] = [[s, t] for s, t in zip(translation.source_texts, translation.translated_texts)]
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        else:
+            writer.writerow(list(record) + [translated_text, error_no])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Translate a TSV, CSV or JSONL file with checkpoint and resume.")
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("--format", choices=("tsv", "csv", "jsonl"), default="", help="Inferred from the input extension by default.")
+    parser.add_argument("--text-column", default="0", help="Column index for TSV/CSV, or key for JSONL.")
+    parser.add_argument("--source-language", default=JA, choices=(EN, JA))
+    parser.add_argument("--target-language", default=EN, choices=(EN, JA))
+    parser.add_argument("--model", default="gpt-3.5-turbo-0125")
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--chunk-size", type=int, default=100, help="Records read and checkpointed at a time.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Records translated concurrently.")
+    parser.add_argument("--checkpoint", default="", help="Defaults to OUTPUT.checkpoint.")
+    parser.add_argument("--memory", default="", help="Translation memory path. Disabled by default.")
+    args = parser.parse_args()
+    if args.source_language == args.target_language:
+        parser.error("Source language and target language must be different.")
+
+    from llm_translator import Translator
+    from translation_memory import TranslationMemory
+    from rate_limiter import PRIORITY_BATCH
+    translation_memory = TranslationMemory(args.memory) if args.memory else None
+    translator = Translator(translation_memory=translation_memory)
+    translator.priority = PRIORITY_BATCH
+    batch = BatchTranslator(translator, args.source_language, args.target_language, args.model, args.temperature,
+                            text_column=args.text_column, chunk_size=args.chunk_size, concurrency=args.concurrency)
+    try:
+        records_done, failures = batch.run(args.input, args.output, args.checkpoint or args.output + ".checkpoint",
+                                           file_format=args.format, log=lambda message: print(message, file=sys.stderr))
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"Translated {records_done} records ({failures} failed).", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+from stub_server import StubServer
+
+OPERATIONS = ("translate", "translate_by_sentence", "check_translation", "compare")
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(q * (len(values) - 1)))))
+    return values[index]
+
+
+def make_sentences(size: int) -> list:
+    return [f"This is sentence number {i} of the benchmark document." for i in range(size)]
+
+
+def make_templated_sentences(size: int, templates: int=50, seed: int=0) -> list:
+    """
+    Distinct sentences made from a few templates that differ only in a number, like the repeated sentences of manuals and UI texts.
+    Every sentence of a template is a near-duplicate of the others, which is the worst case of the LSH buckets.
+    """
+    generator = random.Random(seed)
+    words = ["".join(generator.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(generator.randint(3, 9))) for _ in range(2000)]
+    patterns = [" ".join(generator.choice(words) for _ in range(generator.randint(4, 8))) + " {}." for _ in range(templates)]
+    sentences = dict.fromkeys(generator.choice(patterns).format(generator.randint(1, 10 ** 7)) for _ in range(size))
+    return list(sentences)
+
+
+async def _timed(coroutine, latencies: list):
+    start = time.perf_counter()
+    result = await coroutine
+    latencies.append(time.perf_counter() - start)
+    return result
+
+
+async def run_operation(operation: str, size: int, concurrency: int, model: str) -> tuple:
+    """
+    Run an operation over `size` sentences or rows with `concurrency` requests in flight.
+    Return (latencies of the LLM calls, number of failed items).
+    """
+    import pandas as pd
+    from llm import gather_with_concurrency
+    from metrics import METRICS
+    from llm_translator import Translator
+    from llm_qa import QualityAssurance, FAILED_REVIEW
+    from llm_trans_compare import TranslationCompare, FAILED_REVIEW as COMPARE_FAILED_REVIEW
+    from const import EN, JA
+
+    sentences = make_sentences(size)
+    latencies = []
+    if operation == "translate":
+        translator = Translator()
+        translations = await gather_with_concurrency(concurrency, [_timed(translator.atranslate(EN, JA, s, model), latencies) for s in sentences])
+        return latencies, sum(1 for t in translations if not t.is_success)
+    # The other operations split the input into chunks themselves, so the latencies are those of their LLM calls.
+    METRICS.reset()
+    if operation == "translate_by_sentence":
+        translator = Translator(concurrency=concurrency, max_chunk_tokens=200)
+        translation = await translator.atranslate_by_sentence(EN, JA, " ".join(sentences), model, 0.0)
+        return METRICS.latencies(), 0 if translation.is_success and translation.error == "" else size
+    # The whole table is checked at once, as the pages and the job queue check it.
+    if operation == "check_translation":
+        qa = QualityAssurance(EN, JA, model, 0.0)
+        translation_data = pd.DataFrame({"source": sentences, "target": [f"T:{s}" for s in sentences]})
+        result = await qa.acheck_translation(translation_data, concurrency=concurrency)
+        return METRICS.latencies(), int((result["review"] == FAILED_REVIEW).sum())
+    if operation == "compare":
+        tc = TranslationCompare(EN, JA, model, 0.0)
+        translation_data = pd.DataFrame({"source": sentences, "target1": [f"A:{s}" for s in sentences], "target2": [f"B:{s}" for s in sentences]})
+        result = await tc.acheck_translation(translation_data, concurrency=concurrency)
+        return METRICS.latencies(), int((result["review"] == COMPARE_FAILED_REVIEW).sum())
+    raise ValueError(f"Unknown operation: {operation}")
+
+
+def run_benchmark(operations: list, sizes: list, concurrencies: list, server: StubServer, model: str="gpt-3.5-turbo", repeat: int=1) -> list:
+    """
+    Run every combination of operation, size and concurrency against the stub server and return the result records.
+    retries is the number of requests the client repeated after a 500 or 429 response of the stub, and injected_errors the number of 500 responses.
+    """
+    from llm import run_coroutine
+
+    results = []
+    for operation in operations:
+        for size in sizes:
+            for concurrency in concurrencies:
+                for _ in range(repeat):
+                    server.reset()
+                    start = time.perf_counter()
+                    latencies, failures = run_coroutine(run_operation(operation, size, concurrency, model))
+                    elapsed = time.perf_counter() - start
+                    stats = server.stats()
+                    results.append({
+                        "operation": operation,
+                        "size": size,
+                        "concurrency": concurrency,
+                        "elapsed": elapsed,
+                        "calls": len(latencies),
+                        "latency_p50": percentile(latencies, 0.5),
+                        "latency_p95": percentile(latencies, 0.95),
+                        "latency_mean": statistics.mean(latencies) if latencies else 0.0,
+                        "items_per_second": size / elapsed if elapsed else 0.0,
+                        "requests_per_second": stats["requests"] / elapsed if elapsed else 0.0,
+                        "upstream_requests": stats["requests"],
+                        "retries": stats["retries"],
+                        "injected_errors": stats["errors"],
+                        "malformed_responses": stats["malformed"],
+                        "failed_items": failures,
+                        "prompt_tokens": stats["prompt_tokens"],
+                        "completion_tokens": stats["completion_tokens"],
+                    })
+    return results
+
+
+def run_fuzzy_benchmark(entries: int, lookups: int=1000, model: str="gpt-3.5-turbo") -> dict:
+    """
+    Index `entries` templated pairs in a FuzzyTranslationMemory, and time lookups of edited indexed sentences.
+    recall is the share of the lookups whose best match is the sentence that was edited, rather than another sentence of its template.
+    No server is needed, as the lookup is local.
+    """
+    from fuzzy_memory import FuzzyTranslationMemory
+    from const import EN, JA
+
+    sentences = make_templated_sentences(entries)
+    memory = FuzzyTranslationMemory()
+    start = time.perf_counter()
+    memory.add_many(EN, JA, model, 0.0, ((s, f"T:{s}") for s in sentences))
+    index_seconds = time.perf_counter() - start
+    generator = random.Random(1)
+    originals = generator.sample(sentences, min(lookups, len(sentences)))
+    latencies = []
+    found = 0
+    for original in originals:
+        start = time.perf_counter()
+        matches = memory.search(EN, JA, model, 0.0, original[:-1] + "!")
+        latencies.append(time.perf_counter() - start)
+        found += int(bool(matches) and matches[0][1] == original)
+    return {
+        "operation": "fuzzy_lookup",
+        "size": len(sentences),
+        "index_seconds": index_seconds,
+        "calls": len(latencies),
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_mean": statistics.mean(latencies) if latencies else 0.0,
+        "recall": found / len(originals) if originals else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of Translator, QualityAssurance and TranslationCompare against a local stub server.")
+    parser.add_argument("--operations", nargs="+", default=list(OPERATIONS), choices=OPERATIONS)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10, 100])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8])
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.05, help="Stub latency in seconds per response.")
+    parser.add_argument("--latency-per-token", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--fuzzy-entries", nargs="*", type=int, default=[], help="Also time fuzzy memory lookups with these numbers of entries.")
+    parser.add_argument("--output", help="Write the results as JSON to the file instead of stdout.")
+    args = parser.parse_args()
+
+    server = StubServer(latency=args.latency, latency_per_token=args.latency_per_token,
+                        error_rate=args.error_rate, malformed_rate=args.malformed_rate).start()
+    os.environ["OPENAI_API_BASE"] = server.base_url
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    try:
+        results = run_benchmark(args.operations, args.sizes, args.concurrency, server, repeat=args.repeat)
+    finally:
+        server.stop()
+    results += [run_fuzzy_benchmark(entries) for entries in args.fuzzy_entries]
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "stub": {"latency": args.latency, "latency_per_token": args.latency_per_token,
+                 "error_rate": args.error_rate, "malformed_rate": args.malformed_rate},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
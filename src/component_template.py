@@ -1,4 +1,7 @@
 import streamlit as st
+import pandas as pd
+from job_queue import JobQueue, JobWorkerPool, DEFAULT_WORKERS, ACTIVE_STATUSES, FAILED, CANCELED
+from result_pipeline import ColumnarResult
 
 def generate_default_paramater():
     model = st.sidebar.radio("Choose a model:", ("GPT-3.5", "GPT-4o"), horizontal=True)
@@ -7,7 +10,95 @@ def generate_default_paramater():
 
     else:
         model_name = "gpt-4o-2024-05-13"
-    max_chars = 10000
+    max_chars = 50000
     temperature = st.sidebar.slider("Temperature:", min_value=0.0, max_value=2.0, value=0.0, step=0.1)
 
     return model_name, max_chars, temperature
+
+
+def generate_concurrency_paramater():
+    concurrency = st.sidebar.slider("Concurrency:", min_value=1, max_value=32, value=8, step=1)
+
+    return concurrency
+
+
+def generate_prefilter_paramater():
+    prefilter = st.sidebar.checkbox("Decide easy rows locally", value=True)
+
+    return prefilter
+
+
+def generate_cascade_paramater():
+    cascade = st.sidebar.checkbox("Cascade (GPT-3.5 → GPT-4o)", value=False)
+    min_accuracy = st.sidebar.slider("Min accuracy:", min_value=0, max_value=2, value=2, step=1, disabled=not cascade)
+    min_error = st.sidebar.slider("Min error:", min_value=0, max_value=2, value=1, step=1, disabled=not cascade)
+
+    return cascade, min_accuracy, min_error
+
+
+def generate_background_paramater():
+    background = st.sidebar.checkbox("Run in background", value=False)
+
+    return background
+
+
+@st.cache_resource
+def get_job_queue() -> JobQueue:
+    return JobQueue()
+
+
+@st.cache_resource
+def get_job_pool() -> JobWorkerPool:
+    # LLM_TRANSLATOR_JOB_WORKERS=0 なら、別途 job_queue.py で起動したワーカーに任せる
+    return JobWorkerPool(workers=DEFAULT_WORKERS).start()
+
+
+def show_jobs(kind: str, file_name: str):
+    """
+    Show the progress of the background jobs of the kind, and the results of the selected job, partial while it runs.
+    Return the results of the selected job.
+    """
+    queue = get_job_queue()
+    pool = get_job_pool()
+    jobs = queue.list_jobs(kind)
+    if not jobs:
+        return None
+    st.subheader("Jobs")
+    st.caption(f"{pool.alive()} workers running in this process")
+    st.dataframe(pd.DataFrame([[job["name"], job["status"], f"{job['done_rows']} / {job['rows']}", round(job["rows_per_second"], 2), round(job["cost"], 4)]
+                               for job in jobs], columns=["File", "Status", "Rows", "Rows/s", "Cost"]), hide_index=True)
+    labels = {job["id"]: f"{job['name']} ({job['id'][:8]})" for job in jobs}
+    job_id = st.selectbox("Job", list(labels), format_func=labels.get)
+    job = queue.get_job(job_id)
+    st.progress(job["done_rows"] / max(1, job["rows"]), text=f"{job['status']}: {job['done_rows']} / {job['rows']} rows, {job['rows_per_second']:.2f} rows/s")
+    st.caption(f"Cost: ${job['cost']:.4f} / {job['tokens']} tokens, decided locally: {job['decided']} rows")
+    if job["error"]:
+        st.error(job["error"])
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        if st.button("Refresh"):
+            st.rerun()
+    with col2:
+        if job["status"] in ACTIVE_STATUSES and st.button("Cancel"):
+            queue.cancel(job_id)
+            st.rerun()
+        if job["status"] in (FAILED, CANCELED) and st.button("Resume"):
+            queue.resume(job_id)
+            st.rerun()
+    with col3:
+        if st.button("Delete"):
+            queue.delete(job_id)
+            st.rerun()
+
+    if job["done_rows"] == 0:
+        return None
+    df = queue.results(job_id)
+    result = ColumnarResult(job["columns"])
+    result.extend(df)
+    col1, col2 = st.columns(2)
+    with col1:
+        st.download_button("Download CSV", result.to_csv(), file_name=f"{file_name}.csv", mime="text/csv")
+    with col2:
+        st.download_button("Download Parquet", result.to_parquet(), file_name=f"{file_name}.parquet", mime="application/octet-stream")
+    return df
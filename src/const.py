@@ -1,2 +1,9 @@
 EN = "English"
 JA = "Japanese"
+ZH = "Chinese"
+KO = "Korean"
+FR = "French"
+DE = "German"
+ES = "Spanish"
+# 文分割は EN と JA だけ規則で行い、他の言語は LLM で分割する
+LANGUAGES = (EN, JA, ZH, KO, FR, DE, ES)
@@ -0,0 +1,353 @@
+import html
+import re
+from html.parser import HTMLParser
+
+HTML = "html"
+MARKDOWN = "markdown"
+
+PLACEHOLDER_PATTERN = re.compile(r"⟦(\d+)⟧")
+
+# Elements rendered within a line. Their tags are replaced by placeholders, and the other tags split segments.
+INLINE_TAGS = {"a", "abbr", "b", "bdi", "bdo", "br", "cite", "code", "data", "del", "dfn", "em", "i", "img", "ins", "kbd", "mark",
+               "q", "s", "samp", "small", "span", "strong", "sub", "sup", "time", "u", "var", "wbr"}
+# Elements whose content is not translated.
+SKIP_TAGS = {"script", "style", "pre", "code", "textarea", "svg", "math"}
+# Elements whose content is raw text for HTMLParser, so it must not be escaped again.
+RAW_TEXT_TAGS = {"script", "style"}
+
+FENCE_PATTERN = re.compile(r"^[ \t]*(```|~~~)")
+BLOCK_PREFIX_PATTERN = re.compile(r"^([ \t]*(?:(?:#{1,6}|[-*+]|\d+[.)])[ \t]+(?:\[[ xX]\][ \t]+)?|>[ \t]?)*)")
+TABLE_SEPARATOR_PATTERN = re.compile(r"^[ \t]*\|?[ \t]*:?-+:?[ \t]*(\|[ \t]*:?-+:?[ \t]*)*\|?[ \t]*$")
+HORIZONTAL_RULE_PATTERN = re.compile(r"^[ \t]*([-*_])([ \t]*\1){2,}[ \t]*$")
+INLINE_MARKUP_PATTERN = re.compile(r"!\[[^\]]*\]\([^)]*\)"     # image
+                                   r"|`+[^`]*`+"               # inline code
+                                   r"|\[(?=[^\]]*\]\()"        # opening of a link
+                                   r"|\]\([^)]*\)"             # closing of a link and the URL
+                                   r"|<[^>\n]+>"               # inline HTML and autolinks
+                                   r"|https?://[^\s)>\]]+"     # bare URLs
+                                   r"|\*\*|__|~~"              # emphasis
+                                   r"|(?<![\w*])\*(?=\S)|(?<=\S)\*(?![\w*])")
+
+
+def has_letter(text: str) -> bool:
+    return any(c.isalpha() for c in text)
+
+
+class Segment:
+    """
+    Translatable text of a document with its inline markup replaced by placeholders like ⟦1⟧.
+    """
+    def __init__(self):
+        self.items = []
+
+    def add_text(self, text: str):
+        self.items.append((False, text))
+
+    def add_markup(self, markup: str):
+        # Consecutive markup becomes one placeholder.
+        if self.items and self.items[-1][0]:
+            self.items[-1] = (True, self.items[-1][1] + markup)
+        else:
+            self.items.append((True, markup))
+
+    def has_text(self) -> bool:
+        return any(not is_markup and has_letter(text) for is_markup, text in self.items)
+
+    def make_source(self, normalize_space: bool=False) -> tuple:
+        """
+        Return (prefix, source text, suffix, placeholders). The white space around the text is kept out of the source text.
+        """
+        placeholders = []
+        source = ""
+        for is_markup, text in self.items:
+            if is_markup:
+                source += f"⟦{len(placeholders)}⟧"
+                placeholders.append(text)
+            else:
+                source += re.sub(r"\s+", " ", text) if normalize_space else text
+        stripped = source.strip()
+        start = len(source) - len(source.lstrip())
+        return source[:start], stripped, source[start + len(stripped):], placeholders
+
+    def raw(self, escape) -> str:
+        return "".join(text if is_markup else escape(text) for is_markup, text in self.items)
+
+
+class Document:
+    """
+    A document split into raw parts and translatable segments.
+    """
+    def __init__(self, parts: list, segments: list, escape, normalize_space: bool=False):
+        self.parts = parts
+        self.segments = segments
+        self.escape = escape
+        self.sources = [segment.make_source(normalize_space) for segment in segments]
+
+    @property
+    def source_texts(self) -> list:
+        return [source for _, source, _, _ in self.sources]
+
+    def render(self, translated_texts: list) -> tuple:
+        """
+        Put the translated texts back in place of the segments. Return (text, number of segments whose placeholders were broken).
+        The markup of a broken segment is kept after its text, so that the structure of the document stays intact.
+        """
+        rendered = []
+        broken = 0
+        for i, (prefix, _, suffix, placeholders) in enumerate(self.sources):
+            text, is_broken = self._restore(translated_texts[i], placeholders)
+            rendered.append(prefix + text + suffix)
+            broken += int(is_broken)
+        return "".join(part if isinstance(part, str) else rendered[part] for part in self.parts), broken
+
+    def _restore(self, translated_text: str, placeholders: list) -> tuple:
+        ids = sorted(int(id) for id in PLACEHOLDER_PATTERN.findall(translated_text))
+        if ids != list(range(len(placeholders))):
+            return self.escape(PLACEHOLDER_PATTERN.sub("", translated_text)) + "".join(placeholders), True
+        pieces = PLACEHOLDER_PATTERN.split(translated_text)
+        # split() alternates the texts and the placeholder ids.
+        return "".join(self.escape(piece) if i % 2 == 0 else placeholders[int(piece)] for i, piece in enumerate(pieces)), False
+
+
+class _HTMLSegmenter(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.segments = []
+        self.segment = None
+        self.skip_tag = ""
+        self.skip_depth = 0
+        self.is_skip_inline = False
+
+    def handle_starttag(self, tag, attrs):
+        raw = self.get_starttag_text()
+        if self.skip_tag:
+            self.skip_depth += int(tag == self.skip_tag)
+            return self._add_skipped(raw)
+        if tag in SKIP_TAGS:
+            self.skip_tag = tag
+            self.skip_depth = 1
+            self.is_skip_inline = tag in INLINE_TAGS
+            return self._add_skipped(raw)
+        self._add_tag(tag, raw)
+
+    def handle_startendtag(self, tag, attrs):
+        raw = self.get_starttag_text()
+        if self.skip_tag:
+            return self._add_skipped(raw)
+        self._add_tag(tag, raw)
+
+    def handle_endtag(self, tag):
+        raw = f"</{tag}>"
+        if self.skip_tag:
+            self._add_skipped(raw)
+            if tag == self.skip_tag:
+                self.skip_depth -= 1
+                if self.skip_depth == 0:
+                    self.skip_tag = ""
+            return
+        self._add_tag(tag, raw)
+
+    def handle_data(self, data):
+        if self.skip_tag:
+            return self._add_skipped(data if self.skip_tag in RAW_TEXT_TAGS else html.escape(data, quote=False))
+        self._get_segment().add_text(data)
+
+    def handle_comment(self, data):
+        self._add_markup(f"<!--{data}-->")
+
+    def handle_decl(self, decl):
+        self._add_block(f"<!{decl}>")
+
+    def handle_pi(self, data):
+        self._add_block(f"<?{data}>")
+
+    def unknown_decl(self, data):
+        self._add_block(f"<![{data}]>")
+
+    def close(self):
+        super().close()
+        self._flush()
+
+    def _add_tag(self, tag: str, raw: str):
+        if tag in INLINE_TAGS:
+            self._get_segment().add_markup(raw)
+        else:
+            self._add_block(raw)
+
+    def _add_skipped(self, raw: str):
+        if self.is_skip_inline:
+            self._get_segment().add_markup(raw)
+        else:
+            self._add_block(raw)
+
+    def _add_markup(self, raw: str):
+        if self.segment is not None:
+            self.segment.add_markup(raw)
+        else:
+            self.parts.append(raw)
+
+    def _add_block(self, raw: str):
+        self._flush()
+        self.parts.append(raw)
+
+    def _get_segment(self) -> Segment:
+        if self.segment is None:
+            self.segment = Segment()
+        return self.segment
+
+    def _flush(self):
+        if self.segment is None:
+            return
+        if self.segment.has_text():
+            self.parts.append(len(self.segments))
+            self.segments.append(self.segment)
+        else:
+            self.parts.append(self.segment.raw(lambda text: html.escape(text, quote=False)))
+        self.segment = None
+
+
+def parse_html(text: str) -> Document:
+    """
+    Split HTML into segments per block element. Inline tags become placeholders, and the content of code, pre, script and style is kept as it is.
+    """
+    segmenter = _HTMLSegmenter()
+    segmenter.feed(text)
+    segmenter.close()
+    return Document(segmenter.parts, segmenter.segments, lambda text: html.escape(text, quote=False), normalize_space=True)
+
+
+def make_markdown_segment(text: str) -> Segment:
+    segment = Segment()
+    position = 0
+    for match in INLINE_MARKUP_PATTERN.finditer(text):
+        if match.start() > position:
+            segment.add_text(text[position:match.start()])
+        segment.add_markup(match.group())
+        position = match.end()
+    if position < len(text):
+        segment.add_text(text[position:])
+    return segment
+
+
+def parse_markdown(text: str) -> Document:
+    """
+    Split Markdown into segments per paragraph, heading, list item and table cell.
+    Block markers stay out of the segments, inline markup becomes placeholders, and code blocks are kept as they are.
+    """
+    parts = []
+    segments = []
+    fence = ""
+    previous_kind = "blank"
+    for line in text.splitlines(keepends=True):
+        content = line.rstrip("\r\n")
+        newline = line[len(content):]
+        match = FENCE_PATTERN.match(content)
+        if fence or match:
+            if fence and content.strip().startswith(fence):
+                fence = ""
+            elif not fence:
+                fence = match.group(1)
+            parts.append(line)
+            previous_kind = "code"
+            continue
+        if content.strip() == "":
+            parts.append(line)
+            previous_kind = "blank"
+            continue
+        is_indented_code = content.startswith(("    ", "\t")) and previous_kind in ("blank", "code") and not BLOCK_PREFIX_PATTERN.match(content.lstrip()).group(1)
+        if is_indented_code or HORIZONTAL_RULE_PATTERN.match(content) or TABLE_SEPARATOR_PATTERN.match(content) or content.lstrip().startswith("<"):
+            parts.append(line)
+            previous_kind = "code" if is_indented_code else "raw"
+            continue
+        if "|" in content and content.strip().startswith("|"):
+            # テーブルはセルごとに翻訳する
+            for i, cell in enumerate(content.split("|")):
+                if i > 0:
+                    parts.append("|")
+                _add_markdown_segment(parts, segments, cell)
+            parts.append(newline)
+            previous_kind = "table"
+            continue
+        prefix = BLOCK_PREFIX_PATTERN.match(content).group(1)
+        body = content[len(prefix):]
+        if prefix.strip() == "" and previous_kind == "paragraph" and isinstance(parts[-2], int):
+            # A continuation line of the previous paragraph joins its segment, so that a sentence across lines is translated as a whole.
+            segment = segments[parts[-2]]
+            segment.add_text("\n")
+            for item in make_markdown_segment(body.strip()).items:
+                segment.items.append(item)
+            continue
+        parts.append(prefix)
+        _add_markdown_segment(parts, segments, body)
+        parts.append(newline)
+        # 見出しは 1 行で終わるので、次の行を続きとして結合しない
+        previous_kind = "heading" if prefix.lstrip().startswith("#") else "paragraph"
+    return Document(parts, segments, lambda text: text)
+
+
+def _add_markdown_segment(parts: list, segments: list, text: str):
+    segment = make_markdown_segment(text)
+    if segment.has_text():
+        parts.append(len(segments))
+        segments.append(segment)
+    else:
+        parts.append(text)
+
+
+class DocumentTranslation:
+    def __init__(self, text: str, is_success: bool=True, cost: float=0.0, tokens: int=0, segments: int=0, broken_segments: int=0, error="", error_no=""):
+        self.text: str = text
+        self.is_success: bool = is_success
+        self.cost: float = cost
+        self.tokens: int = tokens
+        self.segments: int = segments
+        self.broken_segments: int = broken_segments
+        self.error: str = error
+        self.error_no: str = error_no
+
+    def __repr__(self):
+        return f"<DocumentTranslation segments={self.segments} broken_segments={self.broken_segments} cost={self.cost} tokens={self.tokens} error={self.error}>"
+
+    def __str__(self) -> str:
+        return self.text
+
+
+class DocumentTranslator:
+    """
+    Translate HTML or Markdown, sending only the text segments in table format requests and keeping the markup out of the prompt.
+    """
+    def __init__(self, translator):
+        self.translator = translator
+
+    def translate_document(self, source_language, target_language, text: str, document_type: str, model, temperature) -> DocumentTranslation:
+        document = self.parse(text, document_type)
+        if not document.segments:
+            return DocumentTranslation(text=text, is_success=True)
+        translation = self.translator.translate_texts(source_language, target_language, document.source_texts, model, temperature)
+        return self._make_document_translation(document, translation)
+
+    async def atranslate_document(self, source_language, target_language, text: str, document_type: str, model, temperature) -> DocumentTranslation:
+        """
+        Async version of translate_document.
+        """
+        document = self.parse(text, document_type)
+        if not document.segments:
+            return DocumentTranslation(text=text, is_success=True)
+        translation = await self.translator.atranslate_texts(source_language, target_language, document.source_texts, model, temperature)
+        return self._make_document_translation(document, translation)
+
+    def parse(self, text: str, document_type: str) -> Document:
+        if document_type == HTML:
+            return parse_html(text)
+        if document_type == MARKDOWN:
+            return parse_markdown(text)
+        raise ValueError(f"Unknown document type: {document_type}")
+
+    def _make_document_translation(self, document: Document, translation) -> DocumentTranslation:
+        if not translation.is_success or translation.error_no != "" or len(translation.translated_texts) != len(document.segments):
+            return DocumentTranslation(text="", is_success=False, cost=translation.cost, tokens=translation.tokens, segments=len(document.segments),
+                                       error=translation.error or "Failed to translate.", error_no=translation.error_no)
+        text, broken = document.render(translation.translated_texts)
+        return DocumentTranslation(text=text, is_success=True, cost=translation.cost, tokens=translation.tokens,
+                                   segments=len(document.segments), broken_segments=broken)
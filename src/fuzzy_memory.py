@@ -0,0 +1,194 @@
+import threading
+import zlib
+
+import numpy as np
+
+from translation_memory import normalize_text
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def char_ngrams(text: str, n: int=2) -> set:
+    """
+    Character n-grams of the normalized text. Works for Japanese as well as English, as no word segmentation is needed.
+    """
+    return _ngrams(normalize_text(text).lower(), n)
+
+
+def _ngrams(text: str, n: int) -> set:
+    if len(text) <= n:
+        return {text}
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def jaccard(a: set, b: set) -> float:
+    if not a and not b:
+        return 1.0
+    intersection = len(a & b)
+    return intersection / (len(a) + len(b) - intersection)
+
+
+class _PairIndex:
+    """
+    LSH index of one language pair, model and temperature. Each band is a (start, end) slice of the signature.
+    A bucket keeps only the newest max_bucket_size entries, so that templated sentences sharing every band do not make a lookup scan them all.
+    """
+    def __init__(self, num_perm: int, band_slices: list, max_bucket_size: int):
+        self.band_slices = band_slices
+        self.max_bucket_size = max_bucket_size
+        self.keys = []
+        self.sources = []
+        self.targets = []
+        self.ids = {}
+        self.signatures = np.empty((1024, num_perm), dtype=np.uint32)
+        self.buckets = [{} for _ in band_slices]
+
+    def add(self, key: str, source: str, target: str, signature: np.ndarray):
+        id = self.ids.get(key)
+        if id is not None:
+            self.targets[id] = target
+            return
+        id = len(self.sources)
+        if id == len(self.signatures):
+            self.signatures = np.concatenate([self.signatures, np.empty_like(self.signatures)])
+        self.ids[key] = id
+        self.keys.append(key)
+        self.sources.append(source)
+        self.targets.append(target)
+        self.signatures[id] = signature
+        for (start, end), bucket in zip(self.band_slices, self.buckets):
+            ids = bucket.setdefault(signature[start:end].tobytes(), [])
+            ids.append(id)
+            if len(ids) > self.max_bucket_size:
+                del ids[0]
+
+    def candidates(self, signature: np.ndarray) -> list:
+        ids = set()
+        for (start, end), bucket in zip(self.band_slices, self.buckets):
+            ids.update(bucket.get(signature[start:end].tobytes(), ()))
+        return list(ids)
+
+
+class FuzzyTranslationMemory:
+    """
+    In-memory MinHash/LSH index over translated (source, target) pairs for near-duplicate lookup.
+    Like TranslationMemory, pairs are kept per language pair, model and temperature.
+
+    Sources are indexed by character n-gram MinHash signatures split into LSH bands, so that a lookup
+    only compares the few entries sharing a band instead of every entry. Candidates are ranked by the
+    estimated similarity, and the top verify_candidates per result are verified with the exact n-gram Jaccard similarity.
+    With bands * rows = num_perm, pairs with a Jaccard similarity above about (1 / bands) ** (1 / rows) are found.
+    Each bucket keeps the newest max_bucket_size entries, which bounds a lookup to (bands + fine_bands) * max_bucket_size candidates.
+    Near-duplicates of a template are many more than that, so fine_bands bands of fine_rows rows, spread over the same signature
+    and overlapping if needed, are indexed as well: only the pairs almost identical to each other share them, and their buckets stay small.
+    An indexed source is always found by its normalized text.
+    """
+    def __init__(self, ngram: int=2, num_perm: int=30, bands: int=10, seed: int=1, batch_size: int=10000, max_bucket_size: int=128,
+                 fine_bands: int=4, fine_rows: int=15, verify_candidates: int=16):
+        if num_perm % bands != 0:
+            raise ValueError("num_perm must be a multiple of bands.")
+        if fine_rows > num_perm:
+            raise ValueError("fine_rows must not exceed num_perm.")
+        self.ngram = ngram
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.fine_bands = fine_bands
+        self.fine_rows = fine_rows
+        self.verify_candidates = verify_candidates
+        fine_starts = [round(band * (num_perm - fine_rows) / max(fine_bands - 1, 1)) for band in range(fine_bands)]
+        self._band_slices = ([(band * self.rows, (band + 1) * self.rows) for band in range(bands)]
+                             + [(start, start + fine_rows) for start in fine_starts])
+        self.batch_size = batch_size
+        self.max_bucket_size = max_bucket_size
+        generator = np.random.RandomState(seed)
+        self._a = generator.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._b = generator.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._lock = threading.Lock()
+        self._indexes = {}
+
+    def signature(self, ngrams: set) -> np.ndarray:
+        return self.signatures([ngrams])[0]
+
+    def signatures(self, ngram_sets: list) -> np.ndarray:
+        """
+        MinHash signatures of the n-gram sets, computed in one pass over all the n-grams.
+        """
+        hashes = np.array([zlib.crc32(ngram.encode()) for ngrams in ngram_sets for ngram in ngrams], dtype=np.uint64)
+        # (a * x + b) mod p fits in uint64 as a, b and x are below 2 ** 32.
+        permuted = (np.outer(hashes, self._a) + self._b) % MERSENNE_PRIME & MAX_HASH
+        offsets = np.cumsum([0] + [len(ngrams) for ngrams in ngram_sets[:-1]])
+        return np.minimum.reduceat(permuted, offsets, axis=0).astype(np.uint32)
+
+    def add(self, source_language: str, target_language: str, model: str, temperature: float, source: str, target: str):
+        self.add_many(source_language, target_language, model, temperature, [(source, target)])
+
+    def add_many(self, source_language: str, target_language: str, model: str, temperature: float, pairs):
+        """
+        Index (source, target) pairs. The target of an already indexed source is replaced.
+        """
+        key = (source_language, target_language, model, float(temperature))
+        entries = [(normalize_text(s), s, t) for s, t in pairs if isinstance(s, str) and isinstance(t, str)]
+        # Signatures are computed in batches to bound the memory of the n-gram hash matrix.
+        for start in range(0, len(entries), self.batch_size):
+            batch = entries[start:start + self.batch_size]
+            signatures = self.signatures([char_ngrams(normalized, self.ngram) for normalized, _, _ in batch])
+            with self._lock:
+                index = self._indexes.get(key)
+                if index is None:
+                    index = _PairIndex(self.num_perm, self._band_slices, self.max_bucket_size)
+                    self._indexes[key] = index
+                for (normalized, source, target), signature in zip(batch, signatures):
+                    index.add(normalized, source, target, signature)
+
+    def search(self, source_language: str, target_language: str, model: str, temperature: float, source: str, k: int=1, threshold: float=0.5) -> list:
+        """
+        Find the pairs similar to the source among those translated with the model and temperature.
+        Return up to k (similarity, source, target) tuples with similarity >= threshold, the most similar first.
+        """
+        index = self._indexes.get((source_language, target_language, model, float(temperature)))
+        if index is None:
+            return []
+        ngrams = char_ngrams(source, self.ngram)
+        signature = self.signature(ngrams)
+        with self._lock:
+            ids = index.candidates(signature)
+            # 満杯のバケットから押し出された文も、完全一致なら見つける
+            exact_id = index.ids.get(normalize_text(source))
+            if exact_id is not None and exact_id not in ids:
+                ids.append(exact_id)
+            if not ids:
+                return []
+            ids = np.array(ids, dtype=np.int64)
+            # 推定類似度は一致した値の数で比べる
+            matches = (index.signatures[ids] == signature).sum(axis=1)
+            count = min(k * self.verify_candidates, len(ids))
+            top = np.argpartition(-matches, count - 1)[:count] if count < len(ids) else np.arange(len(ids))
+            candidates = [(index.keys[id], index.sources[id], index.targets[id]) for id in ids[top].tolist()]
+        results = []
+        for candidate_key, candidate_source, candidate_target in candidates:
+            # The key is normalized already.
+            similarity = jaccard(ngrams, _ngrams(candidate_key.lower(), self.ngram))
+            if similarity >= threshold:
+                results.append((similarity, candidate_source, candidate_target))
+        results.sort(key=lambda result: -result[0])
+        return results[:k]
+
+    def load(self, translation_memory):
+        """
+        Index all the entries of a TranslationMemory.
+        """
+        pairs = {}
+        for source_language, target_language, model, temperature, source, target in translation_memory.items():
+            pairs.setdefault((source_language, target_language, model, temperature), []).append((source, target))
+        for (source_language, target_language, model, temperature), language_pairs in pairs.items():
+            self.add_many(source_language, target_language, model, temperature, language_pairs)
+        return self
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(index.sources) for index in self._indexes.values())
+
+    def __repr__(self):
+        return f"<FuzzyTranslationMemory entries={len(self)} num_perm={self.num_perm} bands={self.bands}>"
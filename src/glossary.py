@@ -0,0 +1,163 @@
+import threading
+import unicodedata
+
+
+def normalize_term(text: str) -> str:
+    """
+    Normalize text for term matching. Unicode width, case and runs of white space are unified.
+    """
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+def is_word_char(c: str) -> bool:
+    return c.isascii() and c.isalnum()
+
+
+class _Automaton:
+    """
+    Aho-Corasick automaton over the normalized terms, which finds every occurrence of every term in one pass over the text.
+    """
+    def __init__(self, keys: list):
+        self.keys = keys
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+        for id, key in enumerate(keys):
+            node = 0
+            for c in key:
+                next_node = self.goto[node].get(c)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto[node][c] = next_node
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.outputs.append([])
+                node = next_node
+            self.outputs[node].append(id)
+        # 幅優先で失敗遷移を作り、失敗先の出力を引き継ぐ
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for c, next_node in self.goto[node].items():
+                fail = self.fail[node]
+                while fail and c not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_node] = self.goto[fail].get(c, 0)
+                self.outputs[next_node] = self.outputs[next_node] + self.outputs[self.fail[next_node]]
+                queue.append(next_node)
+
+    def iter_matches(self, text: str):
+        """
+        Yield (start, end, id) of every occurrence of the terms in the text.
+        """
+        node = 0
+        for i, c in enumerate(text):
+            while node and c not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(c, 0)
+            for id in self.outputs[node]:
+                yield i + 1 - len(self.keys[id]), i + 1, id
+
+
+class _PairGlossary:
+    def __init__(self):
+        self.entries = {}
+        self.automaton = None
+
+
+class Glossary:
+    """
+    Term pairs of each language pair, indexed with an Aho-Corasick automaton.
+
+    Only the entries whose source term occurs in a text are looked up, so the cost of a lookup and the size of
+    the prompt grow with the terms in the text, not with the size of the glossary.
+    Terms match case-insensitively, and a term starting or ending with an ASCII letter or digit matches whole words only.
+    Overlapping occurrences are resolved to the leftmost longest term.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pairs = {}
+
+    def add(self, source_language: str, target_language: str, source: str, target: str):
+        self.add_many(source_language, target_language, [(source, target)])
+
+    def add_many(self, source_language: str, target_language: str, pairs):
+        """
+        Add (source term, target term) pairs. The target of an already added source term is replaced.
+        """
+        with self._lock:
+            glossary = self._pairs.setdefault((source_language, target_language), _PairGlossary())
+            for source, target in pairs:
+                if not isinstance(source, str) or not isinstance(target, str):
+                    continue
+                key = normalize_term(source)
+                if key and target.strip():
+                    glossary.entries[key] = (source.strip(), target.strip())
+            # The automaton is rebuilt on the next lookup.
+            glossary.automaton = None
+
+    def find(self, source_language: str, target_language: str, text: str) -> list:
+        """
+        Find the entries whose source term occurs in the text.
+        Return (source term, target term) pairs in order of first occurrence.
+        """
+        glossary, automaton = self._get_automaton(source_language, target_language)
+        if automaton is None:
+            return []
+        text = normalize_term(text)
+        matches = [(start, end, id) for start, end, id in automaton.iter_matches(text) if self._is_word(text, start, end)]
+        matches.sort(key=lambda match: (match[0], match[0] - match[1]))
+        found = {}
+        position = 0
+        for start, end, id in matches:
+            if start >= position:
+                found.setdefault(automaton.keys[id], None)
+                position = end
+        return [glossary.entries[key] for key in found]
+
+    def find_many(self, source_language: str, target_language: str, texts: list) -> list:
+        """
+        Find the entries whose source term occurs in any of the texts, without duplicates.
+        """
+        found = {}
+        for text in texts:
+            for source, target in self.find(source_language, target_language, text):
+                found.setdefault(source, target)
+        return list(found.items())
+
+    def check(self, source_language: str, target_language: str, source_texts: list, translated_texts: list) -> list:
+        """
+        Check the translations locally. Return (index, source term, target term) of each term found in a source text
+        whose target term is missing in the translated text.
+        """
+        violations = []
+        for i, (source_text, translated_text) in enumerate(zip(source_texts, translated_texts)):
+            if not isinstance(source_text, str) or not isinstance(translated_text, str):
+                continue
+            normalized_translated_text = normalize_term(translated_text)
+            for source, target in self.find(source_language, target_language, source_text):
+                if normalize_term(target) not in normalized_translated_text:
+                    violations.append((i, source, target))
+        return violations
+
+    def _get_automaton(self, source_language: str, target_language: str) -> tuple:
+        with self._lock:
+            glossary = self._pairs.get((source_language, target_language))
+            if glossary is None or not glossary.entries:
+                return glossary, None
+            if glossary.automaton is None:
+                glossary.automaton = _Automaton(list(glossary.entries))
+            return glossary, glossary.automaton
+
+    def _is_word(self, text: str, start: int, end: int) -> bool:
+        if is_word_char(text[start]) and start > 0 and is_word_char(text[start - 1]):
+            return False
+        if is_word_char(text[end - 1]) and end < len(text) and is_word_char(text[end]):
+            return False
+        return True
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(glossary.entries) for glossary in self._pairs.values())
+
+    def __repr__(self):
+        return f"<Glossary entries={len(self)}>"
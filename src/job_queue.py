@@ -0,0 +1,448 @@
+import argparse
+import asyncio
+import functools
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import pandas as pd
+from llm import run_coroutine
+
+DEFAULT_JOB_PATH = os.environ.get("LLM_TRANSLATOR_JOB_PATH", os.path.join(".cache", "jobs.sqlite3"))
+DEFAULT_WORKERS = int(os.environ.get("LLM_TRANSLATOR_JOB_WORKERS", "2"))
+
+# ジョブの種類
+QA = "qa"
+COMPARE = "compare"
+
+# ジョブと chunk の状態
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELED = "canceled"
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+
+def _dump_frame(df: pd.DataFrame) -> str:
+    rows = df.astype(object).where(pd.notna(df), None).values.tolist()
+    return json.dumps(rows, ensure_ascii=False, default=lambda value: value.item() if hasattr(value, "item") else str(value))
+
+
+def _load_frame(data: str, columns: list) -> pd.DataFrame:
+    return pd.DataFrame(json.loads(data), columns=columns)
+
+
+def make_check(kind: str, params: dict) -> tuple:
+    """
+    Make the checker of a job and the coroutine function checking a chunk DataFrame with it. Return (checker, check).
+    """
+    from prefilter import Prefilter
+    prefilter = None
+    if params.get("prefilter"):
+        prefilter = Prefilter(median_log_ratio=params.get("median_log_ratio"))
+        # 投入時にファイル全体で求めた中央値を、どのワーカーでも使う
+        prefilter.fitted = "median_log_ratio" in params
+    options = {"source_language": params["source_language"],
+               "target_language": params["target_language"],
+               "model": params["model"],
+               "temperature": params["temperature"],
+               "prefilter": prefilter}
+    concurrency = params.get("concurrency", 8)
+    if kind == QA:
+        from llm_qa import QualityAssurance
+        checker = QualityAssurance(**options)
+        if params.get("mode") == "batch":
+            return checker, functools.partial(checker.acheck_translation_batch, concurrency=concurrency)
+        return checker, functools.partial(checker.acheck_translation, concurrency=concurrency)
+    if kind == COMPARE:
+        from llm_trans_compare import TranslationCompare
+        checker = TranslationCompare(**options)
+        if params.get("mode") == "n-way":
+            return checker, functools.partial(checker.acheck_translation_nway, engines=params["engines"], concurrency=concurrency)
+        return checker, functools.partial(checker.acheck_translation, concurrency=concurrency)
+    raise ValueError(f"Unknown job kind: {kind}")
+
+
+class JobQueue:
+    """
+    Persistent queue of QA and TransCompare jobs backed by SQLite.
+
+    A job is stored as chunks of input rows, and each chunk is claimed, checked and stored by a worker independently,
+    so that the workers of several processes share a job and the results survive a restart of the UI or the workers.
+    A worker holds a lease on its chunk and renews it while checking; a chunk whose lease expired is claimed again,
+    so an interrupted job resumes from its last finished chunk, not row; the chunk size sets the granularity.
+    A chunk failing max_attempts times fails the job. Canceling a job stops the chunks being checked and discards their partial results.
+    """
+    def __init__(self, path: str=DEFAULT_JOB_PATH, lease: float=60.0, max_attempts: int=3):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # トランザクションは _transaction で明示的に開始する
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        with self._transaction():
+            self._conn.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                               "id TEXT PRIMARY KEY,"
+                               "kind TEXT NOT NULL,"
+                               "name TEXT NOT NULL,"
+                               "params TEXT NOT NULL,"
+                               "columns TEXT NOT NULL,"
+                               "status TEXT NOT NULL,"
+                               "error TEXT NOT NULL DEFAULT '',"
+                               "created_at REAL NOT NULL,"
+                               "started_at REAL,"
+                               "finished_at REAL)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS chunks ("
+                               "job_id TEXT NOT NULL,"
+                               "chunk_index INTEGER NOT NULL,"
+                               "rows INTEGER NOT NULL,"
+                               "input TEXT NOT NULL,"
+                               "input_columns TEXT NOT NULL,"
+                               "result TEXT,"
+                               "status TEXT NOT NULL,"
+                               "attempts INTEGER NOT NULL DEFAULT 0,"
+                               "worker TEXT NOT NULL DEFAULT '',"
+                               "heartbeat_at REAL,"
+                               "finished_at REAL,"
+                               "cost REAL NOT NULL DEFAULT 0,"
+                               "tokens INTEGER NOT NULL DEFAULT 0,"
+                               "decided INTEGER NOT NULL DEFAULT 0,"
+                               "PRIMARY KEY (job_id, chunk_index))")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS chunks_status ON chunks (status)")
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def submit(self, kind: str, params: dict, columns: list, chunks, name: str="") -> str:
+        """
+        Queue a job checking the chunk DataFrames, whose results have the given columns. Return the job id.
+        """
+        job_id = uuid.uuid4().hex
+        with self._transaction():
+            self._conn.execute("INSERT INTO jobs (id, kind, name, params, columns, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (job_id, kind, name, json.dumps(params, ensure_ascii=False), json.dumps(columns), QUEUED, time.time()))
+            chunk_index = 0
+            for chunk in chunks:
+                if chunk.empty:
+                    continue
+                self._conn.execute("INSERT INTO chunks (job_id, chunk_index, rows, input, input_columns, status) VALUES (?, ?, ?, ?, ?, ?)",
+                                   (job_id, chunk_index, len(chunk), _dump_frame(chunk), json.dumps(list(chunk.columns)), QUEUED))
+                chunk_index += 1
+            if chunk_index == 0:
+                self._conn.execute("UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?", (FAILED, "Please input text.", time.time(), job_id))
+        return job_id
+
+    def claim(self, worker: str):
+        """
+        Claim the next chunk to check, oldest job first. Return (job id, kind, params, chunk index, DataFrame), or None if there is none.
+        """
+        now = time.time()
+        with self._transaction():
+            # リースが切れたまま試行回数を使い切った chunk は、ジョブごと失敗にする
+            exhausted = self._conn.execute("SELECT job_id, chunk_index FROM chunks WHERE status = ? AND heartbeat_at < ? AND attempts >= ?",
+                                           (RUNNING, now - self.lease, self.max_attempts)).fetchall()
+            for job_id, chunk_index in exhausted:
+                self._fail_chunk(job_id, chunk_index, "The worker stopped while checking the chunk.", now)
+            row = self._conn.execute("SELECT c.job_id, j.kind, j.params, c.chunk_index, c.input, c.input_columns "
+                                     "FROM chunks c JOIN jobs j ON j.id = c.job_id "
+                                     "WHERE j.status IN (?, ?) AND (c.status = ? OR (c.status = ? AND c.heartbeat_at < ?)) "
+                                     "ORDER BY j.created_at, c.chunk_index LIMIT 1",
+                                     (QUEUED, RUNNING, QUEUED, RUNNING, now - self.lease)).fetchone()
+            if row is None:
+                return None
+            job_id, kind, params, chunk_index, data, input_columns = row
+            self._conn.execute("UPDATE chunks SET status = ?, worker = ?, heartbeat_at = ?, attempts = attempts + 1 WHERE job_id = ? AND chunk_index = ?",
+                               (RUNNING, worker, now, job_id, chunk_index))
+            self._conn.execute("UPDATE jobs SET status = ?, started_at = COALESCE(started_at, ?) WHERE id = ? AND status = ?",
+                               (RUNNING, now, job_id, QUEUED))
+        return job_id, kind, json.loads(params), chunk_index, _load_frame(data, json.loads(input_columns))
+
+    def heartbeat(self, job_id: str, chunk_index: int, worker: str) -> bool:
+        """
+        Renew the lease on a claimed chunk. Return False if the chunk was taken over or its job is no longer active.
+        """
+        with self._transaction():
+            cursor = self._conn.execute("UPDATE chunks SET heartbeat_at = ? WHERE job_id = ? AND chunk_index = ? AND worker = ? AND status = ?",
+                                        (time.time(), job_id, chunk_index, worker, RUNNING))
+            status = self._conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return cursor.rowcount == 1 and status is not None and status[0] in ACTIVE_STATUSES
+
+    def complete(self, job_id: str, chunk_index: int, worker: str, result: pd.DataFrame, cost: float=0.0, tokens: int=0, decided: int=0) -> bool:
+        """
+        Store the result of a claimed chunk. The job is done when all of its chunks are done.
+        Return False without storing it if the chunk was taken over or the job is no longer active, e.g. canceled.
+        """
+        now = time.time()
+        with self._transaction():
+            status = self._conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if status is None or status[0] not in ACTIVE_STATUSES:
+                self._release_chunk(job_id, chunk_index, worker)
+                return False
+            cursor = self._conn.execute("UPDATE chunks SET status = ?, result = ?, finished_at = ?, cost = ?, tokens = ?, decided = ? "
+                                        "WHERE job_id = ? AND chunk_index = ? AND worker = ? AND status = ?",
+                                        (DONE, _dump_frame(result), now, cost, tokens, decided, job_id, chunk_index, worker, RUNNING))
+            if cursor.rowcount == 0:
+                return False
+            remaining = self._conn.execute("SELECT COUNT(*) FROM chunks WHERE job_id = ? AND status != ?", (job_id, DONE)).fetchone()[0]
+            if remaining == 0:
+                self._conn.execute("UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status IN (?, ?)", (DONE, now, job_id, QUEUED, RUNNING))
+        return True
+
+    def release(self, job_id: str, chunk_index: int, worker: str):
+        """
+        Give back a claimed chunk unchecked, without counting the attempt, e.g. when its job was canceled.
+        """
+        with self._transaction():
+            self._release_chunk(job_id, chunk_index, worker)
+
+    def _release_chunk(self, job_id: str, chunk_index: int, worker: str):
+        self._conn.execute("UPDATE chunks SET status = ?, worker = '', attempts = MAX(0, attempts - 1) "
+                           "WHERE job_id = ? AND chunk_index = ? AND worker = ? AND status = ?",
+                           (QUEUED, job_id, chunk_index, worker, RUNNING))
+
+    def fail(self, job_id: str, chunk_index: int, worker: str, error: str, retry: bool=True):
+        """
+        Give back a claimed chunk which raised an error. It is retried up to max_attempts times, otherwise the job fails.
+        """
+        with self._transaction():
+            row = self._conn.execute("SELECT attempts FROM chunks WHERE job_id = ? AND chunk_index = ? AND worker = ? AND status = ?",
+                                     (job_id, chunk_index, worker, RUNNING)).fetchone()
+            if row is None:
+                return
+            if retry and row[0] < self.max_attempts:
+                self._conn.execute("UPDATE chunks SET status = ?, worker = '' WHERE job_id = ? AND chunk_index = ?", (QUEUED, job_id, chunk_index))
+            else:
+                self._fail_chunk(job_id, chunk_index, error, time.time())
+
+    def _fail_chunk(self, job_id: str, chunk_index: int, error: str, now: float):
+        self._conn.execute("UPDATE chunks SET status = ?, worker = '' WHERE job_id = ? AND chunk_index = ?", (FAILED, job_id, chunk_index))
+        self._conn.execute("UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ? AND status IN (?, ?)",
+                           (FAILED, f"Chunk {chunk_index + 1}: {error}", now, job_id, QUEUED, RUNNING))
+
+    def cancel(self, job_id: str):
+        """
+        Stop claiming the chunks of the job. The results of the finished chunks are kept.
+        """
+        with self._transaction():
+            self._conn.execute("UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status IN (?, ?)", (CANCELED, time.time(), job_id, QUEUED, RUNNING))
+
+    def resume(self, job_id: str):
+        """
+        Queue the unfinished chunks of a failed or canceled job again.
+        """
+        with self._transaction():
+            cursor = self._conn.execute("UPDATE jobs SET status = ?, error = '', finished_at = NULL WHERE id = ? AND status IN (?, ?)",
+                                        (QUEUED, job_id, FAILED, CANCELED))
+            if cursor.rowcount == 1:
+                self._conn.execute("UPDATE chunks SET status = ?, worker = '', attempts = 0 WHERE job_id = ? AND status != ?", (QUEUED, job_id, DONE))
+
+    def delete(self, job_id: str):
+        with self._transaction():
+            self._conn.execute("DELETE FROM chunks WHERE job_id = ?", (job_id,))
+            self._conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def list_jobs(self, kind: str=None, limit: int=20) -> list:
+        """
+        Return the progress of the latest jobs, newest first.
+        Throughput is the rows checked per second from the start of the job to its last finished chunk.
+        """
+        if kind is None:
+            return self._select_jobs("", [], limit)
+        return self._select_jobs("WHERE j.kind = ? ", [kind], limit)
+
+    def get_job(self, job_id: str):
+        jobs = self._select_jobs("WHERE j.id = ? ", [job_id], 1)
+        return jobs[0] if jobs else None
+
+    def _select_jobs(self, condition: str, params: list, limit: int) -> list:
+        query = ("SELECT j.id, j.kind, j.name, j.status, j.error, j.columns, j.created_at, j.started_at, j.finished_at, "
+                 "COUNT(c.chunk_index), COALESCE(SUM(c.status = ?), 0), COALESCE(SUM(c.rows), 0), "
+                 "COALESCE(SUM(CASE WHEN c.status = ? THEN c.rows ELSE 0 END), 0), "
+                 "COALESCE(SUM(c.cost), 0), COALESCE(SUM(c.tokens), 0), COALESCE(SUM(c.decided), 0), MAX(c.finished_at) "
+                 "FROM jobs j LEFT JOIN chunks c ON c.job_id = j.id " + condition +
+                 "GROUP BY j.id ORDER BY j.created_at DESC LIMIT ?")
+        with self._lock:
+            rows = self._conn.execute(query, [DONE, DONE] + params + [limit]).fetchall()
+        jobs = []
+        for (job_id, kind, name, status, error, columns, created_at, started_at, finished_at,
+             chunks, done_chunks, total_rows, done_rows, cost, tokens, decided, last_finished_at) in rows:
+            elapsed = (last_finished_at - started_at) if started_at and last_finished_at else 0.0
+            jobs.append({"id": job_id, "kind": kind, "name": name, "status": status, "error": error, "columns": json.loads(columns),
+                         "created_at": created_at, "started_at": started_at, "finished_at": finished_at,
+                         "chunks": chunks, "done_chunks": done_chunks, "rows": total_rows, "done_rows": done_rows,
+                         "cost": cost, "tokens": tokens, "decided": decided,
+                         "rows_per_second": done_rows / elapsed if elapsed > 0 else 0.0})
+        return jobs
+
+    def results(self, job_id: str) -> pd.DataFrame:
+        """
+        Return the results of the finished chunks of the job in input order, so that a running job gives its partial results.
+        """
+        with self._lock:
+            columns = self._conn.execute("SELECT columns FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            rows = self._conn.execute("SELECT result FROM chunks WHERE job_id = ? AND status = ? ORDER BY chunk_index", (job_id, DONE)).fetchall()
+        if columns is None:
+            return pd.DataFrame()
+        columns = json.loads(columns[0])
+        frames = [_load_frame(row[0], columns) for row in rows]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class JobWorker:
+    """
+    Claim chunks from the queue and check them until stopped. The checker of a job is reused across its chunks.
+    """
+    def __init__(self, queue: JobQueue, worker: str="", poll_interval: float=1.0):
+        self.queue = queue
+        self.worker = worker or f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.poll_interval = poll_interval
+        self._checkers = {}
+
+    def run(self, stop_event=None):
+        while stop_event is None or not stop_event.is_set():
+            if not self.run_once():
+                time.sleep(self.poll_interval)
+
+    def run_once(self) -> bool:
+        """
+        Check one chunk. Return False if there was no chunk to check.
+        """
+        claimed = self.queue.claim(self.worker)
+        if claimed is None:
+            return False
+        job_id, kind, params, chunk_index, chunk = claimed
+        stopped = threading.Event()
+        canceled = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job_id, chunk_index, stopped, canceled), daemon=True)
+        heartbeat.start()
+        try:
+            checker, check = self._get_check(job_id, kind, params)
+            cost, tokens, decided = checker.total_cost, checker.total_tokens, checker.prefilter_report.decided
+            result = run_coroutine(self._run_check(check, chunk, canceled))
+            if result is None:
+                self.queue.release(job_id, chunk_index, self.worker)
+            elif isinstance(result, tuple):
+                # (False, error message) of the input validation. Retrying does not help.
+                self.queue.fail(job_id, chunk_index, self.worker, result[1], retry=False)
+            else:
+                self.queue.complete(job_id, chunk_index, self.worker, result, cost=checker.total_cost - cost, tokens=checker.total_tokens - tokens,
+                                    decided=checker.prefilter_report.decided - decided)
+        except Exception as e:
+            self.queue.fail(job_id, chunk_index, self.worker, f"{type(e).__name__}: {e}")
+        finally:
+            stopped.set()
+            heartbeat.join()
+        return True
+
+    def _get_check(self, job_id: str, kind: str, params: dict) -> tuple:
+        if job_id not in self._checkers:
+            # 直近のジョブの checker だけを保持する
+            self._checkers = {job_id: make_check(kind, params)}
+        return self._checkers[job_id]
+
+    async def _run_check(self, check, chunk: pd.DataFrame, canceled: threading.Event):
+        """
+        Run the check of the chunk, and stop it as soon as the job is canceled or the chunk is taken over. Return None if it was stopped.
+        """
+        task = asyncio.ensure_future(check(chunk))
+        while not task.done():
+            await asyncio.wait({task}, timeout=0.1)
+            if canceled.is_set() and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                return None
+        return task.result()
+
+    def _heartbeat(self, job_id: str, chunk_index: int, stopped: threading.Event, canceled: threading.Event):
+        # キャンセルに早く気付けるよう、リースの 1/3 より短い間隔でも確認する
+        while not stopped.wait(min(self.queue.lease / 3, self.poll_interval)):
+            if not self.queue.heartbeat(job_id, chunk_index, self.worker):
+                canceled.set()
+                return
+
+
+def run_worker(path: str, lease: float, max_attempts: int, poll_interval: float):
+    queue = JobQueue(path, lease=lease, max_attempts=max_attempts)
+    try:
+        JobWorker(queue, poll_interval=poll_interval).run()
+    except KeyboardInterrupt:
+        pass
+
+
+class JobWorkerPool:
+    """
+    Worker processes running the jobs of a queue. Workers are spawned, not forked, as the parent runs threads.
+    """
+    def __init__(self, path: str=DEFAULT_JOB_PATH, workers: int=DEFAULT_WORKERS, lease: float=60.0, max_attempts: int=3, poll_interval: float=1.0):
+        self.path = path
+        self.workers = workers
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.processes = []
+
+    def start(self):
+        context = multiprocessing.get_context("spawn")
+        self.processes = [context.Process(target=run_worker, args=(self.path, self.lease, self.max_attempts, self.poll_interval), daemon=True)
+                          for _ in range(self.workers)]
+        for process in self.processes:
+            process.start()
+        return self
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+    def join(self):
+        for process in self.processes:
+            process.join()
+
+    def alive(self) -> int:
+        return sum(1 for process in self.processes if process.is_alive())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the workers of the QA and TransCompare job queue.")
+    parser.add_argument("--path", default=DEFAULT_JOB_PATH, help="Job queue database.")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Worker processes.")
+    parser.add_argument("--lease", type=float, default=60.0, help="Seconds after which the chunk of a stopped worker is checked again.")
+    parser.add_argument("--max-attempts", type=int, default=3, help="Attempts per chunk before the job fails.")
+    args = parser.parse_args()
+
+    pool = JobWorkerPool(args.path, workers=args.workers, lease=args.lease, max_attempts=args.max_attempts).start()
+    print(f"Started {args.workers} workers on {args.path}.", file=sys.stderr)
+    try:
+        pool.join()
+    except KeyboardInterrupt:
+        pool.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import json
+
+
+class IncrementalArrayParser:
+    """
+    Incrementally parse the array value of `key` from a JSON text fed in pieces.
+    feed() returns the array items completed by the piece, so that they can be used before the whole response arrives.
+    """
+    def __init__(self, key: str):
+        self.key = key
+        self.buffer = ""
+        self.items = []
+        self.is_closed = False
+        self._position = -1
+        self._item_start = -1
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, text: str) -> list:
+        self.buffer += text
+        if self.is_closed:
+            return []
+        if self._position < 0 and not self._find_array_start():
+            return []
+        items = []
+        while self._position < len(self.buffer) and not self.is_closed:
+            c = self.buffer[self._position]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif c == "\\":
+                    self._escaped = True
+                elif c == "\"":
+                    self._in_string = False
+            elif c == "\"":
+                self._in_string = True
+                if self._item_start < 0:
+                    self._item_start = self._position
+            elif c in "[{":
+                self._depth += 1
+                if self._item_start < 0:
+                    self._item_start = self._position
+            elif c in "]}" and self._depth > 0:
+                self._depth -= 1
+            elif c in ",]" and self._depth == 0:
+                if self._item_start >= 0:
+                    try:
+                        items.append(json.loads(self.buffer[self._item_start:self._position], strict=False))
+                    except json.decoder.JSONDecodeError:
+                        self.items += items
+                        raise
+                    self._item_start = -1
+                self.is_closed = c == "]"
+            elif not c.isspace() and self._item_start < 0:
+                self._item_start = self._position
+            self._position += 1
+        self.items += items
+        return items
+
+    def _find_array_start(self) -> bool:
+        """
+        Find the "[" after the key. Return False if it has not arrived yet.
+        """
+        key_index = self.buffer.find(json.dumps(self.key))
+        if key_index < 0:
+            return False
+        bracket_index = self.buffer.find("[", key_index)
+        if bracket_index < 0:
+            return False
+        self._position = bracket_index + 1
+        return True
+
+
+def salvage_array(text: str, key: str) -> list:
+    """
+    Recover the complete items of the array value of `key` from a malformed or truncated JSON text.
+    """
+    parser = IncrementalArrayParser(key)
+    try:
+        parser.feed(text)
+    except json.decoder.JSONDecodeError:
+        pass
+    return parser.items
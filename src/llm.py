@@ -1,42 +1,230 @@
+from __future__ import annotations
+
 import os
 import json
+import asyncio
+import atexit
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from llm_registry import REGISTRY
+from metrics import METRICS, CallMetric
+from json_parser import salvage_array
+from rate_limiter import RATE_LIMITER, PRIORITY_INTERACTIVE
+
+if TYPE_CHECKING:
+    from langchain import LLMChain
+    from langchain.chat_models import ChatOpenAI
+
+# Key set in the result when only the complete prefix of a truncated array was recovered.
+PARTIAL_KEY = "_partial"
+
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """
+    Estimate the cost of a call from its token counts with the price table of LangChain. An unknown model costs 0.
+    """
+    from langchain_community.callbacks.openai_info import get_openai_token_cost_for_model
+    try:
+        return (get_openai_token_cost_for_model(model, prompt_tokens)
+                + get_openai_token_cost_for_model(model, completion_tokens, is_completion=True))
+    except ValueError:
+        return 0.0
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Roughly estimate the number of tokens of the text without a tokenizer.
+    ASCII text is about 4 characters per token, and Japanese text is about 1 character per token.
+    """
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Get the process-wide event loop, which runs in a daemon thread.
+    Sync code runs its coroutines on this one loop, so that the async client bound to it is reused instead of one per asyncio.run.
+    """
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            _event_loop = asyncio.new_event_loop()
+            threading.Thread(target=_event_loop.run_forever, name="llm-event-loop", daemon=True).start()
+            atexit.register(_close_event_loop)
+        return _event_loop
+
+
+def run_coroutine(coroutine):
+    """
+    Run a coroutine on the process-wide event loop from sync code, and return its result.
+    It must not be called from a coroutine running on that loop.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop()).result()
+
+
+def _close_event_loop():
+    # 終了時に、ループに紐づいたクライアントの接続を閉じる
+    try:
+        asyncio.run_coroutine_threadsafe(REGISTRY.aclose(), _event_loop).result(timeout=5)
+    finally:
+        _event_loop.call_soon_threadsafe(_event_loop.stop)
+
+
+async def gather_with_concurrency(concurrency: int, coroutines) -> list:
+    """
+    Run coroutines with at most `concurrency` of them in flight, and return the results in input order.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def _run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*[_run(c) for c in coroutines])
 
-from langchain import LLMChain
-from langchain.chat_models import ChatOpenAI
-from langchain.callbacks import get_openai_callback
-from langchain.prompts.chat import (
-    ChatPromptTemplate,
-    SystemMessagePromptTemplate,
-    HumanMessagePromptTemplate,
-)
 
 class LLM:
+    # Priority of the calls in the rate limiter. Subclasses for batch work lower it.
+    priority = PRIORITY_INTERACTIVE
+
     def __init__(self, debug=False) -> None:
         if not os.environ.get("OPENAI_API_KEY"):
             raise ValueError("OPENAI_API_KEY is not set.")
         self.debug = debug
         self.BEGIN_JSON_FORMAT = "```json\n"
         self.END_JSON_FORMAT = "\n```"
+        self.total_cost = 0.0
+        self.total_tokens = 0
+        self._usage_lock = threading.Lock()
 
     def _get_llm(self, model: str="gpt-3.5-turbo", temperature: float=0.0, max_tokens: int=2000) -> ChatOpenAI:
-        return ChatOpenAI(
-            model=model,
-            temperature=temperature,
-            max_tokens=max_tokens,
-        )
+        return REGISTRY.get_llm(model=model, temperature=temperature, max_tokens=max_tokens)
 
     def _make_llm_chain(self, llm, system_template, human_template) -> LLMChain:
-        system_message_prompt = SystemMessagePromptTemplate.from_template(system_template)
-        human_message_prompt = HumanMessagePromptTemplate.from_template(human_template)
-        chat_prompt = ChatPromptTemplate.from_messages([system_message_prompt, human_message_prompt])
+        # LangChain is heavy to import, so it is loaded with the first chain.
+        from langchain import LLMChain
+        chat_prompt = REGISTRY.get_prompt(system_template, human_template)
         chain = LLMChain(llm=llm, prompt=chat_prompt)
         return chain
 
-    def _run_llm_chain(self, chain: LLMChain, **kwargs) -> tuple:
+    def _run_llm_chain(self, chain: LLMChain, operation: str="llm", salvage_key: str="", cache: str="", **kwargs) -> tuple:
+        """
+        Run the chain and parse the JSON response.
+        If salvage_key is set and the response is malformed, the complete items of that array are recovered.
+        cache is the cache status recorded with the call, CACHE_MISS if the call follows a cache lookup.
+        """
+        from langchain.callbacks import get_openai_callback
+        estimated_tokens = self._estimate_call_tokens(chain, kwargs)
+        RATE_LIMITER.acquire(estimated_tokens, self.priority)
+        start = time.perf_counter()
+        with get_openai_callback() as _callback:
+            try:
+                response = chain.run(kwargs)
+            except Exception as e:
+                self._record_call(chain, operation, start, _callback, error_no=type(e).__name__, cache=cache)
+                RATE_LIMITER.settle(estimated_tokens, _callback.total_tokens, is_success=False)
+                raise
+            cost = _callback.total_cost
+            tokens = _callback.total_tokens
+        self._record_call(chain, operation, start, _callback, cache=cache)
+        RATE_LIMITER.settle(estimated_tokens, tokens)
+        return self._parse_response(response, salvage_key), cost, tokens
+
+    async def _arun_llm_chain(self, chain: LLMChain, operation: str="llm", salvage_key: str="", cache: str="", **kwargs) -> tuple:
+        """
+        Async version of _run_llm_chain.
+        """
+        from langchain.callbacks import get_openai_callback
+        estimated_tokens = self._estimate_call_tokens(chain, kwargs)
+        await RATE_LIMITER.aacquire(estimated_tokens, self.priority)
+        start = time.perf_counter()
         with get_openai_callback() as _callback:
-            response = chain.run(kwargs)
+            try:
+                response = await chain.arun(kwargs)
+            except Exception as e:
+                self._record_call(chain, operation, start, _callback, error_no=type(e).__name__, cache=cache)
+                await RATE_LIMITER.asettle(estimated_tokens, _callback.total_tokens, is_success=False)
+                raise
             cost = _callback.total_cost
             tokens = _callback.total_tokens
+        self._record_call(chain, operation, start, _callback, cache=cache)
+        await RATE_LIMITER.asettle(estimated_tokens, tokens)
+        return self._parse_response(response, salvage_key), cost, tokens
+
+    def _estimate_call_tokens(self, chain: LLMChain, kwargs: dict) -> int:
+        """
+        Estimate the tokens the call counts against the tokens-per-minute limit: the prompt and max_tokens.
+        """
+        if not RATE_LIMITER.enabled:
+            return 0
+        prompt = chain.prompt.format_prompt(**kwargs).to_string()
+        return estimate_tokens(prompt) + (getattr(chain.llm, "max_tokens", None) or 0)
+
+    def _record_call(self, chain: LLMChain, operation: str, start: float, callback, error_no: str="", cache: str=""):
+        """
+        Record the metrics of a call, and add its usage to the totals of this instance.
+        """
+        with self._usage_lock:
+            self.total_cost += callback.total_cost
+            self.total_tokens += callback.total_tokens
+        METRICS.record(CallMetric(operation=operation,
+                                  model=getattr(chain.llm, "model_name", ""),
+                                  wall_time=time.perf_counter() - start,
+                                  prompt_tokens=callback.prompt_tokens,
+                                  completion_tokens=callback.completion_tokens,
+                                  cost=callback.total_cost,
+                                  error_no=error_no,
+                                  cache=cache))
+
+    def _record_error(self, operation: str, error_no: str):
+        METRICS.record_error(operation, error_no)
+
+    def _stream_llm_chain(self, chain: LLMChain, operation: str="llm", cache: str="", usage: dict=None, **kwargs):
+        """
+        Stream the response text of the chain piece by piece.
+        Token usage is not reported for streams, so it is estimated, and the cost is estimated from it.
+        If usage is given, the estimated "cost" and "tokens" are set in it when the stream ends.
+        """
+        messages = chain.prompt.format_prompt(**kwargs).to_messages()
+        prompt_tokens = sum(estimate_tokens(m.content) for m in messages)
+        estimated_tokens = prompt_tokens + (getattr(chain.llm, "max_tokens", None) or 0)
+        RATE_LIMITER.acquire(estimated_tokens, self.priority)
+        start = time.perf_counter()
+        response = ""
+        is_complete = False
+        try:
+            for chunk in chain.llm.stream(messages):
+                response += chunk.content
+                yield chunk.content
+            is_complete = True
+        finally:
+            if not is_complete:
+                # 失敗または中断したストリームの予約を返す
+                RATE_LIMITER.settle(estimated_tokens, prompt_tokens + estimate_tokens(response), is_success=False)
+        if self.debug:
+            print(response)
+        completion_tokens = estimate_tokens(response)
+        model = getattr(chain.llm, "model_name", "")
+        cost = estimate_cost(model, prompt_tokens, completion_tokens)
+        with self._usage_lock:
+            self.total_cost += cost
+            self.total_tokens += prompt_tokens + completion_tokens
+        METRICS.record(CallMetric(operation=operation,
+                                  model=model,
+                                  wall_time=time.perf_counter() - start,
+                                  prompt_tokens=prompt_tokens,
+                                  completion_tokens=completion_tokens,
+                                  cost=cost,
+                                  cache=cache))
+        if usage is not None:
+            usage.update(cost=cost, tokens=prompt_tokens + completion_tokens)
+        RATE_LIMITER.settle(estimated_tokens, prompt_tokens + completion_tokens)
+
+    def _parse_response(self, response: str, salvage_key: str="") -> dict:
         try:
             if self.debug:
                 print(response)
@@ -44,6 +232,9 @@ class LLM:
                 response = response[len(self.BEGIN_JSON_FORMAT): -len(self.END_JSON_FORMAT)]
             result = json.loads(response, strict=False)
         except json.decoder.JSONDecodeError:
-            return {}, cost, tokens
+            items = salvage_array(response, salvage_key) if salvage_key else []
+            if items:
+                return {salvage_key: items, PARTIAL_KEY: True}
+            return {}
 
-        return result, cost, tokens
+        return result
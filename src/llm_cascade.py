@@ -0,0 +1,134 @@
+import pandas as pd
+from llm import run_coroutine
+from llm_translator import Translator, Translation
+from llm_qa import QualityAssurance
+from prefilter import Prefilter
+
+FAST_MODEL = "gpt-3.5-turbo-0125"
+STRONG_MODEL = "gpt-4o-2024-05-13"
+
+
+class CascadeTranslation(Translation):
+    def __init__(self, translated_texts: list, is_success: bool=True, cost: float=0.0, tokens: int=0, error="", error_no=""):
+        super().__init__(translated_texts=translated_texts, is_success=is_success, cost=cost, tokens=tokens, error=error, error_no=error_no)
+        # 強いモデルで翻訳し直した文の index
+        self.escalated_indexes: list = []
+        self.qa_rows: pd.DataFrame = None
+        self.escalation_error: str = ""
+
+    def __repr__(self):
+        return f"<CascadeTranslation translated_text={self.translated_texts} escalated={len(self.escalated_indexes)} cost={self.cost} tokens={self.tokens} error={self.error}>"
+
+
+class CascadeTranslator(Translator):
+    """
+    Translate every sentence with the fast model, score each pair with a QA pass,
+    and re-translate with the strong model only the sentences scoring below min_accuracy or min_error.
+    A sentence whose QA failed or which misses a glossary term is re-translated as well.
+    """
+    def __init__(self, fast_model: str=FAST_MODEL, strong_model: str=STRONG_MODEL, qa_model: str="", min_accuracy: int=2, min_error: int=1, qa_concurrency: int=8, **kwargs):
+        super().__init__(**kwargs)
+        self.fast_model = fast_model
+        self.strong_model = strong_model
+        self.qa_model = qa_model or fast_model
+        self.min_accuracy = min_accuracy
+        self.min_error = min_error
+        self.qa_concurrency = qa_concurrency
+
+    def cascade_translate_by_sentence(self, source_language, target_language, text, temperature) -> Translation:
+        """
+        Translate sentence unit with the model cascade.
+        If the fast model fails for the whole text, or its sentences do not match the source sentences, the strong model translates all of it.
+        """
+        translation = self.translate_by_sentence(source_language, target_language, text, self.fast_model, temperature)
+        if not self._is_complete(translation):
+            return self._escalate_all(translation, self.translate_by_sentence(source_language, target_language, text, self.strong_model, temperature))
+
+        qa = self._make_qa(source_language, target_language)
+        qa_data, indexes = self._make_qa_data(translation)
+        qa_rows = run_coroutine(qa.acheck_translation(qa_data, concurrency=self.qa_concurrency)) if indexes else None
+        escalated_texts = self._make_escalated_texts(translation, qa_rows, indexes)
+        strong_translation = self._translate_chunks(source_language, target_language, translation.source_texts, escalated_texts, self.strong_model, temperature)
+        return self._make_cascade_translation(source_language, target_language, temperature, translation, qa, qa_rows, escalated_texts, strong_translation)
+
+    async def acascade_translate_by_sentence(self, source_language, target_language, text, temperature) -> Translation:
+        """
+        Async version of cascade_translate_by_sentence.
+        """
+        translation = await self.atranslate_by_sentence(source_language, target_language, text, self.fast_model, temperature)
+        if not self._is_complete(translation):
+            return self._escalate_all(translation, await self.atranslate_by_sentence(source_language, target_language, text, self.strong_model, temperature))
+
+        qa = self._make_qa(source_language, target_language)
+        qa_data, indexes = self._make_qa_data(translation)
+        qa_rows = await qa.acheck_translation(qa_data, concurrency=self.qa_concurrency) if indexes else None
+        escalated_texts = self._make_escalated_texts(translation, qa_rows, indexes)
+        strong_translation = await self._atranslate_chunks(source_language, target_language, translation.source_texts, escalated_texts, self.strong_model, temperature)
+        return self._make_cascade_translation(source_language, target_language, temperature, translation, qa, qa_rows, escalated_texts, strong_translation)
+
+    def _is_complete(self, translation: Translation) -> bool:
+        # e0200 は is_success のまま未翻訳の文だけが source_texts に残るので、文ごとの QA はできない
+        return translation.is_success and translation.error_no == ""
+
+    def _make_qa(self, source_language, target_language) -> QualityAssurance:
+        # Untranslated sentences and changed numbers are escalated without a QA call.
+        qa = QualityAssurance(source_language=source_language, target_language=target_language, model=self.qa_model, temperature=0.0, debug=self.debug,
+                              prefilter=Prefilter())
+        # The QA pass is part of the translation, so it keeps the priority of the translator.
+        qa.priority = self.priority
+        return qa
+
+    def _make_qa_data(self, translation: Translation) -> tuple:
+        """
+        Make the QA input of the translated pairs. QualityAssurance skips empty texts, so the indexes of the checked pairs are returned with it.
+        """
+        indexes = [i for i, (s, t) in enumerate(zip(translation.source_texts, translation.translated_texts)) if s and t]
+        qa_data = pd.DataFrame([[translation.source_texts[i], translation.translated_texts[i]] for i in indexes], columns=["source", "target"])
+        return qa_data, indexes
+
+    def _make_escalated_texts(self, translation: Translation, qa_rows: pd.DataFrame, indexes: list) -> list:
+        """
+        Return the translated texts with None for the sentences to re-translate with the strong model.
+        """
+        passed = set()
+        if qa_rows is not None:
+            for i, accuracy, error in zip(indexes, qa_rows["accuracy"], qa_rows["error"]):
+                if self._is_passed(accuracy, error):
+                    passed.add(i)
+        passed -= {i for i, _, _ in translation.glossary_violations}
+        return [t if i in passed else None for i, t in enumerate(translation.translated_texts)]
+
+    def _is_passed(self, accuracy, error) -> bool:
+        try:
+            return int(accuracy) >= self.min_accuracy and int(error) >= self.min_error
+        except (TypeError, ValueError):
+            return False
+
+    def _make_cascade_translation(self, source_language, target_language, temperature, translation: Translation, qa: QualityAssurance,
+                                  qa_rows: pd.DataFrame, escalated_texts: list, strong_translation: Translation) -> Translation:
+        cascade_translation = CascadeTranslation(translated_texts=list(translation.translated_texts), is_success=True,
+                                                 cost=translation.cost + qa.total_cost, tokens=translation.tokens + qa.total_tokens)
+        cascade_translation.set_source_texts(translation.source_texts)
+        cascade_translation.qa_rows = qa_rows
+        if strong_translation is None:
+            return self._check_glossary(source_language, target_language, cascade_translation)
+        cascade_translation.cost += strong_translation.cost
+        cascade_translation.tokens += strong_translation.tokens
+        merged = self._merge_translation(source_language, target_language, self.strong_model, temperature, translation.source_texts, escalated_texts, strong_translation)
+        if merged.is_success and merged.error_no == "":
+            cascade_translation.translated_texts = merged.translated_texts
+            cascade_translation.escalated_indexes = [i for i, t in enumerate(escalated_texts) if t is None]
+        else:
+            # 強いモデルが失敗した場合は速いモデルの翻訳を残す
+            cascade_translation.escalation_error = merged.error or strong_translation.error
+        return self._check_glossary(source_language, target_language, cascade_translation)
+
+    def _escalate_all(self, translation: Translation, strong_translation: Translation) -> Translation:
+        cascade_translation = CascadeTranslation(translated_texts=strong_translation.translated_texts, is_success=strong_translation.is_success,
+                                                 cost=translation.cost + strong_translation.cost, tokens=translation.tokens + strong_translation.tokens,
+                                                 error=strong_translation.error, error_no=strong_translation.error_no)
+        cascade_translation.set_source_texts(strong_translation.source_texts)
+        if self._is_complete(strong_translation):
+            cascade_translation.escalated_indexes = list(range(len(strong_translation.source_texts)))
+        cascade_translation.glossary_violations = strong_translation.glossary_violations
+        return cascade_translation
@@ -0,0 +1,192 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from llm import gather_with_concurrency
+from llm_translator import Translator, Translation, BASE_ERROR_MESSAGE, estimate_output_tokens, make_glossary_constraint
+from metrics import METRICS
+from translation_prompt import SYSTEM_TEMPLATE, HUMAN_TEMPLATE, CONTEXT_HUMAN_TEMPLATE, FAN_OUT_OUTPUT_FORMAT
+
+KEY_TRANSLATIONS = "translations"
+
+
+def join_languages(languages: list) -> str:
+    if len(languages) == 1:
+        return languages[0]
+    return ", ".join(languages[:-1]) + " and " + languages[-1]
+
+
+def make_fan_out_example(target_languages: list) -> str:
+    """
+    Make an example of the output format keyed by the target languages.
+    """
+    sources = ["Sentence 1.", "Sentence 2."]
+    translations = {language: [f"Translation of sentence 1 in {language}.", f"Translation of sentence 2 in {language}."] for language in target_languages}
+    return ("```input (array)\n"
+            f"{json.dumps(sources)}"
+            "```\n"
+            "``` output (json)\n"
+            f"{json.dumps({KEY_TRANSLATIONS: translations}, ensure_ascii=False, indent=2)}\n"
+            "```\n")
+
+
+class FanOutTranslator(Translator):
+    """
+    Translate a text into several target languages at once.
+
+    The text is split once, and each chunk of sentences is sent once with all the target languages missing a translation of it,
+    so that the source text is not repeated per language. The result of each language is verified and realigned independently,
+    and the sentences still missing in a language are translated by the single-target path of that language.
+    Translations are cached per language in the translation memory.
+    """
+    def fan_out_translate_by_sentence(self, source_language, target_languages: list, text, model, temperature) -> dict:
+        """
+        Translate sentence unit into each of the target languages. Return a Translation for each target language.
+        """
+        splited_sentences = self.split_sentences(source_language, text)
+        if not splited_sentences.is_success:
+            return {target_language: Translation(translated_texts=[], is_success=False, error=BASE_ERROR_MESSAGE) for target_language in target_languages}
+
+        source_texts = splited_sentences.texts
+        known_texts = {target_language: self._get_known_texts(source_language, target_language, model, temperature, source_texts) for target_language in target_languages}
+        chunks = self._make_fan_out_chunks(source_texts, known_texts, target_languages)
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as executor:
+            results = list(executor.map(lambda chunk: self._fan_out_chunk(source_language, chunk, model, temperature), chunks))
+        translations = {}
+        for target_language in target_languages:
+            filled_texts, cost, tokens = self._fill_fan_out_texts(target_language, known_texts[target_language], chunks, results)
+            rest = self._translate_chunks(source_language, target_language, source_texts, filled_texts, model, temperature)
+            translations[target_language] = self._merge_fan_out_translation(source_language, target_language, model, temperature, source_texts,
+                                                                            known_texts[target_language], filled_texts, rest, cost, tokens)
+        return translations
+
+    async def afan_out_translate_by_sentence(self, source_language, target_languages: list, text, model, temperature) -> dict:
+        """
+        Async version of fan_out_translate_by_sentence.
+        """
+        splited_sentences = await self.asplit_sentences(source_language, text)
+        if not splited_sentences.is_success:
+            return {target_language: Translation(translated_texts=[], is_success=False, error=BASE_ERROR_MESSAGE) for target_language in target_languages}
+
+        source_texts = splited_sentences.texts
+        known_texts = {target_language: self._get_known_texts(source_language, target_language, model, temperature, source_texts) for target_language in target_languages}
+        chunks = self._make_fan_out_chunks(source_texts, known_texts, target_languages)
+        results = await gather_with_concurrency(self.concurrency, [self._afan_out_chunk(source_language, chunk, model, temperature) for chunk in chunks])
+        translations = {}
+        for target_language in target_languages:
+            filled_texts, cost, tokens = self._fill_fan_out_texts(target_language, known_texts[target_language], chunks, results)
+            rest = await self._atranslate_chunks(source_language, target_language, source_texts, filled_texts, model, temperature)
+            translations[target_language] = self._merge_fan_out_translation(source_language, target_language, model, temperature, source_texts,
+                                                                            known_texts[target_language], filled_texts, rest, cost, tokens)
+        return translations
+
+    def _make_fan_out_chunks(self, source_texts: list, known_texts: dict, target_languages: list) -> list:
+        """
+        Make (indexes, texts, context, target languages) chunks of the sentences missing in any target language.
+        The token budget of a chunk is divided by the number of target languages, so that the output of all the languages fits in one response.
+        """
+        missing_mask = [None if any(known_texts[target_language][i] is None for target_language in target_languages) else "" for i in range(len(source_texts))]
+        missing_indexes = [i for i, t in enumerate(missing_mask) if t is None]
+        chunks = []
+        position = 0
+        for texts, context in self._make_chunks(source_texts, missing_mask, max(100, self.max_chunk_tokens // max(1, len(target_languages)))):
+            indexes = missing_indexes[position:position + len(texts)]
+            position += len(texts)
+            languages = [target_language for target_language in target_languages if any(known_texts[target_language][i] is None for i in indexes)]
+            chunks.append((indexes, texts, context, languages))
+        return chunks
+
+    def _fan_out_chunk(self, source_language, chunk: tuple, model, temperature) -> tuple:
+        """
+        Translate a chunk into its target languages in one request. Return ({target language: translated texts}, cost, tokens).
+        """
+        _, texts, context, languages = chunk
+        chain, inputs = self._make_fan_out_chain(source_language, languages, texts, context, model, temperature)
+        result, cost, tokens = self._run_llm_chain(chain=chain, operation="translate_fan_out", cache=self._get_cache_status("table"), **inputs)
+        return self._verify_fan_out_result(result, texts, languages), cost, tokens
+
+    async def _afan_out_chunk(self, source_language, chunk: tuple, model, temperature) -> tuple:
+        _, texts, context, languages = chunk
+        chain, inputs = self._make_fan_out_chain(source_language, languages, texts, context, model, temperature)
+        result, cost, tokens = await self._arun_llm_chain(chain=chain, operation="translate_fan_out", cache=self._get_cache_status("table"), **inputs)
+        return self._verify_fan_out_result(result, texts, languages), cost, tokens
+
+    def _make_fan_out_chain(self, source_language, target_languages: list, texts: list, context: str, model, temperature) -> tuple:
+        source_text = json.dumps(texts)
+        llm = self._get_llm(model=model, temperature=temperature, max_tokens=min(4000, estimate_output_tokens(source_text) * len(target_languages)))
+        inputs = {"source_language": source_language,
+                  "target_language": join_languages(target_languages),
+                  "text": source_text,
+                  "output_format": FAN_OUT_OUTPUT_FORMAT,
+                  "glossary": self._get_fan_out_glossary_constraint(source_language, target_languages, texts),
+                  "example": make_fan_out_example(target_languages)}
+        human_template = HUMAN_TEMPLATE
+        if context:
+            human_template = CONTEXT_HUMAN_TEMPLATE
+            inputs["context"] = context
+        chain = self._make_llm_chain(llm=llm, system_template=SYSTEM_TEMPLATE, human_template=human_template)
+        return chain, inputs
+
+    def _get_fan_out_glossary_constraint(self, source_language, target_languages: list, texts: list) -> str:
+        if self.glossary is None:
+            return ""
+        entries = [(source, f"{target} ({target_language})") for target_language in target_languages
+                   for source, target in self.glossary.find_many(source_language, target_language, texts)]
+        return make_glossary_constraint(entries)
+
+    def _verify_fan_out_result(self, result: dict, texts: list, target_languages: list) -> dict:
+        """
+        Verify the translated texts of each target language independently.
+        A language with a count mismatch is realigned, and a language with a wrong format is left out.
+        """
+        translations = result.get(KEY_TRANSLATIONS) if isinstance(result, dict) else None
+        if not isinstance(translations, dict):
+            self._record_error("translate_fan_out", "e0300")
+            return {}
+        verified = {}
+        for target_language in target_languages:
+            translated_texts = translations.get(target_language)
+            if not isinstance(translated_texts, list) or not all(isinstance(t, str) for t in translated_texts):
+                self._record_error("translate_fan_out", "e0301")
+                continue
+            if len(translated_texts) != len(texts):
+                translated_texts = self.aligner.repair(texts, translated_texts, target_language)
+                METRICS.record_alignment("translate_fan_out", sum(1 for t in translated_texts if t is not None), sum(1 for t in translated_texts if t is None))
+            verified[target_language] = translated_texts
+        return verified
+
+    def _fill_fan_out_texts(self, target_language, known_texts: list, chunks: list, results: list) -> tuple:
+        """
+        Fill the known texts of the target language with its fan-out translations.
+        The cost of a request is shared equally by its target languages.
+        """
+        filled_texts = list(known_texts)
+        cost = 0.0
+        tokens = 0
+        for (indexes, _, _, languages), (translations, chunk_cost, chunk_tokens) in zip(chunks, results):
+            if target_language not in languages:
+                continue
+            cost += chunk_cost / len(languages)
+            tokens += chunk_tokens // len(languages)
+            for i, translated_text in zip(indexes, translations.get(target_language, [])):
+                if filled_texts[i] is None:
+                    filled_texts[i] = translated_text
+        return filled_texts, cost, tokens
+
+    def _merge_fan_out_translation(self, source_language, target_language, model, temperature, source_texts: list, known_texts: list,
+                                   filled_texts: list, rest: Translation, cost: float, tokens: int) -> Translation:
+        """
+        Merge the known texts, the fan-out translations and the single-target translation of the rest, and cache the new translations.
+        """
+        missing_indexes = [i for i, t in enumerate(known_texts) if t is None]
+        if not missing_indexes:
+            return self._merge_translation(source_language, target_language, model, temperature, source_texts, known_texts, None)
+        rest_texts = [source_texts[i] for i, t in enumerate(filled_texts) if t is None]
+        if rest is not None and not self._verify_chunk(rest, rest_texts):
+            translation = rest
+        else:
+            rest_iter = iter(rest.translated_texts if rest is not None else [])
+            translation = Translation(translated_texts=[filled_texts[i] if filled_texts[i] is not None else next(rest_iter) for i in missing_indexes],
+                                      is_success=True, cost=rest.cost if rest is not None else 0.0, tokens=rest.tokens if rest is not None else 0)
+        translation.cost += cost
+        translation.tokens += tokens
+        return self._merge_translation(source_language, target_language, model, temperature, source_texts, known_texts, translation)
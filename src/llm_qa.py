@@ -1,13 +1,57 @@
+import asyncio
+import csv
+import io
+import time
+
 import pandas as pd
-from llm import LLM
+from llm import LLM, gather_with_concurrency, estimate_tokens
+from llm_registry import REGISTRY
+from rate_limiter import PRIORITY_BATCH
+from prefilter import Prefilter, PrefilterReport, LOCAL_REVIEW_PREFIX, LOCAL_REVIEWS, EMPTY, NUMBER, LENGTH, to_text
+import qa_promp
+
+SYSTEM_TEMPLATE = ("次の tsv のデータには、対訳結果が含まれているので、評価してください。\n"
+                   "原文は{source_language}で、訳文は{target_language}です。\n"
+                   "評価軸は、以下の点で評価してください。\n"
+                   "### 評価軸の定義\n"
+                   "accuracy: 0: 翻訳が不正確である, 1: 意味は伝わるが正確ではない, 2: 翻訳が正確である\n"
+                   "grammar: 0: 文法的に誤りが多い, 1: 一部に文法的な誤りがあるが、理解は可能, 2: 文法的に正しい\n"
+                   "fluency: 0: 不自然で読みづらい, 1: 一部に不自然な表現があるが、理解は可能, 2: 自然で読みやすいn"
+                   "cultural: 0: 文化的に不適切, 1: 一部に文化的な違和感があるが、全体としては理解可能, 2: 文化的に適切\n"
+                   "style: 0: スタイルやトーンが不適切, 1: 一部にスタイルやトーンの不一致があるが、全体としては理解可能, 2:  スタイルやトーンが適切\n"
+                   "error: 0: 明らかな誤訳や脱字が多い, 1: 一部に誤訳や脱字があるが、全体としては理解可能, 2: 誤訳や脱字がない\n"
+                   "### 出力形式\n"
+                   "json で、次のフォーマットに従ってください。\n"
+                   "```json\n"
+                   "{{\"accuracy\": 0 or 1 or 2, \"grammar\": 0 or 1 or 2, \"fluency\": 0 or 1 or 2, \"cultural\": 0 or 1 or 2, \"style\": 0 or 1 or 2, \"error\": -1 or 0 or 1, \"review\": \"具体的なレビュー内容\"}}\n"
+                   "```\n"
+                   "review: レビューした内容は日本語で記載してください。")
+HUMAN_TEMPLATE = ("```tsv\n"
+                  "原文\t対訳\n"
+                  "{source}\t{target}\n")
+COLUMNS = ["source", "target", "accuracy", "grammar", "fluency", "cultural", "style", "error", "review"]
+FAILED_REVIEW = "Failed to quality assurance."
+BATCH_COLUMNS = ["source", "target", "accuracy", "omission", "issuePoint"]
+
+REGISTRY.precompile(SYSTEM_TEMPLATE, HUMAN_TEMPLATE)
+REGISTRY.precompile(qa_promp.SYSTEM_TEMPLATE, qa_promp.HUMAN_TEMPLATE)
+
 
 class QualityAssurance(LLM):
-    def __init__(self, source_language: str, target_language: str, model: str, temperature: float, debug: bool=False):
+    """
+    If a prefilter is given, the rows failing its local checks are decided without the LLM,
+    including the rows with an empty target, and only the other rows are sent to the LLM.
+    """
+    priority = PRIORITY_BATCH
+
+    def __init__(self, source_language: str, target_language: str, model: str, temperature: float, debug: bool=False, prefilter: Prefilter=None):
         super().__init__(debug=debug)
         self.source_language = source_language
         self.target_language = target_language
         self.model = model
         self.temperature = temperature
+        self.prefilter = prefilter
+        self.prefilter_report = PrefilterReport()
 
     def check_translation(self, translation_data: pd.DataFrame):
         """
@@ -17,49 +61,220 @@ class QualityAssurance(LLM):
             return False, "Source language and target language must be different."
         if translation_data.empty:
             return False, "Please input text."
-        # 空の pandas.DataFrame を生成
-        df = pd.DataFrame(columns=["source", "target", "accuracy", "grammar", "fluency", "cultural", "style", "error", "review"])
-        for index, row in translation_data.iterrows():
-            source = row["source"]
-            target = row["target"]
-            # 先頭のカラムを除外したカラム名のリストを取得
-            if source and target:
+        # 行を list に溜めてから pandas.DataFrame を生成
+        rows = []
+        for (source, target), reason in zip(*self._prefilter_pairs(translation_data, "qa")):
+            if reason:
+                rows.append(self._make_local_row(source, target, reason))
+            else:
                 is_success, result = self._call(source=source, target=target)
-                if is_success:
-                    df.loc[len(df)] = [source, target, result["accuracy"], result["grammar"], result["fluency"], result["cultural"], result["style"], result["error"], result["review"]]
-                else:
-                    df.loc[len(df)] = [source, target, None, None, "Failed to quality assurance."]
-        return df
+                rows.append(self._make_row(source, target, is_success, result))
+        return pd.DataFrame(rows, columns=COLUMNS)
 
-    def _call(self, source: str, target: str):
-        llm = self._get_llm(model=self.model, temperature=self.temperature)
+    async def acheck_translation(self, translation_data: pd.DataFrame, concurrency: int=8):
+        """
+        Check the quality of the translation with up to `concurrency` requests in flight.
+        The rows keep the input order, and a failed row does not stop the others.
+        """
+        if self.source_language == self.target_language:
+            return False, "Source language and target language must be different."
+        if translation_data.empty:
+            return False, "Please input text."
+        pairs, reasons = self._prefilter_pairs(translation_data, "qa")
+        llm_rows = iter(await gather_with_concurrency(concurrency, [self._acheck_row(source, target) for (source, target), reason in zip(pairs, reasons) if not reason]))
+        rows = [self._make_local_row(source, target, reason) if reason else next(llm_rows) for (source, target), reason in zip(pairs, reasons)]
+        return pd.DataFrame(rows, columns=COLUMNS)
 
-        system_template = ("次の tsv のデータには、対訳結果が含まれているので、評価してください。\n"
-                           "原文は{source_language}で、訳文は{target_language}です。\n"
-                           "評価軸は、以下の点で評価してください。\n"
-                           "### 評価軸の定義\n"
-                           "accuracy: 0: 翻訳が不正確である, 1: 意味は伝わるが正確ではない, 2: 翻訳が正確である\n"
-                           "grammar: 0: 文法的に誤りが多い, 1: 一部に文法的な誤りがあるが、理解は可能, 2: 文法的に正しい\n"
-                           "fluency: 0: 不自然で読みづらい, 1: 一部に不自然な表現があるが、理解は可能, 2: 自然で読みやすいn"
-                           "cultural: 0: 文化的に不適切, 1: 一部に文化的な違和感があるが、全体としては理解可能, 2: 文化的に適切\n"
-                           "style: 0: スタイルやトーンが不適切, 1: 一部にスタイルやトーンの不一致があるが、全体としては理解可能, 2:  スタイルやトーンが適切\n"
-                           "error: 0: 明らかな誤訳や脱字が多い, 1: 一部に誤訳や脱字があるが、全体としては理解可能, 2: 誤訳や脱字がない\n"
-                           "### 出力形式\n"
-                           "json で、次のフォーマットに従ってください。\n"
-                           "```json\n"
-                           "{{\"accuracy\": 0 or 1 or 2, \"grammar\": 0 or 1 or 2, \"fluency\": 0 or 1 or 2, \"cultural\": 0 or 1 or 2, \"style\": 0 or 1 or 2, \"error\": -1 or 0 or 1, \"review\": \"具体的なレビュー内容\"}}\n"
-                           "```\n"
-                           "review: レビューした内容は日本語で記載してください。")
-        human_template = ("```tsv\n"
-                          "原文\t対訳\n"
-                          "{source}\t{target}\n")
-        chain = self._make_llm_chain(llm=llm, system_template=system_template, human_template=human_template)
+    def _prefilter_pairs(self, translation_data: pd.DataFrame, operation: str) -> tuple:
+        """
+        Return the (source, target) pairs to check and the reason of the local verdict of each pair, where "" needs the LLM.
+        Without the prefilter, the pairs with an empty text are skipped as before.
+        """
+        if self.prefilter is None:
+            pairs = [(source, target) for source, target in zip(translation_data["source"], translation_data["target"]) if source and target]
+            return pairs, [""] * len(pairs)
+        pairs = [(source, target) for source, target in zip(translation_data["source"].map(to_text), translation_data["target"].map(to_text)) if source]
+        reasons = self.prefilter.check_translations([source for source, _ in pairs], [target for _, target in pairs])
+        self.prefilter_report.add(f"{operation}_prefilter", reasons)
+        return pairs, reasons
+
+    def _make_local_row(self, source: str, target: str, reason: str) -> list:
+        # 数値の不一致は一部の誤訳、それ以外は訳抜けや未翻訳として扱う
+        score = 1 if reason == NUMBER else 0
+        return [source, target, score, None, None, None, None, score, LOCAL_REVIEW_PREFIX + LOCAL_REVIEWS[reason]]
+
+    async def _acheck_row(self, source: str, target: str) -> list:
+        try:
+            is_success, result = await self._acall(source=source, target=target)
+        except Exception as e:
+            is_success, result = False, str(e)
+        return self._make_row(source, target, is_success, result)
+
+    def _make_row(self, source: str, target: str, is_success: bool, result) -> list:
+        if is_success:
+            return [source, target] + [result.get(column) for column in COLUMNS[2:]]
+        return [source, target, None, None, None, None, None, None, FAILED_REVIEW]
+
+    def _call(self, source: str, target: str):
+        chain = self._make_chain()
         result, cost, tokens = self._run_llm_chain(chain=chain,
+                                                   operation="qa",
                                                    source_language=self.source_language,
                                                    target_language=self.target_language,
                                                    source=source,
                                                    target=target)
+        return self._verify_result(result)
+
+    async def _acall(self, source: str, target: str):
+        chain = self._make_chain()
+        result, cost, tokens = await self._arun_llm_chain(chain=chain,
+                                                          operation="qa",
+                                                          source_language=self.source_language,
+                                                          target_language=self.target_language,
+                                                          source=source,
+                                                          target=target)
+        return self._verify_result(result)
+
+    def _make_chain(self):
+        llm = self._get_llm(model=self.model, temperature=self.temperature)
+        return self._make_llm_chain(llm=llm, system_template=SYSTEM_TEMPLATE, human_template=HUMAN_TEMPLATE)
+
+    def _verify_result(self, result: dict):
         if "accuracy" not in result or "grammar" not in result or "review" not in result:
+            self._record_error("qa", "invalid_format")
             return False, "Output format is not correct."
         return True, result
 
+    def check_translation_batch(self, translation_data: pd.DataFrame, max_tokens_per_request: int=2000, max_rows_per_request: int=30, max_retries: int=2, retry_backoff: float=1.0):
+        """
+        Check the quality of the translation with many rows per request, using the CSV prompt in qa_promp.
+        The results are matched back to the rows by id, and only the rows whose id is missing or malformed are re-requested.
+        The complete results of a truncated response are kept, and the re-requests back off exponentially.
+        """
+        if self.source_language == self.target_language:
+            return False, "Source language and target language must be different."
+        if translation_data.empty:
+            return False, "Please input text."
+        rows, results = self._make_batch_rows(translation_data)
+        pending = [row for row in rows if row[0] not in results]
+        for attempt in range(max_retries + 1):
+            if attempt > 0:
+                time.sleep(retry_backoff * 2 ** (attempt - 1))
+            for batch in self._pack_batches(pending, max_tokens_per_request, max_rows_per_request):
+                results.update(self._call_batch(batch))
+            pending = [row for row in rows if row[0] not in results]
+            if not pending:
+                break
+        return self._make_batch_dataframe(rows, results)
+
+    async def acheck_translation_batch(self, translation_data: pd.DataFrame, max_tokens_per_request: int=2000, max_rows_per_request: int=30, max_retries: int=2, retry_backoff: float=1.0, concurrency: int=8):
+        """
+        Async version of check_translation_batch. Up to `concurrency` batches are in flight.
+        """
+        if self.source_language == self.target_language:
+            return False, "Source language and target language must be different."
+        if translation_data.empty:
+            return False, "Please input text."
+        rows, results = self._make_batch_rows(translation_data)
+        pending = [row for row in rows if row[0] not in results]
+        for attempt in range(max_retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(retry_backoff * 2 ** (attempt - 1))
+            batches = self._pack_batches(pending, max_tokens_per_request, max_rows_per_request)
+            for batch_results in await gather_with_concurrency(concurrency, [self._acall_batch(batch) for batch in batches]):
+                results.update(batch_results)
+            pending = [row for row in rows if row[0] not in results]
+            if not pending:
+                break
+        return self._make_batch_dataframe(rows, results)
+
+    def _make_batch_rows(self, translation_data: pd.DataFrame) -> tuple:
+        """
+        Make (id, source, target) rows, and the results of the rows decided by the prefilter by id. The id is 1-based and unique in the request.
+        """
+        pairs, reasons = self._prefilter_pairs(translation_data, "qa_batch")
+        rows = [(i + 1, source, target) for i, (source, target) in enumerate(pairs)]
+        results = {row[0]: {"accuracy": False, "omission": reason in (EMPTY, LENGTH), "issuePoint": LOCAL_REVIEW_PREFIX + LOCAL_REVIEWS[reason]}
+                   for row, reason in zip(rows, reasons) if reason}
+        return rows, results
+
+    def _pack_batches(self, rows: list, max_tokens_per_request: int, max_rows_per_request: int) -> list:
+        """
+        Pack consecutive rows into batches so that the CSV block of each batch fits in the token budget.
+        """
+        batches = []
+        batch = []
+        batch_tokens = 0
+        for row in rows:
+            row_tokens = estimate_tokens(self._format_csv([row]))
+            if batch and (batch_tokens + row_tokens > max_tokens_per_request or len(batch) >= max_rows_per_request):
+                batches.append(batch)
+                batch = []
+                batch_tokens = 0
+            batch.append(row)
+            batch_tokens += row_tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _format_csv(self, rows: list) -> str:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, quoting=csv.QUOTE_ALL, lineterminator="\n")
+        writer.writerows([[str(row_id), source, target] for row_id, source, target in rows])
+        return buffer.getvalue().rstrip("\n")
+
+    def _call_batch(self, rows: list) -> dict:
+        chain = self._make_batch_chain()
+        try:
+            result, cost, tokens = self._run_llm_chain(chain=chain, operation="qa_batch", salvage_key="qa", **self._make_batch_inputs(rows))
+        except Exception:
+            return {}
+        return self._match_batch_result(rows, result)
+
+    async def _acall_batch(self, rows: list) -> dict:
+        chain = self._make_batch_chain()
+        try:
+            result, cost, tokens = await self._arun_llm_chain(chain=chain, operation="qa_batch", salvage_key="qa", **self._make_batch_inputs(rows))
+        except Exception:
+            return {}
+        return self._match_batch_result(rows, result)
+
+    def _make_batch_chain(self):
+        llm = self._get_llm(model=self.model, temperature=self.temperature, max_tokens=4000)
+        return self._make_llm_chain(llm=llm, system_template=qa_promp.SYSTEM_TEMPLATE, human_template=qa_promp.HUMAN_TEMPLATE)
+
+    def _make_batch_inputs(self, rows: list) -> dict:
+        return {"source_language": self.source_language,
+                "target_language": self.target_language,
+                "exsample": qa_promp.EXSAMPLE,
+                "csv": self._format_csv(rows)}
+
+    def _match_batch_result(self, rows: list, result: dict) -> dict:
+        """
+        Match the QA results to the rows by id. Results with a missing, malformed or unknown id are dropped.
+        """
+        row_ids = {row[0] for row in rows}
+        matched = {}
+        items = result.get("qa") if isinstance(result, dict) else None
+        if not isinstance(items, list):
+            return matched
+        for item in items:
+            if not isinstance(item, dict) or "accuracy" not in item:
+                continue
+            try:
+                row_id = int(item.get("id"))
+            except (TypeError, ValueError):
+                continue
+            if row_id in row_ids:
+                matched[row_id] = item
+        return matched
+
+    def _make_batch_dataframe(self, rows: list, results: dict) -> pd.DataFrame:
+        records = []
+        for row_id, source, target in rows:
+            if row_id in results:
+                item = results[row_id]
+                records.append([source, target, item.get("accuracy"), item.get("omission"), item.get("issuePoint")])
+            else:
+                records.append([source, target, None, None, FAILED_REVIEW])
+        return pd.DataFrame(records, columns=BATCH_COLUMNS)
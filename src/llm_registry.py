@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+import weakref
+from typing import TYPE_CHECKING
+
+from rate_limiter import RATE_LIMITER
+
+if TYPE_CHECKING:
+    import openai
+    from langchain.chat_models import ChatOpenAI
+    from langchain.prompts.chat import ChatPromptTemplate
+
+
+class LLMRegistry:
+    """
+    Process-wide registry of chat models and prompt templates.
+
+    Chat models are reused by (model, temperature, max_tokens) and share one OpenAI client,
+    so that requests go over the same keep-alive connections.
+    The async client is bound to an event loop, so chat models used in an event loop get a client per loop.
+    Every 429 response, including those retried inside the OpenAI client, is reported to the rate limiter.
+    openai and LangChain are imported on first use. Fixed prompt templates are registered on import and compiled on their first use,
+    or all at once by warm_up.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client = None
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._llms = {}
+        self._loop_llms = weakref.WeakKeyDictionary()
+        self._prompts = {}
+        self._fixed_prompts = set()
+        self.llm_hits = 0
+        self.llm_misses = 0
+        self.prompt_hits = 0
+        self.prompt_misses = 0
+
+    def get_llm(self, model: str, temperature: float, max_tokens: int) -> ChatOpenAI:
+        key = (model, temperature, max_tokens)
+        loop = self._get_running_loop()
+        with self._lock:
+            llms = self._llms if loop is None else self._loop_llms.setdefault(loop, {})
+            if key in llms:
+                self.llm_hits += 1
+                return llms[key]
+            self.llm_misses += 1
+            from langchain.chat_models import ChatOpenAI
+            params = {"model": model, "temperature": temperature, "max_tokens": max_tokens, "client": self._get_client().chat.completions}
+            if loop is not None:
+                params["async_client"] = self._get_async_client(loop).chat.completions
+            llms[key] = ChatOpenAI(**params)
+            return llms[key]
+
+    def get_prompt(self, system_template: str, human_template: str) -> ChatPromptTemplate:
+        key = (system_template, human_template)
+        with self._lock:
+            if key in self._prompts:
+                self.prompt_hits += 1
+                return self._prompts[key]
+            self.prompt_misses += 1
+            return self._compile_prompt(key)
+
+    def precompile(self, system_template: str, human_template: str):
+        """
+        Register a fixed prompt template, to be compiled once by warm_up or by its first get_prompt.
+        Nothing is compiled here, so that importing a module does not load LangChain.
+        """
+        with self._lock:
+            self._fixed_prompts.add((system_template, human_template))
+
+    def warm_up(self):
+        """
+        Compile the registered fixed prompt templates, so that every get_prompt of them is a hit.
+        Long-running processes call this at startup.
+        """
+        with self._lock:
+            for key in self._fixed_prompts:
+                if key not in self._prompts:
+                    self._compile_prompt(key)
+
+    async def aclose(self):
+        """
+        Close the async client of the running event loop, and drop the chat models bound to it.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.pop(loop, None)
+            self._loop_llms.pop(loop, None)
+        if client is not None:
+            await client.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"llm_hits": self.llm_hits,
+                    "llm_misses": self.llm_misses,
+                    "llms": len(self._llms) + sum(len(llms) for llms in self._loop_llms.values()),
+                    "prompt_hits": self.prompt_hits,
+                    "prompt_misses": self.prompt_misses,
+                    "prompts": len(self._prompts)}
+
+    def _compile_prompt(self, key: tuple) -> ChatPromptTemplate:
+        from langchain.prompts.chat import (
+            ChatPromptTemplate,
+            SystemMessagePromptTemplate,
+            HumanMessagePromptTemplate,
+        )
+        system_template, human_template = key
+        system_message_prompt = SystemMessagePromptTemplate.from_template(system_template)
+        human_message_prompt = HumanMessagePromptTemplate.from_template(human_template)
+        self._prompts[key] = ChatPromptTemplate.from_messages([system_message_prompt, human_message_prompt])
+        return self._prompts[key]
+
+    def _get_running_loop(self):
+        try:
+            return asyncio.get_running_loop()
+        except RuntimeError:
+            return None
+
+    def _get_client(self) -> openai.OpenAI:
+        if self._client is None:
+            import openai
+            http_client = openai.DefaultHttpxClient(event_hooks={"response": [self._on_response]})
+            self._client = openai.OpenAI(base_url=os.environ.get("OPENAI_API_BASE"), http_client=http_client)
+        return self._client
+
+    def _get_async_client(self, loop) -> openai.AsyncOpenAI:
+        if loop not in self._async_clients:
+            import openai
+            http_client = openai.DefaultAsyncHttpxClient(event_hooks={"response": [self._aon_response]})
+            self._async_clients[loop] = openai.AsyncOpenAI(base_url=os.environ.get("OPENAI_API_BASE"), http_client=http_client)
+        return self._async_clients[loop]
+
+    def _on_response(self, response):
+        if response.status_code == 429:
+            RATE_LIMITER.report_rate_limited(self._get_retry_after(response))
+
+    async def _aon_response(self, response):
+        if response.status_code == 429:
+            await RATE_LIMITER.areport_rate_limited(self._get_retry_after(response))
+
+    def _get_retry_after(self, response) -> float:
+        try:
+            return float(response.headers.get("retry-after", 0))
+        except ValueError:
+            return 0.0
+
+
+REGISTRY = LLMRegistry()
@@ -1,13 +1,53 @@
+import itertools
+
 import pandas as pd
-from llm import LLM
+from llm import LLM, gather_with_concurrency
+from llm_registry import REGISTRY
+from rate_limiter import PRIORITY_BATCH
+from prefilter import Prefilter, PrefilterReport, LOCAL_REVIEW_PREFIX, LOCAL_REVIEWS, SAME, SIMILAR, to_text
+
+SYSTEM_TEMPLATE = ("あなたはどちらの翻訳エンジンの訳質が高いか評価してください。\n"
+                   "次の tsv のデータには、原文と翻訳エンジン1の訳文と翻訳エンジン2の訳文が含まれています。\n"
+                   "原文は{source_language}で、訳文は{target_language}です。\n"
+                   "評価軸は、翻訳の正確性(accuracy)、文法の構造 (grammar) 、総合評価 (total) の3点で評価してください。\n"
+                   "出力形式は json で、次のフォーマットに従ってください。\n"
+                   "```json\n"
+                   "{{\"accuracy\": 0 or 1 or 2, \"grammar\": 0 or 1 or 2, \"total\": 0 or 1 or 2, \"review\": \"具体的なレビュー内容\"}}\n"
+                   "```\n"
+                   "accuracy: 0=同じ, 1=1の方が良い, 2=2の方が良い\n"
+                   "grammar: 0=同じ, 1=1の方が良い, 2=2の方が良い\n"
+                   "total: 0=同じ, 1=1の方が良い, 2=2の方が良い\n"
+                   "review: レビューした内容は日本語で記載してください。\n")
+HUMAN_TEMPLATE = ("```tsv\n"
+                  "原文\t翻訳エンジン1による訳文\t翻訳エンジン2による訳文\n"
+                  "{source}\t{target1}\t{target2}\n")
+COLUMNS = ["source", "target1", "target2", "accuracy", "grammar", "total", "review"]
+FAILED_REVIEW = "Failed to quality assurance."
+NWAY_COLUMNS = ["source", "engine1", "engine2", "target1", "target2", "accuracy", "grammar", "total", "review"]
+WIN_RATE_COLUMNS = ["engine", "wins", "losses", "ties", "comparisons", "win_rate"]
+SAME_REVIEW = "訳文が同一のため評価を省略しました。"
+SWAPPED_REVIEW_PREFIX = "(訳文1と訳文2を入れ替えて評価) "
+
+REGISTRY.precompile(SYSTEM_TEMPLATE, HUMAN_TEMPLATE)
+
 
 class TranslationCompare(LLM):
-    def __init__(self, source_language: str, target_language: str, model: str, temperature: float, debug: bool=False):
+    """
+    If a prefilter is given, the pairs it decides locally do not call the LLM: a translation failing its local checks
+    loses to the other, including an empty translation, and two nearly identical translations tie.
+    """
+    priority = PRIORITY_BATCH
+
+    def __init__(self, source_language: str, target_language: str, model: str, temperature: float, debug: bool=False, prefilter: Prefilter=None):
         super().__init__(debug=debug)
         self.source_language = source_language
         self.target_language = target_language
         self.model = model
         self.temperature = temperature
+        self.prefilter = prefilter
+        self.prefilter_report = PrefilterReport()
+        # (source, target1, target2) の評価結果。target1 <= target2 の向きで保存し、逆向きの組み合わせでも再利用する
+        self._pair_cache = {}
 
     def check_translation(self, translation_data: pd.DataFrame):
         """
@@ -17,46 +57,229 @@ class TranslationCompare(LLM):
             return False, "Source language and target language must be different."
         if translation_data.empty:
             return False, "Please input text."
-        # 空の pandas.DataFrame を生成
-        df = pd.DataFrame(columns=["source", "target1", "target2", "accuracy", "grammar", "total", "review"])
-        for index, row in translation_data.iterrows():
-            source = row["source"]
-            target1 = row["target1"]
-            target2 = row["target2"]
-            # 先頭のカラムを除外したカラム名のリストを取得
-            if source and target1 and target2:
+        # 行を list に溜めてから pandas.DataFrame を生成
+        rows = []
+        triples, verdicts = self._prefilter_triples(translation_data)
+        for (source, target1, target2), (label, reason) in zip(triples, verdicts):
+            if reason:
+                rows.append(self._make_local_row(source, target1, target2, label, reason))
+            else:
                 is_success, result = self._call(source=source, target1=target1, target2=target2)
-                if is_success:
-                    df.loc[len(df)] = [source, target1, target2, result["accuracy"], result["grammar"], result["total"], result["review"]]
-                else:
-                    df.loc[len(df)] = [source, target1, target2, -1, -1, "Failed to quality assurance."]
-        return df
+                rows.append(self._make_row(source, target1, target2, is_success, result))
+        return pd.DataFrame(rows, columns=COLUMNS)
 
-    def _call(self, source: str, target1: str, target2: str):
-        llm = self._get_llm(model=self.model, temperature=self.temperature)
+    async def acheck_translation(self, translation_data: pd.DataFrame, concurrency: int=8):
+        """
+        Check the quality of the translation with up to `concurrency` requests in flight.
+        The rows keep the input order, and a failed row does not stop the others.
+        """
+        if self.source_language == self.target_language:
+            return False, "Source language and target language must be different."
+        if translation_data.empty:
+            return False, "Please input text."
+        triples, verdicts = self._prefilter_triples(translation_data)
+        llm_rows = iter(await gather_with_concurrency(concurrency, [self._acheck_row(*triple) for triple, (_, reason) in zip(triples, verdicts) if not reason]))
+        rows = [self._make_local_row(*triple, label, reason) if reason else next(llm_rows) for triple, (label, reason) in zip(triples, verdicts)]
+        return pd.DataFrame(rows, columns=COLUMNS)
+
+    def _prefilter_triples(self, translation_data: pd.DataFrame) -> tuple:
+        """
+        Return the (source, target1, target2) triples to compare and the (label, reason) local verdict of each triple, where the reason "" needs the LLM.
+        Without the prefilter, the triples with an empty text are skipped as before.
+        """
+        columns = [translation_data["source"], translation_data["target1"], translation_data["target2"]]
+        if self.prefilter is None:
+            triples = [(source, target1, target2) for source, target1, target2 in zip(*columns) if source and target1 and target2]
+            return triples, [(None, "")] * len(triples)
+        triples = [(source, target1, target2) for source, target1, target2 in zip(*[column.map(to_text) for column in columns])
+                   if source and (target1 or target2)]
+        return triples, self._prefilter_verdicts(triples, "compare_prefilter")
+
+    def _prefilter_verdicts(self, triples: list, operation: str) -> list:
+        verdicts = self.prefilter.compare_translations(*[[triple[i] for triple in triples] for i in range(3)])
+        self.prefilter_report.add(operation, [reason for _, reason in verdicts])
+        return verdicts
+
+    def _make_local_row(self, source: str, target1: str, target2: str, label: int, reason: str) -> list:
+        if reason in (SAME, SIMILAR):
+            return [source, target1, target2, 0, 0, 0, LOCAL_REVIEW_PREFIX + LOCAL_REVIEWS[reason]]
+        # 負けた側の訳文がローカルの検査に落ちている
+        return [source, target1, target2, label, None, label, f"{LOCAL_REVIEW_PREFIX}訳文{3 - label}: {LOCAL_REVIEWS[reason]}"]
+
+    def check_translation_nway(self, translation_data: pd.DataFrame, engines: list):
+        """
+        Compare the translations of N engines by round-robin over every pair of engines.
+        translation_data has the "source" column and a column per engine.
+        Pairs evaluated before, in either order, and pairs of identical translations do not call the LLM.
+        """
+        if self.source_language == self.target_language:
+            return False, "Source language and target language must be different."
+        if translation_data.empty or len(engines) < 2:
+            return False, "Please input text."
+        pairs = self._make_nway_pairs(translation_data, engines)
+        verdicts = self._prefilter_nway_pairs(pairs)
+        results = {}
+        for key in self._get_uncached_keys(pairs, verdicts):
+            results[key] = self._call(*key)
+        self._cache_pair_results(results)
+        return self._make_nway_dataframe(pairs, verdicts, results)
 
-        system_template = ("あなたはどちらの翻訳エンジンの訳質が高いか評価してください。\n"
-                           "次の tsv のデータには、原文と翻訳エンジン1の訳文と翻訳エンジン2の訳文が含まれています。\n"
-                           "原文は{source_language}で、訳文は{target_language}です。\n"
-                           "評価軸は、翻訳の正確性(accuracy)、文法の構造 (grammar) 、総合評価 (total) の3点で評価してください。\n"
-                           "出力形式は json で、次のフォーマットに従ってください。\n"
-                           "```json\n"
-                           "{{\"accuracy\": 0 or 1 or 2, \"grammar\": 0 or 1 or 2, \"total\": 0 or 1 or 2, \"review\": \"具体的なレビュー内容\"}}\n"
-                           "```\n"
-                           "accuracy: 0=同じ, 1=1の方が良い, 2=2の方が良い\n"
-                           "grammar: 0=同じ, 1=1の方が良い, 2=2の方が良い\n"
-                           "total: 0=同じ, 1=1の方が良い, 2=2の方が良い\n"
-                           "review: レビューした内容は日本語で記載してください。\n")
-        human_template = ("```tsv\n"
-                          "原文\t翻訳エンジン1による訳文\t翻訳エンジン2による訳文\n"
-                          "{source}\t{target1}\t{target2}\n")
-        chain = self._make_llm_chain(llm=llm, system_template=system_template, human_template=human_template)
+    async def acheck_translation_nway(self, translation_data: pd.DataFrame, engines: list, concurrency: int=8):
+        """
+        Async version of check_translation_nway. The pair evaluations of all the rows are scheduled concurrently.
+        """
+        if self.source_language == self.target_language:
+            return False, "Source language and target language must be different."
+        if translation_data.empty or len(engines) < 2:
+            return False, "Please input text."
+        pairs = self._make_nway_pairs(translation_data, engines)
+        verdicts = self._prefilter_nway_pairs(pairs)
+        keys = self._get_uncached_keys(pairs, verdicts)
+        results = dict(zip(keys, await gather_with_concurrency(concurrency, [self._acheck_pair(*key) for key in keys])))
+        self._cache_pair_results(results)
+        return self._make_nway_dataframe(pairs, verdicts, results)
+
+    def _make_nway_pairs(self, translation_data: pd.DataFrame, engines: list) -> list:
+        """
+        Make (source, engine1, engine2, target1, target2) for every row and every pair of engines.
+        """
+        pairs = []
+        for source, *targets in zip(translation_data["source"].map(to_text), *[translation_data[engine].map(to_text) for engine in engines]):
+            if not source:
+                continue
+            for (engine1, target1), (engine2, target2) in itertools.combinations(zip(engines, targets), 2):
+                if target1 and target2:
+                    pairs.append((source, engine1, engine2, target1, target2))
+        return pairs
+
+    def _prefilter_nway_pairs(self, pairs: list) -> list:
+        if self.prefilter is None:
+            return [(None, "")] * len(pairs)
+        return self._prefilter_verdicts([(source, target1, target2) for source, _, _, target1, target2 in pairs], "compare_nway_prefilter")
+
+    def _get_uncached_keys(self, pairs: list, verdicts: list) -> list:
+        keys = []
+        for (source, _, _, target1, target2), (_, reason) in zip(pairs, verdicts):
+            key, _ = self._make_pair_key(source, target1, target2)
+            if target1 != target2 and not reason and key not in self._pair_cache and key not in keys:
+                keys.append(key)
+        return keys
+
+    def _cache_pair_results(self, results: dict):
+        """
+        Cache the successful pair evaluations. A failure is not cached, so that a transient error is retried by the next duplicate pair.
+        """
+        for key, (is_success, result) in results.items():
+            if is_success:
+                self._pair_cache[key] = (is_success, result)
+
+    def _make_pair_key(self, source: str, target1: str, target2: str) -> tuple:
+        """
+        Return the symmetric cache key and whether target1 and target2 are swapped in it.
+        """
+        source, target1, target2 = to_text(source), to_text(target1), to_text(target2)
+        if target1 <= target2:
+            return (source, target1, target2), False
+        return (source, target2, target1), True
+
+    async def _acheck_pair(self, source: str, target1: str, target2: str) -> tuple:
+        try:
+            return await self._acall(source=source, target1=target1, target2=target2)
+        except Exception as e:
+            return False, str(e)
+
+    def _make_nway_dataframe(self, pairs: list, verdicts: list, results: dict) -> pd.DataFrame:
+        rows = []
+        for (source, engine1, engine2, target1, target2), (label, reason) in zip(pairs, verdicts):
+            if target1 == target2:
+                rows.append([source, engine1, engine2, target1, target2, 0, 0, 0, SAME_REVIEW])
+                continue
+            if reason:
+                row = self._make_local_row(source, target1, target2, label, reason)
+                rows.append(row[:1] + [engine1, engine2] + row[1:])
+                continue
+            key, is_swapped = self._make_pair_key(source, target1, target2)
+            is_success, result = results[key] if key in results else self._pair_cache[key]
+            row = self._make_row(source, target1, target2, is_success, result)
+            if is_success and is_swapped:
+                row = row[:3] + [self._swap_label(label) for label in row[3:6]] + [SWAPPED_REVIEW_PREFIX + str(row[6])]
+            rows.append(row[:1] + [engine1, engine2] + row[1:])
+        return pd.DataFrame(rows, columns=NWAY_COLUMNS)
+
+    def _swap_label(self, label):
+        """
+        Swap the 1 (engine 1 is better) and 2 (engine 2 is better) labels.
+        """
+        try:
+            label = int(label)
+        except (TypeError, ValueError):
+            return label
+        return {1: 2, 2: 1}.get(label, label)
+
+    async def _acheck_row(self, source: str, target1: str, target2: str) -> list:
+        try:
+            is_success, result = await self._acall(source=source, target1=target1, target2=target2)
+        except Exception as e:
+            is_success, result = False, str(e)
+        return self._make_row(source, target1, target2, is_success, result)
+
+    def _make_row(self, source: str, target1: str, target2: str, is_success: bool, result) -> list:
+        if is_success:
+            return [source, target1, target2, result["accuracy"], result["grammar"], result["total"], result["review"]]
+        return [source, target1, target2, -1, -1, -1, FAILED_REVIEW]
+
+    def _call(self, source: str, target1: str, target2: str):
+        chain = self._make_chain()
         result, cost, tokens = self._run_llm_chain(chain=chain,
+                                                   operation="compare",
                                                    source_language=self.source_language,
                                                    target_language=self.target_language,
                                                    source=source,
                                                    target1=target1,
                                                    target2=target2)
+        return self._verify_result(result)
+
+    async def _acall(self, source: str, target1: str, target2: str):
+        chain = self._make_chain()
+        result, cost, tokens = await self._arun_llm_chain(chain=chain,
+                                                          operation="compare",
+                                                          source_language=self.source_language,
+                                                          target_language=self.target_language,
+                                                          source=source,
+                                                          target1=target1,
+                                                          target2=target2)
+        return self._verify_result(result)
+
+    def _make_chain(self):
+        llm = self._get_llm(model=self.model, temperature=self.temperature)
+        return self._make_llm_chain(llm=llm, system_template=SYSTEM_TEMPLATE, human_template=HUMAN_TEMPLATE)
+
+    def _verify_result(self, result: dict):
         if "accuracy" not in result or "grammar" not in result or "total" not in result or "review" not in result:
+            self._record_error("compare", "invalid_format")
             return False, "Output format is not correct."
         return True, result
+
+
+def win_rates(nway_data: pd.DataFrame, column: str="total") -> pd.DataFrame:
+    """
+    Aggregate the N-way compare results into per-engine wins, losses and ties on the column.
+    A tie counts as half a win, and failed evaluations are excluded.
+    """
+    stats = {}
+    for engine1, engine2, label in zip(nway_data["engine1"], nway_data["engine2"], nway_data[column]):
+        try:
+            label = int(label)
+        except (TypeError, ValueError):
+            continue
+        if label not in (0, 1, 2):
+            continue
+        for engine, result in ((engine1, {0: "ties", 1: "wins", 2: "losses"}[label]), (engine2, {0: "ties", 1: "losses", 2: "wins"}[label])):
+            engine_stats = stats.setdefault(engine, {"wins": 0, "losses": 0, "ties": 0})
+            engine_stats[result] += 1
+    rows = []
+    for engine, engine_stats in stats.items():
+        comparisons = engine_stats["wins"] + engine_stats["losses"] + engine_stats["ties"]
+        win_rate = (engine_stats["wins"] + 0.5 * engine_stats["ties"]) / comparisons
+        rows.append([engine, engine_stats["wins"], engine_stats["losses"], engine_stats["ties"], comparisons, win_rate])
+    return pd.DataFrame(rows, columns=WIN_RATE_COLUMNS).sort_values("win_rate", ascending=False, ignore_index=True)
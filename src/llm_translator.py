@@ -1,9 +1,41 @@
+import asyncio
+import difflib
 import json
-
-from llm import LLM
-from bunkai import Bunkai
-from translation_prompt import SYSTEM_TEMPLATE, TEXT_OUTPUT_FORMAT, TABLE_OUTPUT_FOTMAT, HUMAN_TEMPLATE, EXAMPLE_EN_TO_JA, EXAMPLE_JA_TO_EN, TEXT_EXAMPLE
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from llm import LLM, PARTIAL_KEY, estimate_tokens, gather_with_concurrency
+from llm_registry import REGISTRY
+from metrics import METRICS, CallMetric, CACHE_HIT, CACHE_FUZZY, CACHE_MISS
+from json_parser import IncrementalArrayParser
+from translation_prompt import SYSTEM_TEMPLATE, TEXT_OUTPUT_FORMAT, TABLE_OUTPUT_FOTMAT, HUMAN_TEMPLATE, CONTEXT_HUMAN_TEMPLATE, EXAMPLE_EN_TO_JA, EXAMPLE_JA_TO_EN, TEXT_EXAMPLE, GLOSSARY_CONSTRAINT, GLOSSARY_ENTRY
 from const import EN, JA
+from translation_memory import TranslationMemory
+from fuzzy_memory import FuzzyTranslationMemory
+from glossary import Glossary
+from sentence_splitter import EnglishSplitter, JapaneseSplitter
+from sentence_aligner import SentenceAligner
+
+BASE_ERROR_MESSAGE = "Failed to translate."
+PARTIAL_ERROR_NO = "e0003"
+SPLIT_SYSTEM_TEMPLATE = ("Split input text with delimiters and line feed codes.\n"
+                         "Based on the given constraints and input text, output the text segmentation results.\n"
+                         "# Constraints:\n {constraints}")
+SPLIT_CONSTRAINTS = ("- The result must be in json format with a unique key, where the key is \"split_sentences\" and the values must be separated by an array of sentences."
+                     "- The key of \"not unique\" cannot be used.\n"
+                     "- Please refer to the following output format.\n"
+                     "``` input fomat (string)\n"
+                     "Hi, how are you? Not bad.\nThis is a test."
+                     "```\n"
+                     "```json\n"
+                     "{\n"
+                     "  \"split_sentences\": [\"Hi, how are you?\", \"Not bad.\", \"This is a test.\"]"
+                     "}\n"
+                     "```")
+
+REGISTRY.precompile(SYSTEM_TEMPLATE, HUMAN_TEMPLATE)
+REGISTRY.precompile(SYSTEM_TEMPLATE, CONTEXT_HUMAN_TEMPLATE)
+REGISTRY.precompile(SPLIT_SYSTEM_TEMPLATE, HUMAN_TEMPLATE)
 
 
 def remove_line_feed_code(text: str) -> str:
@@ -12,6 +44,55 @@ def remove_line_feed_code(text: str) -> str:
     """
     return "\n".join([line for line in text.split("\n") if line != ""])
 
+
+def chunk_sentences(texts: list, max_tokens: int) -> list:
+    """
+    Group consecutive sentences into chunks whose estimated tokens fit in max_tokens.
+    Return (start, end) index pairs. A sentence longer than max_tokens forms a chunk by itself.
+    """
+    chunks = []
+    start = 0
+    chunk_tokens = 0
+    for i, text in enumerate(texts):
+        text_tokens = estimate_tokens(json.dumps(text))
+        if i > start and chunk_tokens + text_tokens > max_tokens:
+            chunks.append((start, i))
+            start = i
+            chunk_tokens = 0
+        chunk_tokens += text_tokens
+    if start < len(texts):
+        chunks.append((start, len(texts)))
+    return chunks
+
+
+def estimate_output_tokens(text: str) -> int:
+    """
+    Estimate max_tokens for the translation of the text, with headroom for the JSON format.
+    It is rounded up to a multiple of 500 so that chat models can be reused for similar chunks.
+    """
+    return min(4000, (estimate_tokens(text) * 2 + 200 + 499) // 500 * 500)
+
+
+def make_table_example(source_texts: list, translated_texts: list) -> str:
+    """
+    Make a few-shot example in the same format as EXAMPLE_JA_TO_EN and EXAMPLE_EN_TO_JA.
+    """
+    return ("```input (array)\n"
+            f"{json.dumps(source_texts, ensure_ascii=False)}"
+            "```\n"
+            "``` output (json)\n"
+            f"{json.dumps({'translated_texts': translated_texts}, ensure_ascii=False, indent=2)}\n"
+            "```\n")
+
+
+def make_glossary_constraint(entries: list) -> str:
+    """
+    Make the glossary constraint of the (source term, target term) entries. Return "" if there is no entry.
+    """
+    if not entries:
+        return ""
+    return GLOSSARY_CONSTRAINT + "".join(GLOSSARY_ENTRY.format(source=source, target=target) for source, target in entries)
+
 class Translation:
     def __init__(self, translated_texts: list, is_success: bool=True, cost: float=0.0, tokens: int=0, error="", error_no=""):
         self.source_texts: list = []
@@ -21,6 +102,8 @@ class Translation:
         self.tokens: int = tokens
         self.error: str = error
         self.error_no: str = error_no
+        # (index, source term, target term) of the glossary terms missing in the translation
+        self.glossary_violations: list = []
 
     def verify_text_pair(self) -> bool:
         """
@@ -60,52 +143,533 @@ class SplitedSentence:
 
 
 class Translator(LLM):
-    def __init__(self, debug: bool=False):
+    def __init__(self, debug: bool=False, translation_memory: TranslationMemory=None, max_chunk_tokens: int=800, context_size: int=2, concurrency: int=4, max_retries: int=1, retry_backoff: float=1.0, llm_split_fallback: bool=False,
+                 fuzzy_memory: FuzzyTranslationMemory=None, fuzzy_reuse_threshold: float=None, fuzzy_example_threshold: float=0.5, fuzzy_examples: int=3,
+                 glossary: Glossary=None):
         super().__init__(debug=debug)
-        self.japaneses_splitter = Bunkai()
-
-    def translate_by_sentence(self, source_language, target_language, text, model, temperature):
+        self.japaneses_splitter = JapaneseSplitter()
+        self.english_splitter = EnglishSplitter()
+        self.aligner = SentenceAligner()
+        self.llm_split_fallback = llm_split_fallback
+        self.translation_memory = translation_memory
+        # 類似文の翻訳は fuzzy_reuse_threshold 以上ならそのまま再利用し、fuzzy_example_threshold 以上なら few-shot の例として使う
+        self.fuzzy_memory = fuzzy_memory
+        self.fuzzy_reuse_threshold = fuzzy_reuse_threshold
+        self.fuzzy_example_threshold = fuzzy_example_threshold
+        self.fuzzy_examples = fuzzy_examples
+        # 用語集は入力に含まれる用語だけをプロンプトに入れる
+        self.glossary = glossary
+        self.max_chunk_tokens = max_chunk_tokens
+        self.context_size = context_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+
+    def translate_by_sentence(self, source_language, target_language, text, model, temperature, previous: Translation=None):
         """
         Translate sentence unit from source language to target language.
+        If the previous translation of an earlier version of the text is given, only the inserted or changed sentences are translated.
         """
+        splited_sentences = self.split_sentences(source_language, text)
 
-        base_error_message = "Failed to translate."
-        if source_language == JA:
-            splited_sentences = self.split_sentences_by_rule(text=text)
-        else:
-            splited_sentences = self.split_sentences_by_llm(text=text)
+        if not splited_sentences.is_success:
+            return Translation(translated_texts=[], is_success=False, error=BASE_ERROR_MESSAGE)
+
+        return self.translate_texts(source_language, target_language, splited_sentences.texts, model, temperature, previous)
+
+    def translate_texts(self, source_language, target_language, source_texts: list, model, temperature, previous: Translation=None):
+        """
+        Translate already segmented texts, e.g. sentences or text segments of a document, in table format requests.
+        """
+        translated_texts = self._get_known_texts(source_language, target_language, model, temperature, source_texts, previous)
+        # Only the cache-miss sentences are sent to the LLM.
+        translation = self._translate_chunks(source_language, target_language, source_texts, translated_texts, model, temperature)
+        return self._merge_translation(source_language, target_language, model, temperature, source_texts, translated_texts, translation)
+
+    async def atranslate_by_sentence(self, source_language, target_language, text, model, temperature, previous: Translation=None):
+        """
+        Async version of translate_by_sentence.
+        """
+        splited_sentences = await self.asplit_sentences(source_language, text)
+
+        if not splited_sentences.is_success:
+            return Translation(translated_texts=[], is_success=False, error=BASE_ERROR_MESSAGE)
 
-        if splited_sentences.is_success:
-            _source_text = splited_sentences.dump()
+        return await self.atranslate_texts(source_language, target_language, splited_sentences.texts, model, temperature, previous)
+
+    async def atranslate_texts(self, source_language, target_language, source_texts: list, model, temperature, previous: Translation=None):
+        """
+        Async version of translate_texts.
+        """
+        translated_texts = self._get_known_texts(source_language, target_language, model, temperature, source_texts, previous)
+        translation = await self._atranslate_chunks(source_language, target_language, source_texts, translated_texts, model, temperature)
+        return self._merge_translation(source_language, target_language, model, temperature, source_texts, translated_texts, translation)
+
+    def _translate_chunks(self, source_language, target_language, source_texts: list, translated_texts: list, model, temperature):
+        """
+        Translate the cache-miss sentences in token-budgeted chunks dispatched concurrently.
+        Return None if there is no cache-miss sentence.
+        """
+        chunks = self._make_chunks(source_texts, translated_texts)
+        if not chunks:
+            return None
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as executor:
+            translations = list(executor.map(lambda chunk: self._translate_chunk(source_language, target_language, chunk, model, temperature), chunks))
+        return self._combine_translations(translations)
+
+    async def _atranslate_chunks(self, source_language, target_language, source_texts: list, translated_texts: list, model, temperature):
+        """
+        Async version of _translate_chunks.
+        """
+        chunks = self._make_chunks(source_texts, translated_texts)
+        if not chunks:
+            return None
+        translations = await gather_with_concurrency(self.concurrency, [self._atranslate_chunk(source_language, target_language, chunk, model, temperature) for chunk in chunks])
+        return self._combine_translations(translations)
+
+    def _make_chunks(self, source_texts: list, translated_texts: list, max_chunk_tokens: int=None) -> list:
+        """
+        Make (texts, context) chunks of the cache-miss sentences.
+        The context is the neighbor sentences of the chunk in the whole document.
+        """
+        missing_indexes = [i for i, t in enumerate(translated_texts) if t is None]
+        missing_texts = [source_texts[i] for i in missing_indexes]
+        chunks = []
+        for start, end in chunk_sentences(missing_texts, max_chunk_tokens or self.max_chunk_tokens):
+            first, last = missing_indexes[start], missing_indexes[end - 1]
+            before = source_texts[max(0, first - self.context_size): first]
+            after = source_texts[last + 1: last + 1 + self.context_size]
+            chunks.append((missing_texts[start:end], " ".join(before + ["..."] + after) if before or after else ""))
+        return chunks
+
+    def _translate_chunk(self, source_language, target_language, chunk: tuple, model, temperature) -> Translation:
+        """
+        Translate a chunk. Only this chunk is retried when it fails.
+        If the response is truncated, only the missing tail of the chunk is re-requested.
+        If the model merged or split sentences, the response is realigned locally, and only the sentences which cannot be aligned are re-requested.
+        """
+        texts, context = chunk
+        example = self._get_fuzzy_example(source_language, target_language, model, temperature, texts)
+        glossary = self._get_glossary_constraint(source_language, target_language, texts)
+        chunk_translation = Translation(translated_texts=[], is_success=False)
+        translated_texts = [None] * len(texts)
+        pending_texts = []
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            missing_indexes = [i for i, t in enumerate(translated_texts) if t is None]
+            source_text = json.dumps([texts[i] for i in missing_indexes])
+            translation = self.translate(source_language, target_language, source_text, model, temperature, format_type="table",
+                                         context=context, max_tokens=estimate_output_tokens(source_text), example=example, glossary=glossary)
+            pending_texts = self._add_chunk_translation(target_language, chunk_translation, translation, texts, translated_texts, missing_indexes)
+            if None not in translated_texts:
+                break
+        return self._finish_chunk_translation(chunk_translation, texts, translated_texts, pending_texts)
+
+    async def _atranslate_chunk(self, source_language, target_language, chunk: tuple, model, temperature) -> Translation:
+        texts, context = chunk
+        example = self._get_fuzzy_example(source_language, target_language, model, temperature, texts)
+        glossary = self._get_glossary_constraint(source_language, target_language, texts)
+        chunk_translation = Translation(translated_texts=[], is_success=False)
+        translated_texts = [None] * len(texts)
+        pending_texts = []
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            missing_indexes = [i for i, t in enumerate(translated_texts) if t is None]
+            source_text = json.dumps([texts[i] for i in missing_indexes])
+            translation = await self.atranslate(source_language, target_language, source_text, model, temperature, format_type="table",
+                                                context=context, max_tokens=estimate_output_tokens(source_text), example=example, glossary=glossary)
+            pending_texts = self._add_chunk_translation(target_language, chunk_translation, translation, texts, translated_texts, missing_indexes)
+            if None not in translated_texts:
+                break
+        return self._finish_chunk_translation(chunk_translation, texts, translated_texts, pending_texts)
+
+    def _add_chunk_translation(self, target_language, chunk_translation: Translation, translation: Translation, texts: list, translated_texts: list, missing_indexes: list) -> list:
+        """
+        Fill translated_texts at missing_indexes with the translation of the missing texts of the chunk.
+        The complete prefix of a truncated translation is kept, and a translation with a count mismatch is realigned.
+        The texts of a failed translation are returned for reporting.
+        """
+        chunk_translation.cost += translation.cost
+        chunk_translation.tokens += translation.tokens
+        chunk_translation.is_success = translation.is_success
+        chunk_translation.error = translation.error
+        chunk_translation.error_no = translation.error_no
+        if translation.error_no == PARTIAL_ERROR_NO:
+            new_texts = translation.translated_texts[:len(missing_indexes)]
+        elif translation.is_success and len(translation.translated_texts) == len(missing_indexes):
+            new_texts = translation.translated_texts
+        elif translation.is_success and all(isinstance(t, str) for t in translation.translated_texts):
+            new_texts = self.aligner.repair([texts[i] for i in missing_indexes], translation.translated_texts, target_language)
+            METRICS.record_alignment("translate_by_sentence", sum(1 for t in new_texts if t is not None), sum(1 for t in new_texts if t is None))
+        else:
+            return translation.translated_texts
+        for i, translated_text in zip(missing_indexes, new_texts):
+            translated_texts[i] = translated_text
+        return []
+
+    def _finish_chunk_translation(self, chunk_translation: Translation, texts: list, translated_texts: list, pending_texts: list) -> Translation:
+        if None not in translated_texts:
+            chunk_translation.translated_texts = translated_texts
+            chunk_translation.is_success = True
+            chunk_translation.error = ""
+            chunk_translation.error_no = ""
         else:
-            return Translation(translated_texts=[], is_success=False, error=base_error_message)
+            # A count mismatch is reported with all the translated texts, as before.
+            chunk_translation.translated_texts = [t for t in translated_texts if t is not None] + pending_texts
+        chunk_translation.set_source_texts(texts)
+        return chunk_translation
 
-        translation = self.translate(source_language, target_language, _source_text, model, temperature, format_type="table")
+    def _verify_chunk(self, translation: Translation, texts: list) -> bool:
+        translation.set_source_texts(texts)
+        return translation.is_success and translation.verify_text_pair()
 
+    def _combine_translations(self, translations: list) -> Translation:
+        """
+        Reassemble the chunk translations in order. The first failed chunk decides the error.
+        """
+        combined = Translation(translated_texts=[], is_success=True)
+        for translation in translations:
+            combined.source_texts += translation.source_texts
+            combined.translated_texts += translation.translated_texts
+            combined.cost += translation.cost
+            combined.tokens += translation.tokens
+            if combined.is_success and not translation.is_success:
+                combined.is_success = False
+                combined.error = translation.error
+                combined.error_no = translation.error_no
+        return combined
+
+    def stream_translate_by_sentence(self, source_language, target_language, text, model, temperature, previous: Translation=None):
+        """
+        Translate sentence unit and yield (index, source text, translated text) in order as soon as each sentence is translated.
+        When the model merged or split sentences of a chunk, the chunk is realigned after its stream, and the sentences whose
+        translation changed are yielded again with the same index, to replace the rows yielded before.
+        The last item yielded is the whole Translation, which has the same result as translate_by_sentence.
+        """
+        splited_sentences = self.split_sentences(source_language, text)
+
+        if not splited_sentences.is_success:
+            yield Translation(translated_texts=[], is_success=False, error=BASE_ERROR_MESSAGE)
+            return
+
+        source_texts = splited_sentences.texts
+        translated_texts = self._get_known_texts(source_language, target_language, model, temperature, source_texts, previous)
+        missing_indexes = [i for i, t in enumerate(translated_texts) if t is None]
+        position = 0
+        translations = []
+        for chunk in self._make_chunks(source_texts, translated_texts):
+            chunk_indexes = missing_indexes[:len(chunk[0])]
+            missing_indexes = missing_indexes[len(chunk[0]):]
+            # Cached sentences before the chunk are ready.
+            while translated_texts[position] is not None:
+                yield position, source_texts[position], translated_texts[position]
+                position += 1
+            translation = Translation(translated_texts=[], is_success=True)
+            streamed_texts = []
+            for translated_text in self._stream_translate_chunk(source_language, target_language, chunk, model, temperature, translation):
+                # Extra sentences do not belong to this chunk.
+                if len(streamed_texts) < len(chunk_indexes):
+                    yield position, source_texts[position], translated_text
+                    streamed_texts.append(translated_text)
+                    position += 1
+                    while position < len(source_texts) and translated_texts[position] is not None:
+                        yield position, source_texts[position], translated_texts[position]
+                        position += 1
+            translations.append(translation)
+            if not self._verify_chunk(translation, chunk[0]):
+                break
+            for k, (i, translated_text) in enumerate(zip(chunk_indexes, translation.translated_texts)):
+                if k < len(streamed_texts):
+                    # 再整列で訳文が変わった行を差し替える
+                    if translated_text != streamed_texts[k]:
+                        yield i, source_texts[i], translated_text
+                    continue
+                # The sentences realigned after the stream have not been yielded yet.
+                yield position, source_texts[position], translated_text
+                position += 1
+                while position < len(source_texts) and translated_texts[position] is not None:
+                    yield position, source_texts[position], translated_texts[position]
+                    position += 1
+        while position < len(source_texts) and translated_texts[position] is not None:
+            yield position, source_texts[position], translated_texts[position]
+            position += 1
+        combined = self._combine_translations(translations) if translations else None
+        yield self._merge_translation(source_language, target_language, model, temperature, source_texts, translated_texts, combined)
+
+    def _stream_translate_chunk(self, source_language, target_language, chunk: tuple, model, temperature, translation: Translation):
+        """
+        Stream the translation of a chunk and yield each translated text. The result is stored in `translation`.
+        """
+        texts, context = chunk
+        source_text = json.dumps(texts)
+        chain, inputs = self._make_translate_chain(source_language, target_language, source_text, model, temperature, "table",
+                                                   context, estimate_output_tokens(source_text),
+                                                   self._get_fuzzy_example(source_language, target_language, model, temperature, texts),
+                                                   self._get_glossary_constraint(source_language, target_language, texts))
+        parser = IncrementalArrayParser("translated_texts")
+        usage = {"cost": 0.0, "tokens": 0}
+        is_malformed = False
+        for piece in self._stream_llm_chain(chain=chain, operation="translate_stream", cache=self._get_cache_status("table"), usage=usage, **inputs):
+            if is_malformed:
+                # 壊れた要素以降は表示せず、応答の終わりまで読んでから salvage と残りの再要求に任せる
+                parser.buffer += piece
+                continue
+            count = len(parser.items)
+            try:
+                parser.feed(piece)
+            except json.decoder.JSONDecodeError:
+                is_malformed = True
+            # The items completed before a malformed item in the same piece are kept in parser.items.
+            for item in parser.items[count:]:
+                yield item
+        result = self._parse_response(parser.buffer, "translated_texts")
+        if is_malformed and not result.get(PARTIAL_KEY):
+            # Nothing was salvaged, so only the items already yielded are kept, and the rest of the chunk is re-requested.
+            result = {"translated_texts": parser.items, PARTIAL_KEY: True}
+        streamed = self._make_translation(source_language, target_language, source_text, model, temperature, "table", result, usage["cost"], usage["tokens"])
+        translation.translated_texts = streamed.translated_texts if streamed.is_success else parser.items
+        translation.is_success = streamed.is_success
+        translation.error = streamed.error
+        translation.error_no = streamed.error_no
+        translation.cost = streamed.cost
+        translation.tokens = streamed.tokens
+        if streamed.error_no == PARTIAL_ERROR_NO and len(parser.items) < len(texts):
+            # Only the missing tail of the truncated stream is re-requested.
+            tail = self._translate_chunk(source_language, target_language, (texts[len(parser.items):], context), model, temperature)
+            for item in tail.translated_texts:
+                yield item
+            translation.translated_texts = parser.items + tail.translated_texts
+            translation.is_success = tail.is_success
+            translation.error = tail.error
+            translation.error_no = tail.error_no
+            translation.cost += tail.cost
+            translation.tokens += tail.tokens
+        elif streamed.is_success and len(streamed.translated_texts) != len(texts):
+            # The streamed rows are already shown as they came, but the translation of the chunk is realigned as in _translate_chunk.
+            repaired = self._repair_chunk_translation(source_language, target_language, (texts, context), streamed.translated_texts, model, temperature)
+            translation.translated_texts = repaired.translated_texts
+            translation.is_success = repaired.is_success
+            translation.error = repaired.error
+            translation.error_no = repaired.error_no
+            translation.cost += repaired.cost
+            translation.tokens += repaired.tokens
+
+    def _repair_chunk_translation(self, source_language, target_language, chunk: tuple, translated_texts: list, model, temperature) -> Translation:
+        """
+        Realign the translated texts of a chunk with a count mismatch, and re-request only the sentences which cannot be aligned.
+        """
+        texts, context = chunk
+        chunk_translation = Translation(translated_texts=translated_texts, is_success=True)
+        if not all(isinstance(t, str) for t in translated_texts):
+            return chunk_translation
+        repaired = self.aligner.repair(texts, translated_texts, target_language)
+        missing_indexes = [i for i, t in enumerate(repaired) if t is None]
+        METRICS.record_alignment("translate_by_sentence", len(texts) - len(missing_indexes), len(missing_indexes))
+        if missing_indexes:
+            rest = self._translate_chunk(source_language, target_language, ([texts[i] for i in missing_indexes], context), model, temperature)
+            chunk_translation.cost = rest.cost
+            chunk_translation.tokens = rest.tokens
+            if not self._verify_chunk(rest, [texts[i] for i in missing_indexes]):
+                chunk_translation.is_success = rest.is_success
+                chunk_translation.error = rest.error
+                chunk_translation.error_no = rest.error_no
+                return chunk_translation
+            for i, translated_text in zip(missing_indexes, rest.translated_texts):
+                repaired[i] = translated_text
+        chunk_translation.translated_texts = repaired
+        return chunk_translation
+
+    def _get_known_texts(self, source_language, target_language, model, temperature, source_texts: list, previous: Translation=None) -> list:
+        """
+        Get the translations of the sentences unchanged from the previous translation, then of the cached sentences.
+        The other sentences are None.
+        """
+        translated_texts = self._get_previous_texts(source_texts, previous)
+        missing_indexes = [i for i, t in enumerate(translated_texts) if t is None]
+        if not missing_indexes:
+            return translated_texts
+        memory_texts = self._get_memory_texts(source_language, target_language, model, temperature, [source_texts[i] for i in missing_indexes])
+        for i, translated_text in zip(missing_indexes, memory_texts):
+            translated_texts[i] = translated_text
+        return translated_texts
+
+    def _get_previous_texts(self, source_texts: list, previous: Translation=None) -> list:
+        """
+        Diff the sentences against those of the previous translation, and reuse the translations of the unchanged sentences.
+        """
+        translated_texts = [None] * len(source_texts)
+        if previous is None or not previous.is_success or previous.error_no != "" or not previous.verify_text_pair():
+            return translated_texts
+        matcher = difflib.SequenceMatcher(None, previous.source_texts, source_texts, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                translated_texts[j1:j2] = previous.translated_texts[i1:i2]
+        return translated_texts
+
+    def _get_memory_texts(self, source_language, target_language, model, temperature, source_texts: list) -> list:
+        """
+        Get the cached translations of the sentences. Cache-miss sentences are None.
+        """
+        translated_texts = [None] * len(source_texts)
+        if self.translation_memory is not None:
+            start = time.perf_counter()
+            translated_texts = self.translation_memory.get_many(source_language, target_language, model, temperature, source_texts)
+            hits = sum(1 for t in translated_texts if t is not None)
+            METRICS.record_cache("translate_by_sentence", hits, len(translated_texts) - hits)
+            self._record_cache_hits("translate_by_sentence", model, CACHE_HIT, hits, time.perf_counter() - start)
+        if self.fuzzy_memory is not None and self.fuzzy_reuse_threshold is not None:
+            start = time.perf_counter()
+            missing_indexes = [i for i, t in enumerate(translated_texts) if t is None]
+            for i in missing_indexes:
+                matches = self.fuzzy_memory.search(source_language, target_language, model, temperature, source_texts[i], threshold=self.fuzzy_reuse_threshold)
+                if matches:
+                    translated_texts[i] = matches[0][2]
+            hits = sum(1 for i in missing_indexes if translated_texts[i] is not None)
+            METRICS.record_cache("translate_by_sentence_fuzzy", hits, len(missing_indexes) - hits)
+            self._record_cache_hits("translate_by_sentence_fuzzy", model, CACHE_FUZZY, hits, time.perf_counter() - start)
+        return translated_texts
+
+    def _record_cache_hits(self, operation: str, model: str, cache: str, hits: int, wall_time: float):
+        """
+        Record each sentence served from a cache, with the lookup time shared among them.
+        """
+        for _ in range(hits):
+            METRICS.record(CallMetric(operation=operation, model=model, wall_time=wall_time / hits, cache=cache))
+
+    def _get_cache_status(self, format_type: str) -> str:
+        """
+        Cache status of a translate call: the text format looks up the translation memory,
+        and the table format is called with the sentences missing in the memories.
+        """
+        if format_type == "text":
+            return CACHE_MISS if self.translation_memory is not None else ""
+        if self.translation_memory is not None or (self.fuzzy_memory is not None and self.fuzzy_reuse_threshold is not None):
+            return CACHE_MISS
+        return ""
+
+    def _get_fuzzy_example(self, source_language, target_language, model, temperature, texts: list) -> str:
+        """
+        Make a few-shot example from the translations of sentences similar to the texts.
+        Return "" to use the static example if there is no similar sentence.
+        """
+        if self.fuzzy_memory is None or self.fuzzy_examples <= 0:
+            return ""
+        examples = {}
+        for text in texts:
+            for _, source, target in self.fuzzy_memory.search(source_language, target_language, model, temperature, text, threshold=self.fuzzy_example_threshold):
+                examples.setdefault(source, target)
+            if len(examples) >= self.fuzzy_examples:
+                break
+        if not examples:
+            return ""
+        sources = list(examples)[:self.fuzzy_examples]
+        return make_table_example(sources, [examples[source] for source in sources])
+
+    def _get_glossary_constraint(self, source_language, target_language, texts: list) -> str:
+        """
+        Make the glossary constraint of only the glossary terms found in the texts.
+        """
+        if self.glossary is None:
+            return ""
+        return make_glossary_constraint(self.glossary.find_many(source_language, target_language, texts))
+
+    def _check_glossary(self, source_language, target_language, translation: Translation) -> Translation:
+        """
+        Set the glossary violations of the translated texts.
+        """
+        if self.glossary is not None:
+            translation.glossary_violations = self.glossary.check(source_language, target_language, translation.source_texts, translation.translated_texts)
+        return translation
+
+    def _merge_translation(self, source_language, target_language, model, temperature, source_texts: list, translated_texts: list, translation: Translation) -> Translation:
+        """
+        Merge the cached translations and the translation of the cache-miss sentences in order.
+        """
+        missing_indexes = [i for i, t in enumerate(translated_texts) if t is None]
+        if not missing_indexes:
+            translation = Translation(translated_texts=translated_texts, is_success=True)
+            translation.set_source_texts(source_texts)
+            return self._check_glossary(source_language, target_language, translation)
+
+        missing_texts = [source_texts[i] for i in missing_indexes]
         if translation and translation.is_success:
-            translation.set_source_texts(splited_sentences.texts)
+            translation.set_source_texts(missing_texts)
             # Verify that the number of cases in the source and target texts match.
             if translation.verify_text_pair():
-                return translation
-
-            translation.error = base_error_message
+                if self.translation_memory is not None:
+                    self.translation_memory.put_many(source_language, target_language, model, temperature,
+                                                     zip(missing_texts, translation.translated_texts))
+                if self.fuzzy_memory is not None:
+                    self.fuzzy_memory.add_many(source_language, target_language, model, temperature, zip(missing_texts, translation.translated_texts))
+                merged_texts = list(translated_texts)
+                for i, translated_text in zip(missing_indexes, translation.translated_texts):
+                    merged_texts[i] = translated_text
+                translation.translated_texts = merged_texts
+                translation.set_source_texts(source_texts)
+                return self._check_glossary(source_language, target_language, translation)
+
+            translation.error = BASE_ERROR_MESSAGE
             translation.error_no = "e0200"
+            self._record_error("translate_by_sentence", translation.error_no)
             return translation
 
         # NG case
         if translation:
             return translation
-        return Translation(translated_texts=[], is_success=False, error=base_error_message, error_no="e0201")
+        self._record_error("translate_by_sentence", "e0201")
+        return Translation(translated_texts=[], is_success=False, error=BASE_ERROR_MESSAGE, error_no="e0201")
+
+    def split_sentences(self, source_language: str, text: str) -> SplitedSentence:
+        """
+        Split text into sentences with the splitter of the source language.
+        English is split locally, and only the segments the rules flag as ambiguous are split by LLM if llm_split_fallback is set.
+        """
+        if source_language == JA:
+            return self.split_sentences_by_rule(text=text)
+        if source_language != EN:
+            return self.split_sentences_by_llm(text=text)
+        splited_sentences = SplitedSentence(texts=[], is_success=True)
+        for sentence, is_ambiguous in self.english_splitter.split_with_ambiguity(text):
+            if is_ambiguous and self.llm_split_fallback:
+                self._extend_splited_sentence(splited_sentences, sentence, self.split_sentences_by_llm(text=sentence))
+            else:
+                splited_sentences.texts.append(sentence)
+        return splited_sentences
+
+    async def asplit_sentences(self, source_language: str, text: str) -> SplitedSentence:
+        """
+        Async version of split_sentences.
+        """
+        if source_language == JA:
+            return self.split_sentences_by_rule(text=text)
+        if source_language != EN:
+            return await self.asplit_sentences_by_llm(text=text)
+        splited_sentences = SplitedSentence(texts=[], is_success=True)
+        for sentence, is_ambiguous in self.english_splitter.split_with_ambiguity(text):
+            if is_ambiguous and self.llm_split_fallback:
+                self._extend_splited_sentence(splited_sentences, sentence, await self.asplit_sentences_by_llm(text=sentence))
+            else:
+                splited_sentences.texts.append(sentence)
+        return splited_sentences
+
+    def _extend_splited_sentence(self, splited_sentences: SplitedSentence, sentence: str, llm_splited_sentences: SplitedSentence):
+        """
+        Add the sentences split by LLM. The segment is kept as it is if LLM fails.
+        """
+        splited_sentences.cost += llm_splited_sentences.cost
+        splited_sentences.tokens += llm_splited_sentences.tokens
+        if llm_splited_sentences.is_success and llm_splited_sentences.texts:
+            splited_sentences.texts += llm_splited_sentences.texts
+        else:
+            splited_sentences.texts.append(sentence)
 
     def split_sentences_by_rule(self, text: str) -> SplitedSentence:
         """
         Split text into sentences using rule base.
         """
-        texts = []
-        empty_text = ""
-        for _t in self.japaneses_splitter(text):
-            if _t.strip() != empty_text:
-                texts.append(_t)
+        texts = self.japaneses_splitter.split(text)
         return SplitedSentence(texts=texts, is_success=True, cost=0.0, tokens=0, error="")
 
     def split_sentences_by_llm(self, text: str) -> SplitedSentence:
@@ -113,26 +677,29 @@ class Translator(LLM):
         Split text into sentences using LLM.
         """
         text = remove_line_feed_code(text)
+        chain = self._make_split_chain()
+        result, cost, tokens = self._run_llm_chain(chain=chain, operation="split_sentences", text=text, constraints=SPLIT_CONSTRAINTS)
+        return self._make_splited_sentence(result, cost, tokens)
+
+    async def asplit_sentences_by_llm(self, text: str) -> SplitedSentence:
+        """
+        Async version of split_sentences_by_llm.
+        """
+        text = remove_line_feed_code(text)
+        chain = self._make_split_chain()
+        result, cost, tokens = await self._arun_llm_chain(chain=chain, operation="split_sentences", text=text, constraints=SPLIT_CONSTRAINTS)
+        return self._make_splited_sentence(result, cost, tokens)
+
+    def _make_split_chain(self):
         llm = self._get_llm(model="gpt-3.5-turbo", temperature=0.0)
-        system_template = ("Split input text with delimiters and line feed codes.\n"
-                           "Based on the given constraints and input text, output the text segmentation results.\n"
-                           "# Constraints:\n {constraints}")
-        constraints = ("- The result must be in json format with a unique key, where the key is \"split_sentences\" and the values must be separated by an array of sentences."
-                       "- The key of \"not unique\" cannot be used.\n"
-                       "- Please refer to the following output format.\n"
-                       "``` input fomat (string)\n"
-                       "Hi, how are you? Not bad.\nThis is a test."
-                       "```\n"
-                       "```json\n"
-                       "{\n"
-                       "  \"split_sentences\": [\"Hi, how are you?\", \"Not bad.\", \"This is a test.\"]"
-                       "}\n"
-                       "```")
+        return self._make_llm_chain(llm=llm, system_template=SPLIT_SYSTEM_TEMPLATE, human_template=HUMAN_TEMPLATE)
 
-        human_template = HUMAN_TEMPLATE
-        chain = self._make_llm_chain(llm=llm, system_template=system_template, human_template=human_template)
-        result, cost, tokens = self._run_llm_chain(chain=chain, text=text, constraints=constraints)
+    def _make_splited_sentence(self, result: dict, cost: float, tokens: int) -> SplitedSentence:
+        splited_sentences = self._verify_splited_sentence(result, cost, tokens)
+        self._record_error("split_sentences", splited_sentences.error_no)
+        return splited_sentences
 
+    def _verify_splited_sentence(self, result: dict, cost: float, tokens: int) -> SplitedSentence:
         key_split_sentences = "split_sentences"
         if key_split_sentences not in result:
             return SplitedSentence(texts=[], is_success=False, error=f"Output format is not {key_split_sentences} key", error_no="e0100", cost=cost, tokens=tokens)
@@ -142,35 +709,105 @@ class Translator(LLM):
 
         return SplitedSentence(texts=result[key_split_sentences], is_success=True, cost=cost, tokens=tokens)
 
-    def translate(self, source_language: str, target_language: str, text: str, model: str="gpt-3.5-turbo", temperature: float=0.0, format_type: str="text") -> Translation:
+    def translate(self, source_language: str, target_language: str, text: str, model: str="gpt-3.5-turbo", temperature: float=0.0, format_type: str="text", context: str="", max_tokens: int=2000, example: str="", glossary: str=None) -> Translation:
         """
         Translate text from source language to target language.
+        The context is the neighbor text given to the LLM for reference only.
+        The example replaces the static few-shot example of the table format if given.
+        The glossary constraint is made from the glossary terms found in the text unless given.
 
         MEMO: Prompted to ignore input overriding instructions, but to no avail.
         """
-        llm = self._get_llm(model=model, temperature=temperature)
+        cached_translation = self._get_memory_translation(source_language, target_language, text, model, temperature, format_type)
+        if cached_translation:
+            return cached_translation
+
+        if glossary is None:
+            glossary = self._get_glossary_constraint(source_language, target_language, self._get_input_texts(text, format_type))
+        chain, inputs = self._make_translate_chain(source_language, target_language, text, model, temperature, format_type, context, max_tokens, example, glossary)
+        salvage_key = "translated_texts" if format_type == "table" else ""
+        result, cost, tokens = self._run_llm_chain(chain=chain, operation="translate", salvage_key=salvage_key, cache=self._get_cache_status(format_type), **inputs)
+        return self._make_translation(source_language, target_language, text, model, temperature, format_type, result, cost, tokens)
+
+    async def atranslate(self, source_language: str, target_language: str, text: str, model: str="gpt-3.5-turbo", temperature: float=0.0, format_type: str="text", context: str="", max_tokens: int=2000, example: str="", glossary: str=None) -> Translation:
+        """
+        Async version of translate.
+        """
+        cached_translation = self._get_memory_translation(source_language, target_language, text, model, temperature, format_type)
+        if cached_translation:
+            return cached_translation
+
+        if glossary is None:
+            glossary = self._get_glossary_constraint(source_language, target_language, self._get_input_texts(text, format_type))
+        chain, inputs = self._make_translate_chain(source_language, target_language, text, model, temperature, format_type, context, max_tokens, example, glossary)
+        salvage_key = "translated_texts" if format_type == "table" else ""
+        result, cost, tokens = await self._arun_llm_chain(chain=chain, operation="translate", salvage_key=salvage_key, cache=self._get_cache_status(format_type), **inputs)
+        return self._make_translation(source_language, target_language, text, model, temperature, format_type, result, cost, tokens)
+
+    def _get_input_texts(self, text: str, format_type: str) -> list:
+        """
+        Get the texts of the input. The input of the table format is a JSON array of texts.
+        """
+        if format_type == "table":
+            try:
+                texts = json.loads(text)
+                if isinstance(texts, list):
+                    return [t for t in texts if isinstance(t, str)]
+            except json.decoder.JSONDecodeError:
+                pass
+        return [text]
+
+    def _get_memory_translation(self, source_language, target_language, text, model, temperature, format_type):
+        if self.translation_memory is None or format_type != "text":
+            return None
+        start = time.perf_counter()
+        cached_text = self.translation_memory.get(source_language, target_language, model, temperature, text)
+        METRICS.record_cache("translate", int(cached_text is not None), int(cached_text is None))
+        if cached_text is None:
+            return None
+        self._record_cache_hits("translate", model, CACHE_HIT, 1, time.perf_counter() - start)
+        return Translation(translated_texts=cached_text, is_success=True)
+
+    def _make_translate_chain(self, source_language, target_language, text, model, temperature, format_type, context="", max_tokens=2000, example="", glossary="") -> tuple:
+        llm = self._get_llm(model=model, temperature=temperature, max_tokens=max_tokens)
 
         output_format = TEXT_OUTPUT_FORMAT
-        example = TEXT_EXAMPLE
+        static_example = TEXT_EXAMPLE
         if format_type == "table":
             output_format = TABLE_OUTPUT_FOTMAT
             if source_language == JA and target_language == EN:
-                example = EXAMPLE_JA_TO_EN
+                static_example = EXAMPLE_JA_TO_EN
             elif source_language == EN and target_language == JA:
-                example = EXAMPLE_EN_TO_JA
+                static_example = EXAMPLE_EN_TO_JA
+        if format_type != "table" or not example:
+            example = static_example
 
         system_template = SYSTEM_TEMPLATE
         human_template = HUMAN_TEMPLATE
+        inputs = {"source_language": source_language,
+                  "target_language": target_language,
+                  "text": text,
+                  "output_format": output_format,
+                  "glossary": glossary,
+                  "example": example}
+        if context:
+            human_template = CONTEXT_HUMAN_TEMPLATE
+            inputs["context"] = context
         chain = self._make_llm_chain(llm=llm, system_template=system_template, human_template=human_template)
-        result, cost, tokens = self._run_llm_chain(chain=chain,
-                                                   source_language=source_language,
-                                                   target_language=target_language,
-                                                   text=text,
-                                                   output_format=output_format,
-                                                   example=example)
+        return chain, inputs
+
+    def _make_translation(self, source_language, target_language, text, model, temperature, format_type, result, cost, tokens) -> Translation:
+        translation = self._verify_translation(source_language, target_language, text, model, temperature, format_type, result, cost, tokens)
+        self._record_error("translate", translation.error_no)
+        return translation
+
+    def _verify_translation(self, source_language, target_language, text, model, temperature, format_type, result, cost, tokens) -> Translation:
         key_translated_texts = "translated_texts"
-        if key_translated_texts not in result:
+        # トップレベルが配列や文字列の JSON も出力形式の誤り
+        if not isinstance(result, dict) or key_translated_texts not in result:
             return Translation(translated_texts=[], is_success=False, error=f"Output format is not {key_translated_texts} key", error_no="e0000", cost=cost, tokens=tokens)
+        if result.get(PARTIAL_KEY):
+            return Translation(translated_texts=result[key_translated_texts], is_success=False, error="Output is truncated", error_no=PARTIAL_ERROR_NO, cost=cost, tokens=tokens)
         _translated_texts = result[key_translated_texts]
         if format_type == "table":
             if isinstance(_translated_texts, list):
@@ -178,7 +815,12 @@ class Translator(LLM):
             return Translation(translated_texts=[], is_success=False, error="Output format is not list", error_no="e0001", cost=cost, tokens=tokens)
         else:
             if isinstance(_translated_texts, str):
-                return Translation(translated_texts=_translated_texts, is_success=True, cost=cost, tokens=tokens)
+                if self.translation_memory is not None:
+                    self.translation_memory.put(source_language, target_language, model, temperature, text, _translated_texts)
+                translation = Translation(translated_texts=_translated_texts, is_success=True, cost=cost, tokens=tokens)
+                if self.glossary is not None:
+                    translation.glossary_violations = self.glossary.check(source_language, target_language, [text], [_translated_texts])
+                return translation
 
             return Translation(translated_texts=[], is_success=False, error="Output format is not str", error_no="e0002", cost=cost, tokens=tokens)
 
@@ -0,0 +1,229 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+METRICS_PATH = os.environ.get("LLM_TRANSLATOR_METRICS_PATH", "")
+
+# CallMetric.cache の値。"" はキャッシュを使わない呼び出し
+CACHE_HIT = "hit"
+CACHE_FUZZY = "fuzzy"
+CACHE_MISS = "miss"
+
+
+class CallMetric:
+    """
+    One LLM call, or one request served from a cache without a call. cache is CACHE_MISS for a call made after a cache lookup,
+    and CACHE_HIT or CACHE_FUZZY for a request served from the translation memory or the fuzzy memory.
+    """
+    def __init__(self, operation: str, model: str, wall_time: float, prompt_tokens: int=0, completion_tokens: int=0, cost: float=0.0, error_no: str="", cache: str=""):
+        self.timestamp = time.time()
+        self.operation = operation
+        self.model = model
+        self.wall_time = wall_time
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.cost = cost
+        self.error_no = error_no
+        self.cache = cache
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        return f"<CallMetric operation={self.operation} model={self.model} wall_time={self.wall_time:.3f} cost={self.cost} error_no={self.error_no}>"
+
+
+class OperationStats:
+    def __init__(self, max_samples: int):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.wall_time = 0.0
+        self.errors = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.served_from_cache = 0
+        self.aligned = 0
+        self.unaligned = 0
+        self.latencies = deque(maxlen=max_samples)
+
+
+class MetricsCollector:
+    """
+    In-process aggregation of LLM call metrics, exported in Prometheus text format or JSON lines.
+    If jsonl_path is set, every call, cache count and error is also appended to the file as a JSON line,
+    so that the metrics of other processes writing to the same file, e.g. job queue workers, can be loaded with load_json_lines.
+    """
+    def __init__(self, jsonl_path: str=METRICS_PATH, max_samples: int=10000):
+        self.jsonl_path = jsonl_path
+        self.max_samples = max_samples
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def record(self, metric: CallMetric):
+        """
+        Record a call. A request served from a cache is counted apart from the calls, and its wall time is not a call latency.
+        """
+        with self._lock:
+            self._write_json_line(metric.to_dict())
+            stats = self._get_stats(metric.operation)
+            if metric.cache in (CACHE_HIT, CACHE_FUZZY):
+                stats.served_from_cache += 1
+                return
+            stats.calls += 1
+            stats.prompt_tokens += metric.prompt_tokens
+            stats.completion_tokens += metric.completion_tokens
+            stats.cost += metric.cost
+            stats.wall_time += metric.wall_time
+            stats.latencies.append(metric.wall_time)
+            if metric.error_no:
+                stats.errors[metric.error_no] = stats.errors.get(metric.error_no, 0) + 1
+
+    def record_error(self, operation: str, error_no: str):
+        """
+        Count an error decided after the call, e.g. an output format error of the response.
+        """
+        if not error_no:
+            return
+        with self._lock:
+            self._write_json_line({"timestamp": time.time(), "operation": operation, "error_no": error_no})
+            stats = self._get_stats(operation)
+            stats.errors[error_no] = stats.errors.get(error_no, 0) + 1
+
+    def record_cache(self, operation: str, hits: int, misses: int):
+        with self._lock:
+            self._write_json_line({"timestamp": time.time(), "operation": operation, "cache_hits": hits, "cache_misses": misses})
+            stats = self._get_stats(operation)
+            stats.cache_hits += hits
+            stats.cache_misses += misses
+
+    def record_alignment(self, operation: str, aligned: int, unaligned: int):
+        """
+        Count the sentences of a count mismatch which were realigned locally, and those re-requested from the LLM.
+        """
+        with self._lock:
+            self._write_json_line({"timestamp": time.time(), "operation": operation, "aligned": aligned, "unaligned": unaligned})
+            stats = self._get_stats(operation)
+            stats.aligned += aligned
+            stats.unaligned += unaligned
+
+    def load_json_lines(self, path: str) -> "MetricsCollector":
+        """
+        Aggregate the JSON lines written by every process sharing the file into this collector.
+        started_at becomes the oldest timestamp of the file, so that calls_per_second covers the whole file.
+        """
+        if not os.path.exists(path):
+            return self
+        with open(path) as f:
+            for line in f:
+                try:
+                    data = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    # 他のプロセスが書き込み中の行
+                    continue
+                if "timestamp" in data:
+                    self.started_at = min(self.started_at, data["timestamp"])
+                if "wall_time" in data:
+                    timestamp = data.pop("timestamp", time.time())
+                    metric = CallMetric(**data)
+                    metric.timestamp = timestamp
+                    self.record(metric)
+                elif "cache_hits" in data:
+                    self.record_cache(data["operation"], data["cache_hits"], data["cache_misses"])
+                elif "aligned" in data:
+                    self.record_alignment(data["operation"], data["aligned"], data["unaligned"])
+                elif "error_no" in data:
+                    self.record_error(data["operation"], data["error_no"])
+        return self
+
+    def summary(self) -> list:
+        """
+        Summarize the metrics per operation.
+        """
+        with self._lock:
+            elapsed = max(time.time() - self.started_at, 1e-9)
+            rows = []
+            for operation, stats in sorted(self._operations.items()):
+                latencies = sorted(stats.latencies)
+                rows.append({
+                    "operation": operation,
+                    "calls": stats.calls,
+                    "calls_per_second": stats.calls / elapsed,
+                    "latency_p50": self._percentile(latencies, 0.5),
+                    "latency_p95": self._percentile(latencies, 0.95),
+                    "latency_p99": self._percentile(latencies, 0.99),
+                    "prompt_tokens": stats.prompt_tokens,
+                    "completion_tokens": stats.completion_tokens,
+                    "cost": stats.cost,
+                    "cost_per_call": stats.cost / stats.calls if stats.calls else 0.0,
+                    "errors": dict(stats.errors),
+                    "cache_hits": stats.cache_hits,
+                    "cache_misses": stats.cache_misses,
+                    "served_from_cache": stats.served_from_cache,
+                    "aligned": stats.aligned,
+                    "unaligned": stats.unaligned,
+                })
+            return rows
+
+    def latencies(self) -> list:
+        """
+        Latencies of the sampled calls of every operation, e.g. to compute percentiles over several operations.
+        """
+        with self._lock:
+            return [latency for stats in self._operations.values() for latency in stats.latencies]
+
+    def to_prometheus(self) -> str:
+        lines = []
+        counters = [("calls", "llm_calls_total"), ("prompt_tokens", "llm_prompt_tokens_total"), ("completion_tokens", "llm_completion_tokens_total"),
+                    ("cost", "llm_cost_dollars_total"), ("cache_hits", "llm_cache_hits_total"), ("cache_misses", "llm_cache_misses_total"),
+                    ("served_from_cache", "llm_served_from_cache_total"), ("aligned", "llm_aligned_sentences_total"),
+                    ("unaligned", "llm_unaligned_sentences_total")]
+        summary = self.summary()
+        for key, name in counters:
+            lines.append(f"# TYPE {name} counter")
+            for row in summary:
+                lines.append(f"{name}{{operation=\"{row['operation']}\"}} {row[key]}")
+        lines.append("# TYPE llm_errors_total counter")
+        for row in summary:
+            for error_no, count in sorted(row["errors"].items()):
+                lines.append(f"llm_errors_total{{operation=\"{row['operation']}\",error_no=\"{error_no}\"}} {count}")
+        lines.append("# TYPE llm_latency_seconds summary")
+        for row in summary:
+            for quantile, key in (("0.5", "latency_p50"), ("0.95", "latency_p95"), ("0.99", "latency_p99")):
+                lines.append(f"llm_latency_seconds{{operation=\"{row['operation']}\",quantile=\"{quantile}\"}} {row[key]}")
+        return "\n".join(lines) + "\n"
+
+    def to_json_lines(self) -> str:
+        return "".join(json.dumps(row) + "\n" for row in self.summary())
+
+    def reset(self, clear_file: bool=False):
+        """
+        Clear the metrics of this process. If clear_file is set, also truncate the JSON lines file shared with other processes.
+        """
+        with self._lock:
+            self._operations = {}
+            self.started_at = time.time()
+            if clear_file and self.jsonl_path and os.path.exists(self.jsonl_path):
+                open(self.jsonl_path, "w").close()
+
+    def _write_json_line(self, data: dict):
+        if self.jsonl_path:
+            with open(self.jsonl_path, "a") as f:
+                f.write(json.dumps(data) + "\n")
+
+    def _get_stats(self, operation: str) -> OperationStats:
+        if operation not in self._operations:
+            self._operations[operation] = OperationStats(self.max_samples)
+        return self._operations[operation]
+
+    def _percentile(self, values: list, q: float) -> float:
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+METRICS = MetricsCollector()
@@ -0,0 +1,47 @@
+import streamlit as st
+import pandas as pd
+from metrics import METRICS, METRICS_PATH, MetricsCollector
+
+
+def main():
+    st.title("Metrics")
+
+    collector = METRICS
+    if METRICS_PATH:
+        # ジョブキューのワーカーなど、同じファイルに書き込む他のプロセスの分も集計する
+        if st.sidebar.checkbox("Include other processes", value=True, help=f"Aggregated from {METRICS_PATH}"):
+            collector = MetricsCollector(jsonl_path="").load_json_lines(METRICS_PATH)
+    else:
+        st.caption("Only the calls of this process are shown. Set LLM_TRANSLATOR_METRICS_PATH to include background job workers.")
+
+    summary = collector.summary()
+    if not summary:
+        st.markdown("No LLM calls yet.")
+        return
+
+    df = pd.DataFrame(summary)
+    df["errors"] = df["errors"].apply(lambda errors: ", ".join(f"{k}: {v}" for k, v in sorted(errors.items())))
+    st.subheader("Per operation")
+    st.dataframe(df, hide_index=True)
+
+    col1, col2 = st.columns(2)
+    with col1:
+        st.subheader("Latency (seconds)")
+        st.bar_chart(df.set_index("operation")[["latency_p50", "latency_p95", "latency_p99"]])
+    with col2:
+        st.subheader("Cost (USD)")
+        st.bar_chart(df.set_index("operation")[["cost"]])
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.download_button("Download Prometheus", data=collector.to_prometheus(), file_name="metrics.prom", mime="text/plain")
+    with col2:
+        st.download_button("Download JSON lines", data=collector.to_json_lines(), file_name="metrics.jsonl", mime="application/jsonl")
+    with col3:
+        if st.button("Reset", help=f"Also clears {METRICS_PATH}" if METRICS_PATH else None):
+            METRICS.reset(clear_file=True)
+            st.rerun()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,24 @@
+import functools
+
 import streamlit as st
-import pandas as pd
-from component_template import generate_default_paramater
+from component_template import generate_default_paramater, generate_concurrency_paramater, generate_prefilter_paramater, generate_background_paramater, get_job_queue, show_jobs
 from const import JA, EN
-from llm_qa import QualityAssurance
+from job_queue import QA
+from llm_qa import QualityAssurance, COLUMNS, BATCH_COLUMNS
+from prefilter import Prefilter
+from result_pipeline import read_upload_chunks, ColumnarResult, iter_check_results
 
 def main():
     st.title("QA")
     st.sidebar.title("Options")
 
     model, max_chars, temperature = generate_default_paramater()
+    concurrency = generate_concurrency_paramater()
+    prefilter = generate_prefilter_paramater()
+    mode = st.sidebar.radio("Mode:", ("row", "batch"), horizontal=True)
+    chunksize = st.sidebar.number_input("Rows per chunk:", min_value=10, max_value=10000, value=500, step=10,
+                                        help="A background job saves its results and resumes per chunk.")
+    background = generate_background_paramater()
 
     col1, col2 = st.columns(2)
     # 左側のテキストエリアを配置
@@ -26,15 +36,55 @@ def main():
                               target_language=target_language,
                               model=model,
                               temperature=temperature,
-                              debug=True)
+                              debug=True,
+                              prefilter=Prefilter() if prefilter else None)
 
-        df = pd.read_csv(uploaded_file, header=None, delimiter="\t")
-        df.columns = ["source", "target"]
-        st.write(df)
-        if st.button("Check"):
+        # 大きなファイルでもメモリに載せきらないよう、先頭の chunk だけをプレビューする
+        columns = ["source", "target"]
+        st.write(next(read_upload_chunks(uploaded_file, columns, chunksize=chunksize), None))
+        if background and st.button("Submit"):
+            # ワーカーが chunk ごとに処理するので、タブを閉じても途中の結果は残る
+            params = {"source_language": source_language, "target_language": target_language, "model": model, "temperature": temperature,
+                      "prefilter": prefilter, "mode": mode, "concurrency": concurrency}
+            if prefilter:
+                # 長さの比の中央値はファイル全体で求め、どの chunk でも同じ基準で判定する
+                params["median_log_ratio"] = qa.prefilter.fit(read_upload_chunks(uploaded_file, columns, chunksize=chunksize), columns[1:]).median_log_ratio
+            get_job_queue().submit(QA, params, BATCH_COLUMNS if mode == "batch" else COLUMNS,
+                                   read_upload_chunks(uploaded_file, columns, chunksize=chunksize), name=uploaded_file.name)
+            st.success("Submitted.")
+        if not background and st.button("Check"):
+            if prefilter:
+                qa.prefilter.fit(read_upload_chunks(uploaded_file, columns, chunksize=chunksize), columns[1:])
+            if mode == "batch":
+                check = functools.partial(qa.acheck_translation_batch, concurrency=concurrency)
+                result = ColumnarResult(BATCH_COLUMNS)
+            else:
+                check = functools.partial(qa.acheck_translation, concurrency=concurrency)
+                result = ColumnarResult(COLUMNS)
+            progress = st.empty()
+            table = None
             with st.spinner("Checking..."):
-                res = qa.check_translation(translation_data=df)
-                st.write(res)
+                try:
+                    for chunk_df in iter_check_results(check, read_upload_chunks(uploaded_file, columns, chunksize=chunksize)):
+                        result.extend(chunk_df)
+                        if table is None:
+                            table = st.dataframe(chunk_df)
+                        else:
+                            table.add_rows(chunk_df)
+                        progress.caption(f"{len(result)} rows checked")
+                except ValueError as e:
+                    st.error(e)
+            st.caption(f"Cost: ${qa.total_cost:.4f} / {qa.total_tokens} tokens")
+            if prefilter:
+                st.caption(f"Decided locally: {qa.prefilter_report.decided} / {qa.prefilter_report.rows} rows ({qa.prefilter_report.saved_calls} LLM calls saved)")
+            if len(result) > 0:
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.download_button("Download CSV", result.to_csv(), file_name="qa.csv", mime="text/csv")
+                with col2:
+                    st.download_button("Download Parquet", result.to_parquet(), file_name="qa.parquet", mime="application/octet-stream")
+    if background:
+        show_jobs(QA, "qa")
 
 if __name__ == "__main__":
     main()
@@ -1,14 +1,25 @@
+import functools
+
 import streamlit as st
 import pandas as pd
-from component_template import generate_default_paramater
+from component_template import generate_default_paramater, generate_concurrency_paramater, generate_prefilter_paramater, generate_background_paramater, get_job_queue, show_jobs
 from const import JA, EN
-from llm_trans_compare import TranslationCompare
+from job_queue import COMPARE
+from llm_trans_compare import TranslationCompare, COLUMNS, NWAY_COLUMNS, win_rates
+from prefilter import Prefilter
+from result_pipeline import read_upload_chunks, ColumnarResult, iter_check_results
 
 def main():
     st.title("TransCompare")
     st.sidebar.title("Options")
 
     model, max_chars, temperature = generate_default_paramater()
+    concurrency = generate_concurrency_paramater()
+    prefilter = generate_prefilter_paramater()
+    mode = st.sidebar.radio("Mode:", ("pair", "n-way"), horizontal=True)
+    chunksize = st.sidebar.number_input("Rows per chunk:", min_value=10, max_value=10000, value=500, step=10,
+                                        help="A background job saves its results and resumes per chunk.")
+    background = generate_background_paramater()
 
     col1, col2 = st.columns(2)
     # 左側のテキストエリアを配置
@@ -26,19 +37,74 @@ def main():
                               target_language=target_language,
                               model=model,
                               temperature=temperature,
-                              debug=True)
+                              debug=True,
+                              prefilter=Prefilter() if prefilter else None)
         file_type = uploaded_file.name.split(".")[-1]
-        if file_type == "csv":
-            df = pd.read_csv(uploaded_file, header=None)
-        else:
-            df = pd.read_csv(uploaded_file, header=None, delimiter="\t")
-        df.columns = ["source", "target1", "target2"]
-        st.write(df)
-        if st.button("Check"):
+        delimiter = "," if file_type == "csv" else "\t"
+        columns = ["source", "target1", "target2"]
+        if mode == "n-way":
+            # 2 列目以降をそれぞれ翻訳エンジンの訳文とみなす
+            uploaded_file.seek(0)
+            engine_count = pd.read_csv(uploaded_file, header=None, delimiter=delimiter, nrows=1, dtype=str).shape[1] - 1
+            default_engines = ",".join(f"engine{i + 1}" for i in range(engine_count))
+            engines = [engine.strip() for engine in st.text_input("Engine names (comma separated)", value=default_engines).split(",")]
+            if len(engines) != engine_count or len(set(engines)) != len(engines) or "source" in engines:
+                st.markdown(f"## WARNING:\nPlease input {engine_count} unique engine names.")
+                return
+            columns = ["source"] + engines
+        # 大きなファイルでもメモリに載せきらないよう、先頭の chunk だけをプレビューする
+        st.write(next(read_upload_chunks(uploaded_file, columns, delimiter=delimiter, chunksize=chunksize), None))
+        if background and st.button("Submit"):
+            params = {"source_language": source_language, "target_language": target_language, "model": model, "temperature": temperature,
+                      "prefilter": prefilter, "mode": mode, "concurrency": concurrency}
+            if mode == "n-way":
+                params["engines"] = engines
+            if prefilter:
+                # 長さの比の中央値はファイル全体で求め、どの chunk でも同じ基準で判定する
+                params["median_log_ratio"] = tc.prefilter.fit(read_upload_chunks(uploaded_file, columns, delimiter=delimiter, chunksize=chunksize),
+                                                              columns[1:]).median_log_ratio
+            get_job_queue().submit(COMPARE, params, NWAY_COLUMNS if mode == "n-way" else COLUMNS,
+                                   read_upload_chunks(uploaded_file, columns, delimiter=delimiter, chunksize=chunksize), name=uploaded_file.name)
+            st.success("Submitted.")
+        if not background and st.button("Check"):
+            if prefilter:
+                tc.prefilter.fit(read_upload_chunks(uploaded_file, columns, delimiter=delimiter, chunksize=chunksize), columns[1:])
+            if mode == "n-way":
+                check = functools.partial(tc.acheck_translation_nway, engines=engines, concurrency=concurrency)
+                result = ColumnarResult(NWAY_COLUMNS)
+            else:
+                check = functools.partial(tc.acheck_translation, concurrency=concurrency)
+                result = ColumnarResult(COLUMNS)
+            progress = st.empty()
+            table = None
             with st.spinner("Checking..."):
-                res = tc.check_translation(translation_data=df)
-                print("TransCompare")
-                st.write(res)
+                try:
+                    for chunk_df in iter_check_results(check, read_upload_chunks(uploaded_file, columns, delimiter=delimiter, chunksize=chunksize)):
+                        result.extend(chunk_df)
+                        if table is None:
+                            table = st.dataframe(chunk_df)
+                        else:
+                            table.add_rows(chunk_df)
+                        progress.caption(f"{len(result)} rows checked")
+                except ValueError as e:
+                    st.error(e)
+            st.caption(f"Cost: ${tc.total_cost:.4f} / {tc.total_tokens} tokens")
+            if prefilter:
+                st.caption(f"Decided locally: {tc.prefilter_report.decided} / {tc.prefilter_report.rows} rows ({tc.prefilter_report.saved_calls} LLM calls saved)")
+            if mode == "n-way" and len(result) > 0:
+                st.subheader("Win rates")
+                st.write(win_rates(result.to_dataframe()))
+            if len(result) > 0:
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.download_button("Download CSV", result.to_csv(), file_name="trans_compare.csv", mime="text/csv")
+                with col2:
+                    st.download_button("Download Parquet", result.to_parquet(), file_name="trans_compare.parquet", mime="application/octet-stream")
+    if background:
+        result = show_jobs(COMPARE, "trans_compare")
+        if result is not None and list(result.columns) == NWAY_COLUMNS:
+            st.subheader("Win rates")
+            st.write(win_rates(result))
 
 if __name__ == "__main__":
     main()
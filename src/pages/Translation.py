@@ -1,8 +1,40 @@
+import io
+
 import streamlit as st
 import pandas as pd
-from llm_translator import Translator
-from const import JA, EN
-from component_template import generate_default_paramater
+from llm_fan_out import FanOutTranslator
+from llm_cascade import CascadeTranslator
+from document_translator import DocumentTranslator, HTML, MARKDOWN
+from const import JA, EN, LANGUAGES
+from component_template import generate_default_paramater, generate_cascade_paramater
+from translation_memory import TranslationMemory
+from fuzzy_memory import FuzzyTranslationMemory
+from glossary import Glossary
+from llm_registry import REGISTRY
+
+
+@st.cache_resource
+def get_translation_memory() -> TranslationMemory:
+    return TranslationMemory()
+
+
+@st.cache_resource
+def get_fuzzy_memory() -> FuzzyTranslationMemory:
+    return FuzzyTranslationMemory().load(get_translation_memory())
+
+
+@st.cache_resource
+def get_glossary(data: bytes, source_language: str, target_language: str) -> Glossary:
+    terms = pd.read_csv(io.BytesIO(data), header=None, delimiter="\t", names=["source", "target"], usecols=[0, 1], dtype=str, keep_default_na=False)
+    glossary = Glossary()
+    glossary.add_many(source_language, target_language, zip(terms["source"], terms["target"]))
+    return glossary
+
+
+def show_glossary_violations(translation):
+    if translation.glossary_violations:
+        st.markdown("## WARNING:\nSome glossary terms are not used in the translation.")
+        st.table(pd.DataFrame([[i + 1, s, t] for i, s, t in translation.glossary_violations], columns=["Sentence", "Source term", "Target term"]))
 
 
 def main():
@@ -10,11 +42,28 @@ def main():
     st.sidebar.title("Options")
 
     model, max_chars, temperature = generate_default_paramater()
-    format_type = st.sidebar.radio("Output format:", ("text", "table"), horizontal=True, index=1)
+    document_type = st.sidebar.radio("Input type:", ("plain", HTML, MARKDOWN), horizontal=True)
+    format_type = st.sidebar.radio("Output format:", ("text", "table"), horizontal=True, index=1, disabled=document_type != "plain")
+    streaming = st.sidebar.checkbox("Streaming", value=True)
+    cascade, min_accuracy, min_error = generate_cascade_paramater()
 
-    llm = Translator(debug=True)
+    fuzzy_reuse = st.sidebar.checkbox("Reuse similar translations", value=False)
+    fuzzy_reuse_threshold = st.sidebar.slider("Similarity threshold:", min_value=0.5, max_value=1.0, value=0.9, step=0.05, disabled=not fuzzy_reuse)
+    glossary_file = st.sidebar.file_uploader("Glossary (TSV: source term, target term)", type=["tsv", "txt"])
+
+    translation_memory = get_translation_memory()
+    translator_options = {"debug": True,
+                          "translation_memory": translation_memory,
+                          "fuzzy_memory": get_fuzzy_memory(),
+                          "fuzzy_reuse_threshold": fuzzy_reuse_threshold if fuzzy_reuse else None}
+    if cascade:
+        llm = CascadeTranslator(min_accuracy=min_accuracy, min_error=min_error, **translator_options)
+    else:
+        llm = FanOutTranslator(**translator_options)
     if "cost" not in st.session_state:
         st.session_state.cost = 0.0
+    if "previous_translation" not in st.session_state:
+        st.session_state.previous_translation = None
 
     col1, col2 = st.columns(2)
 
@@ -25,9 +74,21 @@ def main():
     # 右側のテキストエリアを配置
     with col2:
         target_language = st.selectbox("Target Language", (EN, JA))
+        # 追加の言語は同じリクエストでまとめて翻訳する
+        other_languages = st.multiselect("Also translate into", [language for language in LANGUAGES if language not in (source_language, target_language)],
+                                         disabled=cascade or format_type != "table" or document_type != "plain")
+
+    if glossary_file is not None:
+        llm.glossary = get_glossary(glossary_file.getvalue(), source_language, target_language)
 
     text = st.text_area("Input", height=300, max_chars=max_chars)
 
+    # 前回と同じ設定なら、前回の翻訳から変更のない文を再利用する
+    previous_key = (source_language, target_language, model, temperature)
+    previous = None
+    if st.session_state.previous_translation and st.session_state.previous_translation[0] == previous_key:
+        previous = st.session_state.previous_translation[1]
+
     translation = None
     if st.button("Translate"):
         if source_language == target_language:
@@ -36,14 +97,75 @@ def main():
             st.markdown("## WARNING:\nPlease input text.")
         else:
             with st.spinner("Translating ..."):
-                if format_type == "text":
+                if document_type != "plain":
+                    # マークアップは送らず、テキストだけを翻訳して元の構造に戻す
+                    translation = DocumentTranslator(llm).translate_document(source_language, target_language, text, document_type, model, temperature)
+                    if translation.error == "":
+                        st.code(translation.text, language=document_type)
+                        st.caption(f"{translation.segments} segments translated" +
+                                   (f", markup of {translation.broken_segments} segments could not be placed" if translation.broken_segments else ""))
+                        extension = "html" if document_type == HTML else "md"
+                        st.download_button(f"Download {extension}", data=translation.text, file_name=f"translation.{extension}", mime="text/plain")
+                    else:
+                        st.markdown(f"## WARNING:\n{translation.error}")
+                elif format_type == "text":
                     translation = llm.translate(source_language, target_language, text, model, temperature, format_type)
                     if translation.error == "":
                         st.write(translation.translated_texts)
                     else:
                         st.markdown(f"## WARNING:\n{translation.error}")
+                elif format_type == "table" and cascade:
+                    translation = llm.cascade_translate_by_sentence(source_language, target_language, text, temperature)
+                    if translation.error == "":
+                        pair = [[s, t] for s, t in zip(translation.source_texts, translation.translated_texts)]
+                        st.table(pair)
+                        st.caption(f"Escalated to GPT-4o: {len(translation.escalated_indexes)} / {len(translation.source_texts)} sentences")
+                        if translation.escalation_error:
+                            st.markdown(f"## WARNING:\nGPT-4o failed, so the GPT-3.5 translations are kept. {translation.escalation_error}")
+                        pd_pair = pd.DataFrame(pair, columns=["Source", "Target"])
+                        st.download_button("Download csv", data=pd_pair.to_csv(index=False), file_name="pair.csv", mime="text/csv")
+                    else:
+                        st.markdown(f"## WARNING:\n{translation.error}")
+                elif format_type == "table" and other_languages:
+                    target_languages = [target_language] + other_languages
+                    translations = llm.fan_out_translate_by_sentence(source_language, target_languages, text, model, temperature)
+                    translation = translations[target_language]
+                    for language in other_languages:
+                        translation.cost += translations[language].cost
+                    errors = [f"{language}: {translations[language].error}" for language in target_languages if translations[language].error != ""]
+                    if not errors:
+                        pd_pair = pd.DataFrame({"Source": translation.source_texts,
+                                                **{language: translations[language].translated_texts for language in target_languages}})
+                        st.table(pd_pair)
+                        st.download_button("Download csv", data=pd_pair.to_csv(index=False), file_name="pair.csv", mime="text/csv")
+                    else:
+                        st.markdown("## WARNING:\n" + "\n".join(errors))
+                elif format_type == "table" and streaming:
+                    placeholder = st.empty()
+                    table = placeholder.table(pd.DataFrame(columns=["Source", "Target"]))
+                    rows = []
+                    for item in llm.stream_translate_by_sentence(source_language, target_language, text, model, temperature, previous=previous):
+                        if not isinstance(item, tuple):
+                            translation = item
+                        elif item[0] == len(rows):
+                            rows.append(list(item[1:]))
+                            table.add_rows(pd.DataFrame([item[1:]], columns=["Source", "Target"]))
+                        else:
+                            # Realigned rows replace the rows already shown.
+                            rows[item[0]] = list(item[1:])
+                            table = placeholder.table(pd.DataFrame(rows, columns=["Source", "Target"]))
+                    if translation.error == "":
+                        pair = [[s, t] for s, t in zip(translation.source_texts, translation.translated_texts)]
+                        pd_pair = pd.DataFrame(pair, columns=["Source", "Target"])
+                        st.download_button("Download csv", data=pd_pair.to_csv(index=False), file_name="pair.csv", mime="text/csv")
+                    elif translation.error_no == "e0200":
+                        placeholder.empty()
+                        st.write("## WARNING:\nCould not output in table.")
+                        st.write("\n".join(translation.translated_texts))
+                    else:
+                        st.markdown(f"## WARNING:\n{translation.error}")
                 elif format_type == "table":
-                    translation = llm.translate_by_sentence(source_language, target_language, text, model, temperature)
+                    translation = llm.translate_by_sentence(source_language, target_language, text, model, temperature, previous=previous)
                     if translation.error == "":
                         pair = [[s, t] for s, t in zip(translation.source_texts, translation.translated_texts)]
                         st.table(pair)
@@ -55,6 +177,19 @@ def main():
                     else:
                         st.markdown(f"## WARNING:\n{translation.error}")
 
+    if translation:
+        st.session_state.cost += translation.cost
+        if document_type == "plain":
+            show_glossary_violations(translation)
+        if document_type == "plain" and format_type == "table" and not cascade and translation.error_no == "":
+            st.session_state.previous_translation = (previous_key, translation)
+    st.sidebar.caption(f"Total cost: ${st.session_state.cost:.4f}")
+    stats = translation_memory.stats()
+    st.sidebar.caption(f"Translation memory: {stats['hits']} hits / {stats['misses']} misses")
+    registry_stats = REGISTRY.stats()
+    st.sidebar.caption(f"Client reuse: {registry_stats['llm_hits']} hits / {registry_stats['llm_misses']} misses, "
+                       f"prompt reuse: {registry_stats['prompt_hits']} hits / {registry_stats['prompt_misses']} misses")
+
 
 if __name__ == "__main__":
     main()
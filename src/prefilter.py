@@ -0,0 +1,249 @@
+import re
+import threading
+import unicodedata
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+from metrics import METRICS
+
+NUMBER_PATTERN = re.compile(r"(\d+(?:[.,]\d+)*)")
+LOOSE_PATTERN = re.compile(r"[\W_]+")
+
+# 判定の理由。空文字列は LLM で評価する行
+EMPTY = "empty"
+UNTRANSLATED = "untranslated"
+NUMBER = "number"
+LENGTH = "length"
+SAME = "same"
+SIMILAR = "similar"
+LOCAL_REVIEW_PREFIX = "(ローカル判定) "
+LOCAL_REVIEWS = {EMPTY: "訳文が空です。",
+                 UNTRANSLATED: "原文が翻訳されていません。",
+                 NUMBER: "原文と訳文の数値が一致しません。",
+                 LENGTH: "原文に対する訳文の長さの比が他の行と大きく異なり、訳抜けまたは余分な訳の可能性があります。",
+                 SAME: "訳文が同一のため評価を省略しました。",
+                 SIMILAR: "訳文の差が軽微なため同等と判定しました。"}
+
+
+def chrf(hypothesis: str, reference: str, max_n: int=6, beta: float=2.0) -> float:
+    """
+    Character n-gram F-score (chrF) of the hypothesis against the reference, from 0 to 1. White space is ignored.
+    """
+    hypothesis = "".join(hypothesis.split())
+    reference = "".join(reference.split())
+    if hypothesis == reference:
+        return 1.0
+    precisions = []
+    recalls = []
+    for n in range(1, max_n + 1):
+        hypothesis_ngrams = Counter(hypothesis[i:i + n] for i in range(len(hypothesis) - n + 1))
+        reference_ngrams = Counter(reference[i:i + n] for i in range(len(reference) - n + 1))
+        if not hypothesis_ngrams or not reference_ngrams:
+            break
+        matches = sum((hypothesis_ngrams & reference_ngrams).values())
+        precisions.append(matches / sum(hypothesis_ngrams.values()))
+        recalls.append(matches / sum(reference_ngrams.values()))
+    if not precisions:
+        return 0.0
+    precision = sum(precisions) / len(precisions)
+    recall = sum(recalls) / len(recalls)
+    if precision + recall == 0:
+        return 0.0
+    return (1 + beta ** 2) * precision * recall / (beta ** 2 * precision + recall)
+
+
+def chrf_upper_bound(hypothesis_lengths: np.ndarray, reference_lengths: np.ndarray, max_n: int=6, beta: float=2.0) -> np.ndarray:
+    """
+    Upper bound of chrF from the lengths of the texts without white space alone, for many pairs at once.
+    An n-gram can match at most as many times as the shorter text has n-grams.
+    """
+    hypothesis_lengths = np.asarray(hypothesis_lengths, dtype=float)
+    reference_lengths = np.asarray(reference_lengths, dtype=float)
+    orders = np.minimum(max_n, np.minimum(hypothesis_lengths, reference_lengths))
+    precision = np.zeros(len(hypothesis_lengths))
+    recall = np.zeros(len(hypothesis_lengths))
+    for n in range(1, max_n + 1):
+        valid = orders >= n
+        hypothesis_ngrams = np.maximum(hypothesis_lengths - n + 1, 1)
+        reference_ngrams = np.maximum(reference_lengths - n + 1, 1)
+        matches = np.minimum(hypothesis_ngrams, reference_ngrams)
+        precision += np.where(valid, matches / hypothesis_ngrams, 0.0)
+        recall += np.where(valid, matches / reference_ngrams, 0.0)
+    precision = np.where(orders > 0, precision / np.maximum(orders, 1), 0.0)
+    recall = np.where(orders > 0, recall / np.maximum(orders, 1), 0.0)
+    denominator = beta ** 2 * precision + recall
+    bound = np.where(denominator > 0, (1 + beta ** 2) * precision * recall / np.where(denominator > 0, denominator, 1), 0.0)
+    return np.where((hypothesis_lengths == 0) & (reference_lengths == 0), 1.0, bound)
+
+
+def to_text(value) -> str:
+    """
+    Convert a cell to text. A missing value (None or NaN) is an empty text.
+    An integral float is written as an integer, as a numeric column with a missing value is read as floats.
+    """
+    if value is None or (isinstance(value, float) and value != value):
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _normalize(texts) -> pd.Series:
+    return pd.Series(list(texts), dtype=object).fillna("").map(lambda text: unicodedata.normalize("NFKC", str(text)).strip())
+
+
+def _number_counts(texts: pd.Series) -> pd.Series:
+    """
+    Count of each number in each text, indexed by (row, number).
+    Numbers are compared by value, so that "05" and "5" or "3.0" and "3" are the same number.
+    """
+    numbers = texts.str.extractall(NUMBER_PATTERN)[0].str.replace(",", "", regex=False)
+    # 2024.05.01 のようにピリオドが複数ある数値は、年月日などの並びとして分ける
+    numbers = numbers.map(lambda number: number.split(".") if number.count(".") > 1 else [number]).explode()
+    numbers = (numbers.str.replace(r"^0+(?=\d)", "", regex=True)
+                      .str.replace(r"(\.\d*?)0+$", r"\1", regex=True)
+                      .str.replace(r"\.$", "", regex=True))
+    return numbers.groupby([numbers.index.get_level_values(0), numbers.to_numpy()]).size()
+
+
+def _number_mismatches(sources: pd.Series, targets: pd.Series) -> np.ndarray:
+    differences = _number_counts(sources).sub(_number_counts(targets), fill_value=0)
+    rows = differences.index.get_level_values(0)
+    source_extra = (differences > 0).groupby(rows).any().reindex(sources.index, fill_value=False)
+    target_extra = (differences < 0).groupby(rows).any().reindex(sources.index, fill_value=False)
+    # 月名や漢数字に訳された数値で誤判定しないよう、両方に相手にない数値がある場合だけ不一致とする
+    return (source_extra & target_extra).to_numpy(dtype=bool)
+
+
+def _log_length_ratios(sources: pd.Series, targets: pd.Series) -> np.ndarray:
+    return np.log(np.maximum(targets.str.len().to_numpy(), 1) / np.maximum(sources.str.len().to_numpy(), 1))
+
+
+class PrefilterReport:
+    """
+    Counts of the rows decided locally and of the rows sent to the LLM.
+    """
+    def __init__(self):
+        self.rows = 0
+        self.decided = 0
+        self.reasons = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, operation: str, reasons: list):
+        """
+        Count the reasons of the rows, where "" is a row sent to the LLM. Local verdicts are recorded as cache hits of the operation.
+        """
+        METRICS.record_cache(operation, sum(1 for reason in reasons if reason), sum(1 for reason in reasons if not reason))
+        with self._lock:
+            self.rows += len(reasons)
+            for reason in reasons:
+                if reason:
+                    self.decided += 1
+                    self.reasons[reason] += 1
+
+    @property
+    def saved_calls(self) -> int:
+        return self.decided
+
+    def __repr__(self):
+        return f"<PrefilterReport rows={self.rows} decided={self.decided} reasons={dict(self.reasons)}>"
+
+
+class Prefilter:
+    """
+    Reference-free local checks run over the whole DataFrame before any LLM call.
+
+    A translation fails locally if it is empty, left untranslated, changes a number of the source,
+    or its length ratio to the source is more than max_length_ratio times off the median ratio of the data.
+    The median is used as the expected ratio, so the check works for any language pair.
+    Call fit over the whole file first, so that every chunk of it is checked against the same median;
+    otherwise the median of each call is used.
+    Two translations compared with each other tie locally if their chrF is tie_chrf or more.
+    """
+    def __init__(self, max_length_ratio: float=4.0, min_length: int=20, min_rows: int=5, tie_chrf: float=0.97, median_log_ratio: float=None):
+        self.max_length_ratio = max_length_ratio
+        self.min_length = min_length
+        self.min_rows = min_rows
+        self.tie_chrf = tie_chrf
+        self.median_log_ratio = median_log_ratio
+        self.fitted = median_log_ratio is not None
+
+    def fit(self, chunks, target_columns: list, source_column: str="source") -> "Prefilter":
+        """
+        Compute the median length ratio of the whole data in one pass over its chunk DataFrames, e.g. the chunks of an upload.
+        Every translation column counts, so all the engines of a comparison share the median.
+        """
+        log_ratios = []
+        for chunk in chunks:
+            sources = _normalize(chunk[source_column])
+            for column in target_columns:
+                targets = _normalize(chunk[column])
+                eligible = (sources.str.len().to_numpy() >= self.min_length) & (targets.str.len().to_numpy() > 0)
+                log_ratios.append(_log_length_ratios(sources, targets)[eligible])
+        log_ratios = np.concatenate(log_ratios) if log_ratios else np.array([])
+        self.median_log_ratio = float(np.median(log_ratios)) if len(log_ratios) >= self.min_rows else None
+        self.fitted = True
+        return self
+
+    def check_translations(self, sources, targets) -> list:
+        """
+        Return the reason of the local failure of each translation, or "" if the translation needs the LLM.
+        """
+        sources = _normalize(sources)
+        targets = _normalize(targets)
+        source_lengths = sources.str.len().to_numpy()
+        target_lengths = targets.str.len().to_numpy()
+
+        empty = target_lengths == 0
+        loose_sources = sources.str.replace(LOOSE_PATTERN, "", regex=True).str.casefold()
+        loose_targets = targets.str.replace(LOOSE_PATTERN, "", regex=True).str.casefold()
+        untranslated = ((loose_sources == loose_targets) & (source_lengths >= self.min_length)).to_numpy()
+        number = _number_mismatches(sources, targets)
+
+        length = np.zeros(len(sources), dtype=bool)
+        eligible = (source_lengths >= self.min_length) & ~empty
+        median_log_ratio = self.median_log_ratio
+        if not self.fitted and eligible.sum() >= self.min_rows:
+            median_log_ratio = np.median(_log_length_ratios(sources, targets)[eligible])
+        if median_log_ratio is not None:
+            length = eligible & (np.abs(_log_length_ratios(sources, targets) - median_log_ratio) > np.log(self.max_length_ratio))
+
+        reasons = np.full(len(sources), "", dtype=object)
+        # 優先度の低い順に上書きする
+        reasons[length] = LENGTH
+        reasons[number] = NUMBER
+        reasons[untranslated] = UNTRANSLATED
+        reasons[empty] = EMPTY
+        return reasons.tolist()
+
+    def compare_translations(self, sources, targets1, targets2) -> list:
+        """
+        Return the local verdict of each pair of translations: (label, reason) where the label is
+        0 for a tie, 1 if the translation 1 is better and 2 if the translation 2 is better, or None if the pair needs the LLM.
+        """
+        reasons1 = np.array(self.check_translations(sources, targets1), dtype=object)
+        reasons2 = np.array(self.check_translations(sources, targets2), dtype=object)
+        targets1 = _normalize(targets1)
+        targets2 = _normalize(targets2)
+        labels = np.full(len(targets1), None, dtype=object)
+        reasons = np.full(len(targets1), "", dtype=object)
+        failed1 = reasons1 != ""
+        failed2 = reasons2 != ""
+        only1 = failed1 & ~failed2
+        only2 = failed2 & ~failed1
+        labels[only1], reasons[only1] = 2, reasons1[only1]
+        labels[only2], reasons[only2] = 1, reasons2[only2]
+
+        # chrF は長さから求めた上限が閾値に届く組だけ計算する
+        candidates = ~failed1 & ~failed2
+        loose_lengths1 = targets1.str.replace(r"\s+", "", regex=True).str.len().to_numpy()
+        loose_lengths2 = targets2.str.replace(r"\s+", "", regex=True).str.len().to_numpy()
+        candidates &= chrf_upper_bound(loose_lengths1, loose_lengths2, beta=1.0) >= self.tie_chrf
+        for i in np.flatnonzero(candidates):
+            if chrf(targets1[i], targets2[i], beta=1.0) >= self.tie_chrf:
+                labels[i], reasons[i] = 0, SIMILAR
+
+        same = (targets1 == targets2).to_numpy()
+        labels[same], reasons[same] = 0, SAME
+        return list(zip(labels.tolist(), reasons.tolist()))
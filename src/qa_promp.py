@@ -21,7 +21,8 @@ SYSTEM_TEMPLATE = (
 "```\n"
 "### 出力例\n"
 "```json\n"
-"{exsample}\n"
+"{exsample}"
+"```\n"
 )
 
 EXSAMPLE = (
@@ -32,7 +33,7 @@ EXSAMPLE = (
 "   \"issuePoint\": \"\""
 "  },"
 "  {"
-"    \"uid\": 2,"
+"    \"id\": 2,"
 "    \"accuracy\": false,"
 "    \"omission\": false,"
 "    \"numMatch\": true,"
@@ -0,0 +1,210 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+DEFAULT_RATE_LIMIT_PATH = os.environ.get("LLM_TRANSLATOR_RATE_LIMIT_PATH", os.path.join(".cache", "rate_limit.sqlite3"))
+REQUESTS_PER_MINUTE = int(os.environ.get("LLM_TRANSLATOR_RPM", "0"))
+TOKENS_PER_MINUTE = int(os.environ.get("LLM_TRANSLATOR_TPM", "0"))
+
+# 値が小さいほど優先度が高い
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute token buckets shared across processes through SQLite.
+
+    A request waits until both buckets have room and no request of a higher priority is waiting,
+    so that interactive requests go ahead of batch QA and Compare work.
+    When the upstream returns 429, every process backs off; the backoff doubles on consecutive 429s
+    and halves on each successful call. A budget of 0 disables that bucket, and the limiter is a no-op if both are 0.
+    """
+    def __init__(self, path: str=DEFAULT_RATE_LIMIT_PATH, requests_per_minute: int=REQUESTS_PER_MINUTE, tokens_per_minute: int=TOKENS_PER_MINUTE,
+                 max_backoff: float=60.0, poll_interval: float=0.2, waiter_timeout: float=30.0):
+        self.path = path
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self.waiter_timeout = waiter_timeout
+        self.waits = 0
+        self.wait_time = 0.0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.requests_per_minute > 0 or self.tokens_per_minute > 0
+
+    def acquire(self, tokens: int, priority: int=PRIORITY_INTERACTIVE):
+        """
+        Block until a request of `tokens` tokens is allowed.
+        """
+        if not self.enabled:
+            return
+        waiter_id = uuid.uuid4().hex
+        start = None
+        while True:
+            wait = self._try_acquire(waiter_id, tokens, priority)
+            if wait <= 0:
+                break
+            start = start or time.perf_counter()
+            time.sleep(min(wait, self.poll_interval))
+        if start is not None:
+            self._add_wait(start)
+
+    async def aacquire(self, tokens: int, priority: int=PRIORITY_INTERACTIVE):
+        """
+        Async version of acquire. The SQLite transactions run in a thread, so that they do not block the event loop.
+        """
+        if not self.enabled:
+            return
+        waiter_id = uuid.uuid4().hex
+        start = None
+        while True:
+            wait = await asyncio.to_thread(self._try_acquire, waiter_id, tokens, priority)
+            if wait <= 0:
+                break
+            start = start or time.perf_counter()
+            await asyncio.sleep(min(wait, self.poll_interval))
+        if start is not None:
+            self._add_wait(start)
+
+    def settle(self, estimated_tokens: int, actual_tokens: int, is_success: bool=True):
+        """
+        Give back the tokens reserved beyond the actual usage of a call. A successful call halves the backoff.
+        The usage of a successful call without a reported usage is unknown, so nothing is given back for it.
+        """
+        if not self.enabled:
+            return
+        refund = estimated_tokens - actual_tokens if self.tokens_per_minute > 0 and (actual_tokens > 0 or not is_success) else 0
+        with self._transaction() as conn:
+            conn.execute("UPDATE bucket SET tokens = MIN(?, tokens + ?), backoff = backoff / ? WHERE id = 0",
+                         (self.tokens_per_minute, max(0, refund), 2 if is_success else 1))
+
+    async def asettle(self, estimated_tokens: int, actual_tokens: int, is_success: bool=True):
+        """
+        Async version of settle.
+        """
+        if self.enabled:
+            await asyncio.to_thread(self.settle, estimated_tokens, actual_tokens, is_success)
+
+    def report_rate_limited(self, retry_after: float=0.0):
+        """
+        Block every process for the backoff, which doubles on consecutive 429s.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.rate_limited += 1
+        with self._transaction() as conn:
+            backoff = conn.execute("SELECT backoff FROM bucket WHERE id = 0").fetchone()[0]
+            backoff = min(self.max_backoff, max(1.0, backoff * 2))
+            conn.execute("UPDATE bucket SET backoff = ?, blocked_until = MAX(blocked_until, ?) WHERE id = 0",
+                         (backoff, time.time() + max(backoff, retry_after)))
+
+    async def areport_rate_limited(self, retry_after: float=0.0):
+        """
+        Async version of report_rate_limited.
+        """
+        if self.enabled:
+            await asyncio.to_thread(self.report_rate_limited, retry_after)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"waits": self.waits, "wait_time": self.wait_time, "rate_limited": self.rate_limited}
+
+    def _try_acquire(self, waiter_id: str, tokens: int, priority: int) -> float:
+        """
+        Take a request and the tokens from the buckets. Return 0 on success, or the seconds to wait before retrying.
+        """
+        now = time.time()
+        # A request larger than the whole budget waits for a full bucket instead of forever.
+        tokens = min(tokens, self.tokens_per_minute) if self.tokens_per_minute > 0 else 0
+        with self._transaction() as conn:
+            requests, bucket_tokens, updated_at, blocked_until = conn.execute(
+                "SELECT requests, tokens, updated_at, blocked_until FROM bucket WHERE id = 0").fetchone()
+            elapsed = max(0.0, now - updated_at)
+            requests = min(self.requests_per_minute, requests + elapsed * self.requests_per_minute / 60)
+            bucket_tokens = min(self.tokens_per_minute, bucket_tokens + elapsed * self.tokens_per_minute / 60)
+            conn.execute("DELETE FROM waiter WHERE heartbeat < ?", (now - self.waiter_timeout,))
+            is_preceded = conn.execute("SELECT 1 FROM waiter WHERE priority < ? LIMIT 1", (priority,)).fetchone() is not None
+            wait = 0.0
+            if blocked_until > now:
+                wait = blocked_until - now
+            elif is_preceded:
+                wait = self.poll_interval
+            else:
+                if self.requests_per_minute > 0 and requests < 1:
+                    wait = max(wait, (1 - requests) * 60 / self.requests_per_minute)
+                if self.tokens_per_minute > 0 and bucket_tokens < tokens:
+                    wait = max(wait, (tokens - bucket_tokens) * 60 / self.tokens_per_minute)
+            if wait <= 0:
+                requests -= 1 if self.requests_per_minute > 0 else 0
+                bucket_tokens -= tokens
+                conn.execute("DELETE FROM waiter WHERE id = ?", (waiter_id,))
+            else:
+                conn.execute("INSERT OR REPLACE INTO waiter VALUES (?, ?, ?)", (waiter_id, priority, now))
+            conn.execute("UPDATE bucket SET requests = ?, tokens = ?, updated_at = ? WHERE id = 0", (requests, bucket_tokens, now))
+        return wait
+
+    def _add_wait(self, start: float):
+        with self._lock:
+            self.waits += 1
+            self.wait_time += time.perf_counter() - start
+
+    def _transaction(self):
+        with self._lock:
+            if self._conn is None:
+                self._conn = self._connect()
+        return _Transaction(self._conn, self._lock)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.path != ":memory:" and os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30, isolation_level=None)
+        conn.execute("CREATE TABLE IF NOT EXISTS bucket ("
+                     "id INTEGER PRIMARY KEY,"
+                     "requests REAL NOT NULL,"
+                     "tokens REAL NOT NULL,"
+                     "updated_at REAL NOT NULL,"
+                     "blocked_until REAL NOT NULL,"
+                     "backoff REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS waiter ("
+                     "id TEXT PRIMARY KEY,"
+                     "priority INTEGER NOT NULL,"
+                     "heartbeat REAL NOT NULL)")
+        conn.execute("INSERT OR IGNORE INTO bucket VALUES (0, ?, ?, ?, 0, 0)", (self.requests_per_minute, self.tokens_per_minute, time.time()))
+        return conn
+
+
+class _Transaction:
+    """
+    BEGIN IMMEDIATE transaction, so that the read-modify-write of the buckets is atomic across processes.
+    """
+    def __init__(self, conn: sqlite3.Connection, lock: threading.Lock):
+        self.conn = conn
+        self.lock = lock
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.lock.acquire()
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+        except Exception:
+            self.lock.release()
+            raise
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.lock.release()
+
+
+RATE_LIMITER = RateLimiter()
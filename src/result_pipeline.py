@@ -0,0 +1,63 @@
+import io
+
+import pandas as pd
+from llm import run_coroutine
+
+
+def read_upload_chunks(uploaded_file, columns: list, delimiter: str="\t", chunksize: int=500):
+    """
+    Read an uploaded TSV/CSV file without a header in chunks of DataFrames with the given columns.
+    Empty cells are read as empty strings.
+    """
+    uploaded_file.seek(0)
+    for chunk in pd.read_csv(uploaded_file, header=None, delimiter=delimiter, names=columns, usecols=range(len(columns)),
+                             dtype=str, keep_default_na=False, chunksize=chunksize):
+        yield chunk
+
+
+class ColumnarResult:
+    """
+    Accumulate result rows column by column, so that appending is O(1) per row.
+    """
+    def __init__(self, columns: list):
+        self.columns = columns
+        self.data = {column: [] for column in columns}
+
+    def extend(self, df: pd.DataFrame):
+        for column in self.columns:
+            self.data[column].extend(df[column].tolist())
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame(self.data, columns=self.columns)
+
+    def to_csv(self) -> str:
+        return self.to_dataframe().to_csv(index=False)
+
+    def to_parquet(self) -> bytes:
+        buffer = io.BytesIO()
+        df = self.to_dataframe()
+        # Result columns mix numbers, None and strings, which Parquet cannot store in one column.
+        for column in df.columns:
+            if df[column].dtype == object:
+                df[column] = df[column].map(lambda value: None if value is None or value != value else str(value))
+        df.to_parquet(buffer, index=False)
+        return buffer.getvalue()
+
+    def __len__(self) -> int:
+        return len(self.data[self.columns[0]]) if self.columns else 0
+
+
+def iter_check_results(check, chunks):
+    """
+    Run `check`, a coroutine function taking a DataFrame such as QualityAssurance.acheck_translation, on each chunk,
+    and yield the result DataFrame of each chunk as it completes.
+    All the chunks run on the process-wide event loop, so they share one async client and its connections.
+    """
+    for chunk in chunks:
+        if chunk.empty:
+            continue
+        result = run_coroutine(check(chunk))
+        if isinstance(result, tuple):
+            # (False, error message) of the input validation.
+            raise ValueError(result[1])
+        yield result
@@ -0,0 +1,117 @@
+import math
+import re
+
+from const import JA
+from sentence_splitter import EnglishSplitter
+
+# Gale-Church の bead の事前確率。2-2 は 1-1 二つで表す
+BEAD_PRIORS = {(1, 1): 0.89, (1, 2): 0.0445, (2, 1): 0.0445, (1, 0): 0.005, (0, 1): 0.005}
+# Variance of the target length per source character, for a length ratio of 1.
+VARIANCE = 6.8
+JAPANESE_BOUNDARY_PATTERN = re.compile(r"(?<=[。！？!?])")
+
+
+def text_length(text: str) -> int:
+    return len("".join(text.split()))
+
+
+def norm_cdf(x: float) -> float:
+    return (1 + math.erf(x / math.sqrt(2))) / 2
+
+
+class SentenceAligner:
+    """
+    Length-based sentence aligner in the style of Gale and Church (1993).
+
+    It aligns the translated texts returned for a list of source sentences when the model merged or split some of them,
+    with 1:1, 1:2, 2:1, 1:0 and 0:1 beads found by dynamic programming over the character lengths.
+    The expected length ratio is that of the whole list, so it adapts to Japanese and English as well as to the style of the text.
+    """
+    def __init__(self, variance: float=VARIANCE, bead_priors: dict=BEAD_PRIORS):
+        self.variance = variance
+        self.bead_priors = bead_priors
+        self.english_splitter = EnglishSplitter()
+
+    def align(self, source_texts: list, target_texts: list) -> list:
+        """
+        Return the beads as (source indexes, target indexes) pairs in order.
+        """
+        source_lengths = [text_length(text) for text in source_texts]
+        target_lengths = [text_length(text) for text in target_texts]
+        ratio = min(5.0, max(0.2, (sum(target_lengths) or 1) / (sum(source_lengths) or 1)))
+        n, m = len(source_lengths), len(target_lengths)
+        costs = [[math.inf] * (m + 1) for _ in range(n + 1)]
+        backs = [[None] * (m + 1) for _ in range(n + 1)]
+        costs[0][0] = 0.0
+        for i in range(n + 1):
+            for j in range(m + 1):
+                if costs[i][j] == math.inf:
+                    continue
+                for (di, dj), prior in self.bead_priors.items():
+                    if i + di > n or j + dj > m:
+                        continue
+                    cost = costs[i][j] - math.log(prior) + self._match_cost(sum(source_lengths[i:i + di]), sum(target_lengths[j:j + dj]), ratio)
+                    if cost < costs[i + di][j + dj]:
+                        costs[i + di][j + dj] = cost
+                        backs[i + di][j + dj] = (di, dj)
+        beads = []
+        i, j = n, m
+        while i > 0 or j > 0:
+            di, dj = backs[i][j]
+            beads.append((list(range(i - di, i)), list(range(j - dj, j))))
+            i, j = i - di, j - dj
+        return beads[::-1]
+
+    def repair(self, source_texts: list, target_texts: list, target_language: str) -> list:
+        """
+        Return one translated text per source text. A source text which cannot be aligned is None, to be re-requested:
+        one with no translation, one next to an extra translated text, or two merged into a text that cannot be split at a sentence boundary.
+        """
+        repaired = [None] * len(source_texts)
+        invalid = set()
+        last_index = -1
+        for source_indexes, target_indexes in self.align(source_texts, target_texts):
+            targets = [target_texts[j] for j in target_indexes]
+            if not source_indexes:
+                # 余分な訳文がどの文の一部か分からないので、直前の文 (先頭なら次の文) を訳し直す
+                invalid.add(max(0, last_index))
+                continue
+            if len(source_indexes) == 1 and targets:
+                separator = "" if target_language == JA else " "
+                repaired[source_indexes[0]] = separator.join(targets)
+            elif len(source_indexes) == 2:
+                split_texts = self._split_target(targets[0], [source_texts[i] for i in source_indexes], target_language)
+                for i, text in zip(source_indexes, split_texts):
+                    repaired[i] = text
+            last_index = source_indexes[-1]
+        for i in invalid:
+            if i < len(repaired):
+                repaired[i] = None
+        return repaired
+
+    def _match_cost(self, source_length: int, target_length: int, ratio: float) -> float:
+        if source_length == 0 and target_length == 0:
+            return 0.0
+        mean = (source_length + target_length / ratio) / 2
+        delta = (target_length - source_length * ratio) / math.sqrt(max(mean, 1.0) * self.variance * ratio)
+        return -math.log(max(2 * (1 - norm_cdf(abs(delta))), 1e-12))
+
+    def _split_target(self, target_text: str, source_texts: list, target_language: str) -> list:
+        """
+        Split a translated text merged from two source texts at the sentence boundary closest to the length ratio of the sources.
+        """
+        japanese_sentences = [sentence for sentence in JAPANESE_BOUNDARY_PATTERN.split(target_text) if sentence.strip()]
+        english_sentences = self.english_splitter.split(target_text)
+        # 訳文に他の言語の句読点が混ざっていても分割できるよう、もう一方の規則も試す
+        if target_language == JA:
+            sentences = japanese_sentences if len(japanese_sentences) >= 2 else english_sentences
+            separator = ""
+        else:
+            sentences = english_sentences if len(english_sentences) >= 2 else japanese_sentences
+            separator = " "
+        if len(sentences) < 2:
+            return [None, None]
+        share = text_length(source_texts[0]) / max(1, sum(text_length(text) for text in source_texts))
+        total = text_length(target_text)
+        best = min(range(1, len(sentences)), key=lambda k: abs(sum(text_length(s) for s in sentences[:k]) / max(1, total) - share))
+        return [separator.join(sentences[:best]).strip(), separator.join(sentences[best:]).strip()]
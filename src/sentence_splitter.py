@@ -0,0 +1,177 @@
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from const import EN, JA
+
+ABBREVIATIONS = {
+    "mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "mt", "vs", "etc", "e.g", "i.e", "cf", "al", "fig", "no",
+    "vol", "inc", "ltd", "co", "corp", "dept", "approx", "est", "jan", "feb", "mar", "apr", "jun", "jul", "aug",
+    "sep", "sept", "oct", "nov", "dec", "u.s", "u.k", "a.m", "p.m",
+}
+# Abbreviations that often end a sentence too, e.g. "... and so on, etc. The next sentence".
+SENTENCE_END_ABBREVIATIONS = {"etc", "inc", "ltd", "co", "corp", "u.s", "u.k", "a.m", "p.m", "al"}
+BOUNDARY_PATTERN = re.compile(r"([.!?…]+)([\"'”’)\]]*)(\s+)")
+
+_bunkai = None
+_bunkai_lock = threading.Lock()
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def get_bunkai():
+    """
+    Get the Bunkai of this process. It is loaded on first use and shared by all the splitters and sessions.
+    """
+    global _bunkai
+    if _bunkai is None:
+        with _bunkai_lock:
+            if _bunkai is None:
+                from bunkai import Bunkai
+                _bunkai = Bunkai()
+    return _bunkai
+
+
+def split_japanese(text: str) -> list:
+    return [sentence for sentence in get_bunkai()(text) if sentence.strip() != ""]
+
+
+def get_process_pool(max_workers: int) -> ProcessPoolExecutor:
+    """
+    Get the process pool for splitting large Japanese texts. Workers are spawned, not forked, as the parent runs threads.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"), initializer=get_bunkai)
+        return _process_pool
+
+
+def group_paragraphs(text: str, group_size: int) -> list:
+    """
+    Group the lines of the text into pieces of about group_size characters. Line breaks are always sentence boundaries, so the pieces split the same.
+    Blank lines stay in the group before them, as Bunkai keeps a run of line breaks in the sentence before it.
+    """
+    groups = []
+    group = ""
+    for line in text.splitlines(keepends=True):
+        if group == "" and groups and line.strip() == "":
+            groups[-1] += line
+            continue
+        group += line
+        if len(group) >= group_size:
+            groups.append(group)
+            group = ""
+    if group:
+        groups.append(group)
+    return groups
+
+
+class SentenceSplitter:
+    """
+    Interface of the sentence splitters.
+    """
+    def split(self, text: str) -> list:
+        """
+        Split text into sentences. Empty sentences are excluded.
+        """
+        return [sentence for sentence, _ in self.split_with_ambiguity(text)]
+
+    def split_with_ambiguity(self, text: str) -> list:
+        """
+        Split text into (sentence, is_ambiguous) pairs.
+        is_ambiguous is True if the rules could not decide a boundary in the sentence.
+        """
+        raise NotImplementedError
+
+
+class JapaneseSplitter(SentenceSplitter):
+    """
+    Bunkai-based Japanese sentence splitter.
+    Bunkai slows down superlinearly on long texts, so the text is split paragraph by paragraph,
+    and texts of parallel_threshold characters or more are split across a process pool.
+    """
+    def __init__(self, parallel_threshold: int=20000, group_size: int=2000, max_workers: int=None):
+        self.parallel_threshold = parallel_threshold
+        self.group_size = group_size
+        self.max_workers = max_workers or os.cpu_count() or 1
+
+    def split_with_ambiguity(self, text: str) -> list:
+        groups = group_paragraphs(text, self.group_size)
+        if len(text) >= self.parallel_threshold and self.max_workers > 1 and len(groups) > 1:
+            results = get_process_pool(self.max_workers).map(split_japanese, groups)
+        else:
+            results = map(split_japanese, groups)
+        return [(sentence, False) for sentences in results for sentence in sentences]
+
+
+class EnglishSplitter(SentenceSplitter):
+    """
+    Rule-based English sentence splitter.
+    Line breaks are always boundaries. Periods in abbreviations, initials and decimals are not.
+    """
+    def split_with_ambiguity(self, text: str) -> list:
+        sentences = []
+        for line in text.split("\n"):
+            if line.strip() != "":
+                sentences += self._split_line(line.strip())
+        return sentences
+
+    def _split_line(self, line: str) -> list:
+        sentences = []
+        start = 0
+        is_ambiguous = False
+        for match in BOUNDARY_PATTERN.finditer(line):
+            end = match.end(2)
+            next_text = line[match.end():]
+            if next_text == "":
+                break
+            decision = self._decide(line[start:match.start(1)], match.group(1), next_text)
+            if decision is None:
+                is_ambiguous = True
+                continue
+            if decision:
+                sentences.append((line[start:end], is_ambiguous))
+                start = match.end()
+                is_ambiguous = False
+        if start < len(line):
+            sentences.append((line[start:], is_ambiguous))
+        return sentences
+
+    def _decide(self, before: str, punctuation: str, next_text: str):
+        """
+        Decide whether the punctuation is a sentence boundary. Return None if it is ambiguous.
+        """
+        next_char = next_text[0]
+        starts_sentence = next_char.isupper() or next_char.isdigit() or next_char in "\"'“‘(["
+        if punctuation in ("!", "?") or punctuation.endswith(("!", "?")):
+            return True if starts_sentence else None
+        words = before.split()
+        last_word = words[-1].lower().strip("\"'(“‘") if words else ""
+        if punctuation == ".":
+            if last_word in ABBREVIATIONS:
+                if last_word in SENTENCE_END_ABBREVIATIONS and starts_sentence:
+                    return None
+                return False
+            # An initial such as "J. Smith".
+            if len(last_word) == 1 and last_word.isalpha():
+                return False
+        if not starts_sentence:
+            return False
+        if punctuation != ".":
+            # An ellipsis followed by a capital letter.
+            return None
+        return True
+
+
+def get_splitter(language: str) -> SentenceSplitter:
+    """
+    Get the rule-based splitter of the language. Return None if there is no splitter for the language.
+    """
+    if language == JA:
+        return JapaneseSplitter()
+    if language == EN:
+        return EnglishSplitter()
+    return None
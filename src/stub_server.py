@@ -0,0 +1,233 @@
+import argparse
+import csv
+import io
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llm import estimate_tokens
+
+INPUT_TEXT_PATTERN = re.compile(r"# Input text:\n(.*)\n # Output text:", re.S)
+TARGET_LANGUAGES_PATTERN = re.compile(r"translates .+? into (.+?)\.\n")
+
+
+def make_content(messages: list, merge: bool=False) -> str:
+    """
+    Make a plausible response content for the prompts of this repository.
+    Translations are the source texts with a "T:" prefix. If merge is set, the last two translated sentences are merged into one.
+    """
+    system = messages[0]["content"] if messages else ""
+    human = messages[-1]["content"] if messages else ""
+    if "split_sentences" in system:
+        match = INPUT_TEXT_PATTERN.search(human)
+        text = match.group(1) if match else human
+        sentences = [s.strip() for s in re.split(r"(?<=[.!?])\s+|\n", text) if s.strip()]
+        return json.dumps({"split_sentences": sentences})
+    if "\"translations\"" in system:
+        match = INPUT_TEXT_PATTERN.search(human)
+        texts = json.loads(match.group(1)) if match else []
+        match = TARGET_LANGUAGES_PATTERN.search(system)
+        languages = re.split(r", | and ", match.group(1)) if match else []
+        translations = {language: [f"T:{t}" for t in texts] for language in languages}
+        for language in translations:
+            if merge and len(texts) >= 2:
+                translations[language][-2:] = [" ".join(translations[language][-2:])]
+                break
+        return json.dumps({"translations": translations}, ensure_ascii=False)
+    if "translated_texts" in system:
+        match = INPUT_TEXT_PATTERN.search(human)
+        text = match.group(1) if match else human
+        try:
+            texts = json.loads(text)
+        except json.decoder.JSONDecodeError:
+            texts = None
+        if isinstance(texts, list):
+            translated_texts = [f"T:{t}" for t in texts]
+            if merge and len(translated_texts) >= 2:
+                translated_texts[-2:] = [" ".join(translated_texts[-2:])]
+            return json.dumps({"translated_texts": translated_texts}, ensure_ascii=False)
+        return json.dumps({"translated_texts": f"T:{text}"}, ensure_ascii=False)
+    if "\"id\",\"原文\",\"訳文\"" in human:
+        block = human.split("\"id\",\"原文\",\"訳文\"\n", 1)[1].split("\n```", 1)[0]
+        rows = list(csv.reader(io.StringIO(block)))
+        qa = [{"id": int(row[0]), "accuracy": True, "omission": False, "issuePoint": ""} for row in rows if row]
+        return json.dumps({"qa": qa})
+    if "total" in system:
+        return json.dumps({"accuracy": 1, "grammar": 0, "total": 1, "review": "1の方が良い"}, ensure_ascii=False)
+    return json.dumps({"accuracy": 2, "grammar": 2, "fluency": 2, "cultural": 2, "style": 2, "error": 2, "review": "問題ありません"}, ensure_ascii=False)
+
+
+class StubServer:
+    """
+    Local server speaking the OpenAI chat-completions protocol, for benchmarks without OpenAI.
+
+    latency: seconds added to every response. latency_per_token: seconds added per completion token.
+    error_rate: ratio of 500 responses. malformed_rate: ratio of responses whose JSON is truncated.
+    rate_limit_rate: ratio of 429 responses. merge_rate: ratio of table translations merging two sentences into one.
+    retries counts the requests repeating the messages of a request that got a 500 or 429 response.
+    """
+    def __init__(self, host: str="127.0.0.1", port: int=0, latency: float=0.05, latency_per_token: float=0.0,
+                 error_rate: float=0.0, malformed_rate: float=0.0, rate_limit_rate: float=0.0, merge_rate: float=0.0, seed: int=0):
+        self.latency = latency
+        self.latency_per_token = latency_per_token
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.merge_rate = merge_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.malformed = 0
+        self.rate_limited = 0
+        self.retries = 0
+        self._failed_messages = set()
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"requests": self.requests,
+                    "errors": self.errors,
+                    "malformed": self.malformed,
+                    "rate_limited": self.rate_limited,
+                    "retries": self.retries,
+                    "prompt_tokens": self.prompt_tokens,
+                    "completion_tokens": self.completion_tokens}
+
+    def reset(self):
+        with self.lock:
+            self.requests = self.errors = self.malformed = self.rate_limited = self.retries = self.prompt_tokens = self.completion_tokens = 0
+            self._failed_messages.clear()
+
+    def complete(self, request: dict) -> tuple:
+        """
+        Make (status, content, prompt tokens, completion tokens) for a chat-completions request.
+        """
+        messages = request.get("messages", [])
+        prompt_tokens = sum(estimate_tokens(m.get("content", "")) for m in messages)
+        key = json.dumps(messages, sort_keys=True)
+        with self.lock:
+            self.requests += 1
+            if key in self._failed_messages:
+                self.retries += 1
+                self._failed_messages.discard(key)
+            is_rate_limited = self.random.random() < self.rate_limit_rate
+            is_error = not is_rate_limited and self.random.random() < self.error_rate
+            is_malformed = not is_error and self.random.random() < self.malformed_rate
+            is_merged = self.random.random() < self.merge_rate
+            self.errors += int(is_error)
+            self.rate_limited += int(is_rate_limited)
+            self.malformed += int(is_malformed)
+            if is_error or is_rate_limited:
+                self._failed_messages.add(key)
+        if is_rate_limited:
+            return 429, "", prompt_tokens, 0
+        if is_error:
+            time.sleep(self.latency)
+            return 500, "", prompt_tokens, 0
+        content = make_content(messages, merge=is_merged)
+        if is_malformed:
+            content = content[: len(content) * 2 // 3]
+        completion_tokens = estimate_tokens(content)
+        time.sleep(self.latency + self.latency_per_token * completion_tokens)
+        with self.lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+        return 200, content, prompt_tokens, completion_tokens
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                if not self.path.endswith("/chat/completions"):
+                    return self._send_json(404, {"error": {"message": "Not found"}})
+                status, content, prompt_tokens, completion_tokens = server.complete(request)
+                if status == 429:
+                    return self._send_json(status, {"error": {"message": "Rate limit reached", "type": "requests"}})
+                if status != 200:
+                    return self._send_json(status, {"error": {"message": "Stub error", "type": "server_error"}})
+                model = request.get("model", "stub")
+                if request.get("stream"):
+                    return self._send_stream(model, content)
+                self._send_json(200, {
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+                })
+
+            def _send_json(self, status: int, body: dict):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_stream(self, model: str, content: str):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                pieces = [content[i:i + 8] for i in range(0, len(content), 8)] + [None]
+                for piece in pieces:
+                    delta = {"content": piece} if piece is not None else {}
+                    chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                             "choices": [{"index": 0, "delta": delta, "finish_reason": None if piece is not None else "stop"}]}
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.close_connection = True
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stub server for benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--latency-per-token", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--merge-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    server = StubServer(host=args.host, port=args.port, latency=args.latency, latency_per_token=args.latency_per_token,
+                        error_rate=args.error_rate, malformed_rate=args.malformed_rate, rate_limit_rate=args.rate_limit_rate, merge_rate=args.merge_rate)
+    print(f"Stub server listening on {server.base_url}")
+    server.httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
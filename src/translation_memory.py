@@ -0,0 +1,126 @@
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+DEFAULT_MEMORY_PATH = os.environ.get("LLM_TRANSLATOR_MEMORY_PATH", os.path.join(".cache", "translation_memory.sqlite3"))
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize text for the translation memory key.
+    Unicode width and runs of white space are unified, so that trivially different inputs share an entry.
+    """
+    lines = [" ".join(line.split()) for line in unicodedata.normalize("NFKC", text).split("\n")]
+    return "\n".join([line for line in lines if line != ""])
+
+
+class TranslationMemory:
+    """
+    On-disk sentence-level translation memory backed by SQLite.
+
+    Entries are keyed by the normalized source sentence, language pair, model and temperature.
+    Entries older than max_age seconds are evicted, and the least recently used entries are evicted
+    when the number of entries exceeds max_entries.
+    """
+    def __init__(self, path: str=DEFAULT_MEMORY_PATH, max_entries: int=100000, max_age: float=30 * 24 * 60 * 60, evict_interval: int=100):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.evict_interval = evict_interval
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS memory ("
+                               "source_language TEXT NOT NULL,"
+                               "target_language TEXT NOT NULL,"
+                               "model TEXT NOT NULL,"
+                               "temperature REAL NOT NULL,"
+                               "source TEXT NOT NULL,"
+                               "target TEXT NOT NULL,"
+                               "created_at REAL NOT NULL,"
+                               "accessed_at REAL NOT NULL,"
+                               "PRIMARY KEY (source_language, target_language, model, temperature, source))")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS memory_accessed_at ON memory (accessed_at)")
+
+    def get(self, source_language: str, target_language: str, model: str, temperature: float, source: str):
+        """
+        Get the cached translation of the source sentence. Return None on a cache miss.
+        """
+        return self.get_many(source_language, target_language, model, temperature, [source])[0]
+
+    def get_many(self, source_language: str, target_language: str, model: str, temperature: float, sources: list) -> list:
+        """
+        Get the cached translations of the source sentences in order. Missing entries are None.
+        """
+        now = time.time()
+        keys = [normalize_text(s) for s in sources]
+        found = {}
+        with self._lock, self._conn:
+            for key in set(keys):
+                row = self._conn.execute("SELECT target, created_at FROM memory "
+                                         "WHERE source_language = ? AND target_language = ? AND model = ? AND temperature = ? AND source = ?",
+                                         (source_language, target_language, model, temperature, key)).fetchone()
+                if row is None or now - row[1] > self.max_age:
+                    continue
+                found[key] = row[0]
+                self._conn.execute("UPDATE memory SET accessed_at = ? "
+                                   "WHERE source_language = ? AND target_language = ? AND model = ? AND temperature = ? AND source = ?",
+                                   (now, source_language, target_language, model, temperature, key))
+            targets = [found.get(key) for key in keys]
+            hits = sum(1 for t in targets if t is not None)
+            self.hits += hits
+            self.misses += len(targets) - hits
+        return targets
+
+    def put(self, source_language: str, target_language: str, model: str, temperature: float, source: str, target: str):
+        self.put_many(source_language, target_language, model, temperature, [(source, target)])
+
+    def put_many(self, source_language: str, target_language: str, model: str, temperature: float, pairs: list):
+        """
+        Store (source, target) pairs.
+        """
+        now = time.time()
+        rows = [(source_language, target_language, model, temperature, normalize_text(s), t, now, now) for s, t in pairs]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO memory VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._puts += len(rows)
+            if self._puts >= self.evict_interval:
+                self._puts = 0
+                self._evict()
+
+    def evict(self):
+        with self._lock, self._conn:
+            self._evict()
+
+    def _evict(self):
+        self._conn.execute("DELETE FROM memory WHERE created_at < ?", (time.time() - self.max_age,))
+        count = self._conn.execute("SELECT COUNT(*) FROM memory").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute("DELETE FROM memory WHERE rowid IN (SELECT rowid FROM memory ORDER BY accessed_at LIMIT ?)",
+                               (count - self.max_entries,))
+
+    def items(self) -> list:
+        """
+        All the (source_language, target_language, model, temperature, source, target) entries that are not expired.
+        """
+        with self._lock:
+            return self._conn.execute("SELECT source_language, target_language, model, temperature, source, target FROM memory WHERE created_at >= ?",
+                                      (time.time() - self.max_age,)).fetchall()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM memory").fetchone()[0]
+
+    def __repr__(self):
+        return f"<TranslationMemory path={self.path} hits={self.hits} misses={self.misses}>"
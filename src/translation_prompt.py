@@ -2,6 +2,7 @@ SYSTEM_TEMPLATE = ("You are a professional translator who translates {source_lan
                    "Based on the given constraints and input text, please output the translation result.\n"
                    "# Constraints:\n"
                    "{output_format}"
+                   "{glossary}"
                    "- Please refer to the following output format.\n"
                    "{example}")
 
@@ -13,7 +14,15 @@ TEXT_EXAMPLE = ("```json\n"
                 "```\n")
 
 TABLE_OUTPUT_FOTMAT = ("- The outcome should be in JSON format.\n"
-                       "- The translated results are stored in an array for each sentence, where the string \"translated_texts\" is used as the key, and the translated text corresponding to the key is stored for each sentence.\n")
+                       "- The translated results are stored in an array for each sentence, where the string \"translated_texts\" is used as the key, and the translated text corresponding to the key is stored for each sentence.\n"
+                       "- Keep placeholders such as ⟦1⟧ unchanged, at the positions corresponding to the translation.\n")
+
+FAN_OUT_OUTPUT_FORMAT = ("- The outcome should be in JSON format.\n"
+                         "- The translated results are stored under the key \"translations\" as an object with a key for each target language, where the value is an array of the translated text of each input sentence in order.\n"
+                         "- Keep placeholders such as ⟦1⟧ unchanged, at the positions corresponding to the translation.\n")
+
+GLOSSARY_CONSTRAINT = "- Translate the following terms as specified in the glossary.\n"
+GLOSSARY_ENTRY = "  - {source} → {target}\n"
 
 EXAMPLE_EN_TO_JA = ("```input (array)\n"
                     "[\"Hello, how are you?\", \"I'm fine, thank you.\", \"Hello, world!\"]"
@@ -42,3 +51,5 @@ EXAMPLE_JA_TO_EN = ("```input (array)\n"
                     "```\n")
 
 HUMAN_TEMPLATE = "# Input text:\n{text}\n # Output text:\n"
+CONTEXT_HUMAN_TEMPLATE = ("# Context (for reference only, do not translate):\n{context}\n"
+                          "# Input text:\n{text}\n # Output text:\n")
@@ -0,0 +1,245 @@
+import argparse
+import json
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llm_translator import Translation
+
+# パスごとの必須フィールド
+REQUIRED_FIELDS = {
+    "/translate": ("source_language", "target_language", "text"),
+    "/translate_by_sentence": ("source_language", "target_language", "text"),
+    "/qa": ("source_language", "target_language", "source", "target"),
+}
+
+
+def translation_to_dict(translation: Translation) -> dict:
+    return {"source_texts": translation.source_texts,
+            "translated_texts": translation.translated_texts,
+            "is_success": translation.is_success,
+            "cost": translation.cost,
+            "tokens": translation.tokens,
+            "error": translation.error,
+            "error_no": translation.error_no}
+
+
+class RequestCoalescer:
+    """
+    Run identical concurrent requests once. Callers with the same key while a request is in flight wait for its result.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.requests = 0
+        self.coalesced = 0
+
+    def run(self, key, function):
+        with self._lock:
+            self.requests += 1
+            future = self._in_flight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._in_flight[key] = future
+            else:
+                self.coalesced += 1
+        if not is_owner:
+            return future.result()
+        try:
+            future.set_result(function())
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        return future.result()
+
+
+class MicroBatcher:
+    """
+    Collect short sentences from different callers for `window` seconds, translate them in one table-format request,
+    and split the results back per caller. Sentences of a failed batch are translated one by one.
+    Sentences in the translation memory of the translator are answered without batching, and the batch results are stored in it.
+    """
+    def __init__(self, translator, window: float=0.005, max_batch_size: int=32):
+        self.translator = translator
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        self._batches = {}
+        self.batches = 0
+        self.sentences = 0
+
+    def submit(self, source_language: str, target_language: str, text: str, model: str, temperature: float) -> Future:
+        key = (source_language, target_language, model, temperature)
+        future = Future()
+        cached_translation = self.translator._get_memory_translation(source_language, target_language, text, model, temperature, "text")
+        if cached_translation:
+            future.set_result(cached_translation)
+            return future
+        with self._lock:
+            self.sentences += 1
+            batch = self._batches.get(key)
+            if batch is None:
+                batch = []
+                self._batches[key] = batch
+                timer = threading.Timer(self.window, self._flush, args=(key, batch))
+                timer.daemon = True
+                timer.start()
+            batch.append((text, future))
+            is_full = len(batch) >= self.max_batch_size
+        if is_full:
+            self._flush(key, batch)
+        return future
+
+    def _flush(self, key: tuple, batch: list):
+        with self._lock:
+            # The batch may have been flushed already by the timer or because it was full.
+            if self._batches.get(key) is not batch:
+                return
+            del self._batches[key]
+            self.batches += 1
+        source_language, target_language, model, temperature = key
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            translation = self.translator.translate(source_language, target_language, json.dumps(texts), model, temperature, format_type="table")
+            translation.set_source_texts(texts)
+            if translation.is_success and translation.verify_text_pair():
+                translated = dict(zip(texts, translation.translated_texts))
+                if self.translator.translation_memory is not None:
+                    self.translator.translation_memory.put_many(source_language, target_language, model, temperature, translated.items())
+                for text, future in batch:
+                    future.set_result(Translation(translated_texts=translated[text], is_success=True,
+                                                  cost=translation.cost / len(batch), tokens=translation.tokens // len(batch)))
+                return
+            for text, future in batch:
+                future.set_result(self.translator.translate(source_language, target_language, text, model, temperature))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+
+class TranslationService:
+    """
+    Translator and QualityAssurance behind request coalescing and micro-batching.
+    """
+    def __init__(self, translator, short_text_length: int=200, window: float=0.005, max_batch_size: int=32):
+        self.translator = translator
+        self.short_text_length = short_text_length
+        self.coalescer = RequestCoalescer()
+        self.batcher = MicroBatcher(translator, window=window, max_batch_size=max_batch_size)
+        self._qa = {}
+        self._qa_lock = threading.Lock()
+
+    def translate(self, source_language: str, target_language: str, text: str, model: str, temperature: float, format_type: str="text") -> dict:
+        key = ("translate", source_language, target_language, text, model, temperature, format_type)
+        if format_type == "text" and self._is_short(text):
+            function = lambda: self.batcher.submit(source_language, target_language, text, model, temperature).result()
+        else:
+            function = lambda: self.translator.translate(source_language, target_language, text, model, temperature, format_type)
+        return translation_to_dict(self.coalescer.run(key, function))
+
+    def translate_by_sentence(self, source_language: str, target_language: str, text: str, model: str, temperature: float) -> dict:
+        key = ("translate_by_sentence", source_language, target_language, text, model, temperature)
+        translation = self.coalescer.run(key, lambda: self.translator.translate_by_sentence(source_language, target_language, text, model, temperature))
+        return translation_to_dict(translation)
+
+    def check_translation(self, source_language: str, target_language: str, source: str, target: str, model: str, temperature: float) -> dict:
+        key = ("qa", source_language, target_language, source, target, model, temperature)
+        qa = self._get_qa(source_language, target_language, model, temperature)
+        is_success, result = self.coalescer.run(key, lambda: qa._call(source=source, target=target))
+        return {"is_success": is_success, "result": result}
+
+    def stats(self) -> dict:
+        return {"requests": self.coalescer.requests,
+                "coalesced": self.coalescer.coalesced,
+                "batches": self.batcher.batches,
+                "batched_sentences": self.batcher.sentences}
+
+    def _is_short(self, text: str) -> bool:
+        return len(text) <= self.short_text_length and "\n" not in text
+
+    def _get_qa(self, source_language: str, target_language: str, model: str, temperature: float):
+        from llm_qa import QualityAssurance
+        key = (source_language, target_language, model, temperature)
+        with self._qa_lock:
+            if key not in self._qa:
+                self._qa[key] = QualityAssurance(source_language=source_language, target_language=target_language, model=model, temperature=temperature)
+            return self._qa[key]
+
+
+def make_handler(service: TranslationService):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path == "/stats":
+                return self._send_json(200, service.stats())
+            self._send_json(404, {"error": "Not found"})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                request = json.loads(self.rfile.read(length) or b"{}")
+                model = request.get("model", "gpt-3.5-turbo-0125")
+                temperature = float(request.get("temperature", 0.0))
+                if self.path not in REQUIRED_FIELDS:
+                    return self._send_json(404, {"error": "Not found"})
+                missing_fields = [field for field in REQUIRED_FIELDS[self.path] if request.get(field) is None]
+                if missing_fields:
+                    return self._send_json(400, {"error": f"{', '.join(missing_fields)} {'is' if len(missing_fields) == 1 else 'are'} required."})
+                if request["source_language"] == request["target_language"]:
+                    return self._send_json(400, {"error": "Source language and target language must be different."})
+                if self.path == "/translate":
+                    body = service.translate(request["source_language"], request["target_language"], request["text"], model, temperature,
+                                             request.get("format_type", "text"))
+                elif self.path == "/translate_by_sentence":
+                    body = service.translate_by_sentence(request["source_language"], request["target_language"], request["text"], model, temperature)
+                elif self.path == "/qa":
+                    body = service.check_translation(request["source_language"], request["target_language"], request["source"], request["target"], model, temperature)
+            except Exception as e:
+                return self._send_json(500, {"error": str(e)})
+            self._send_json(200, body)
+
+        def _send_json(self, status: int, body: dict):
+            data = json.dumps(body, ensure_ascii=False).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Translation HTTP service with request coalescing and micro-batching.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--window", type=float, default=0.005, help="Micro-batching window in seconds.")
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--short-text-length", type=int, default=200, help="Texts up to this length are micro-batched.")
+    parser.add_argument("--memory", default="", help="Translation memory path. Disabled by default.")
+    args = parser.parse_args()
+
+    import llm_qa
+    from llm_registry import REGISTRY
+    from llm_translator import Translator
+    from translation_memory import TranslationMemory
+    # The prompt templates of translation and QA are compiled before the first request.
+    REGISTRY.warm_up()
+    translator = Translator(translation_memory=TranslationMemory(args.memory) if args.memory else None)
+    service = TranslationService(translator, short_text_length=args.short_text_length, window=args.window, max_batch_size=args.max_batch_size)
+    httpd = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    httpd.daemon_threads = True
+    print(f"Translation service listening on http://{args.host}:{args.port}")
+    httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# src のモジュールはフラットに import されるので、src をパスに追加する
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+
+@pytest.fixture(scope="session")
+def stub_server():
+    """
+    OpenAI-compatible stub server shared by the tests. The registry keeps its first client, so it is started once per session.
+    """
+    from stub_server import StubServer
+    server = StubServer(latency=0.0)
+    server.start()
+    os.environ["OPENAI_API_BASE"] = server.base_url
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    yield server
+    server.stop()
@@ -0,0 +1,57 @@
+import csv
+import json
+
+import pytest
+
+from batch_translate import BatchTranslator, RECORD_ERROR_NO
+from llm_translator import Translation
+
+
+class FailingTranslator:
+    def translate_by_sentence(self, source_language, target_language, text, model, temperature):
+        if text == "fail":
+            raise ConnectionError("connection reset")
+        translation = Translation(translated_texts=[f"T:{text}"])
+        translation.set_source_texts([text])
+        return translation
+
+
+def test_failing_record_does_not_stop_the_batch(tmp_path):
+    input_path = tmp_path / "input.tsv"
+    output_path = tmp_path / "output.tsv"
+    input_path.write_text("ok 1\nfail\nok 2\n", encoding="utf-8")
+    batch = BatchTranslator(FailingTranslator(), "English", "Japanese", "gpt-3.5-turbo", 0.0, text_column="0", chunk_size=2, concurrency=2)
+    records_done, failures = batch.run(str(input_path), str(output_path), str(tmp_path / "checkpoint"))
+    assert (records_done, failures) == (3, 1)
+    with open(output_path, encoding="utf-8") as f:
+        rows = list(csv.reader(f, delimiter="\t"))
+    assert rows == [["ok 1", "T:ok 1", ""], ["fail", "", RECORD_ERROR_NO], ["ok 2", "T:ok 2", ""]]
+
+
+def test_missing_text_column_is_an_error(tmp_path):
+    input_path = tmp_path / "input.jsonl"
+    input_path.write_text(json.dumps({"text": "ok"}) + "\n", encoding="utf-8")
+    batch = BatchTranslator(FailingTranslator(), "English", "Japanese", "gpt-3.5-turbo", 0.0, text_column="0")
+    with pytest.raises(ValueError):
+        batch.run(str(input_path), str(tmp_path / "output.jsonl"), str(tmp_path / "checkpoint"))
+
+
+def test_null_text_is_not_translated(tmp_path):
+    input_path = tmp_path / "input.jsonl"
+    input_path.write_text(json.dumps({"text": None}) + "\n" + json.dumps({"text": "ok"}) + "\n", encoding="utf-8")
+    output_path = tmp_path / "output.jsonl"
+    batch = BatchTranslator(FailingTranslator(), "English", "Japanese", "gpt-3.5-turbo", 0.0, text_column="text")
+    assert batch.run(str(input_path), str(output_path), str(tmp_path / "checkpoint")) == (2, 0)
+    records = [json.loads(line) for line in output_path.read_text(encoding="utf-8").splitlines()]
+    assert [record["translation"] for record in records] == ["", "T:ok"]
+
+
+def test_resume_without_the_output_is_an_error(tmp_path):
+    input_path = tmp_path / "input.tsv"
+    output_path = tmp_path / "output.tsv"
+    input_path.write_text("ok 1\nok 2\n", encoding="utf-8")
+    batch = BatchTranslator(FailingTranslator(), "English", "Japanese", "gpt-3.5-turbo", 0.0, text_column="0", chunk_size=1)
+    batch.run(str(input_path), str(output_path), str(tmp_path / "checkpoint"))
+    output_path.unlink()
+    with pytest.raises(ValueError):
+        batch.run(str(input_path), str(output_path), str(tmp_path / "checkpoint"))
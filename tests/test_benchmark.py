@@ -0,0 +1,9 @@
+from benchmark import run_benchmark
+
+
+def test_latencies_and_retries_are_per_call(stub_server, monkeypatch):
+    monkeypatch.setattr(stub_server, "error_rate", 0.3)
+    [result] = run_benchmark(["check_translation"], [10], [2], stub_server)
+    assert result["calls"] > 1
+    assert result["retries"] > 0
+    assert result["upstream_requests"] == result["calls"] + result["retries"]
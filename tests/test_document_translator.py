@@ -0,0 +1,14 @@
+from document_translator import parse_markdown
+
+
+def test_heading_followed_by_paragraph():
+    document = parse_markdown("# Title here\nSome *emphasis* text\ncontinued line.\n")
+    assert document.source_texts == ["Title here", "Some ⟦0⟧emphasis⟦1⟧ text\ncontinued line."]
+    text, broken = document.render(["Titre", "Du ⟦0⟧texte⟦1⟧\nsuite."])
+    assert text == "# Titre\nDu *texte*\nsuite.\n"
+    assert broken == 0
+
+
+def test_paragraph_continuation_is_joined():
+    document = parse_markdown("First line\nsecond line.\n\nNext paragraph.\n")
+    assert document.source_texts == ["First line\nsecond line.", "Next paragraph."]
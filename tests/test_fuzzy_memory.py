@@ -0,0 +1,34 @@
+from benchmark import run_fuzzy_benchmark
+from const import EN, JA
+from fuzzy_memory import FuzzyTranslationMemory
+from translation_memory import TranslationMemory
+
+
+def test_search_only_matches_the_same_model_and_temperature():
+    memory = FuzzyTranslationMemory()
+    memory.add(EN, JA, "gpt-3.5-turbo", 0.0, "This is a pen.", "これはペンです。")
+    assert memory.search(EN, JA, "gpt-3.5-turbo", 0.0, "This is a pen!")[0][2] == "これはペンです。"
+    assert memory.search(EN, JA, "gpt-4o", 0.0, "This is a pen!") == []
+    assert memory.search(EN, JA, "gpt-3.5-turbo", 0.7, "This is a pen!") == []
+
+
+def test_load_keeps_the_model_and_temperature():
+    translation_memory = TranslationMemory(":memory:")
+    translation_memory.put(EN, JA, "gpt-4o", 0.5, "This is a pen.", "これはペンです。")
+    memory = FuzzyTranslationMemory().load(translation_memory)
+    assert memory.search(EN, JA, "gpt-4o", 0.5, "This is a pen!")
+    assert memory.search(EN, JA, "gpt-3.5-turbo", 0.0, "This is a pen!") == []
+
+
+def test_full_bucket_keeps_exact_matches_findable():
+    memory = FuzzyTranslationMemory(max_bucket_size=2)
+    memory.add_many(EN, JA, "gpt-3.5-turbo", 0.0, [(f"Press the button {i}.", f"ボタン {i} を押す。") for i in range(20)])
+    index = next(iter(memory._indexes.values()))
+    assert max(len(ids) for bucket in index.buckets for ids in bucket.values()) <= 2
+    assert memory.search(EN, JA, "gpt-3.5-turbo", 0.0, "Press the button 0.")[0][1:] == ("Press the button 0.", "ボタン 0 を押す。")
+
+
+def test_fuzzy_benchmark_finds_edited_sentences():
+    result = run_fuzzy_benchmark(2000, lookups=100)
+    assert (result["size"], result["calls"]) == (2000, 100)
+    assert result["recall"] >= 0.7
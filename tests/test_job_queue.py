@@ -0,0 +1,81 @@
+import asyncio
+import threading
+import time
+
+import pandas as pd
+
+from job_queue import JobQueue, JobWorker, QA, CANCELED, DONE, QUEUED
+
+
+class FakeReport:
+    decided = 0
+
+
+class FakeChecker:
+    total_cost = 0.0
+    total_tokens = 0
+    prefilter_report = FakeReport()
+
+
+class SlowWorker(JobWorker):
+    """
+    Worker whose check takes `delay` seconds per chunk and marks each row.
+    """
+    def __init__(self, queue, delay: float):
+        super().__init__(queue, poll_interval=0.05)
+        self.delay = delay
+
+    def _get_check(self, job_id, kind, params):
+        async def check(chunk):
+            await asyncio.sleep(self.delay)
+            return chunk.assign(review="ok")
+        return FakeChecker(), check
+
+
+def submit(queue, rows: int=4, chunksize: int=2) -> str:
+    df = pd.DataFrame({"source": [f"s{i}" for i in range(rows)], "target": [f"t{i}" for i in range(rows)]})
+    return queue.submit(QA, {}, ["source", "target", "review"], (df[i:i + chunksize] for i in range(0, rows, chunksize)), name="test.tsv")
+
+
+def get_chunk_statuses(queue, job_id):
+    return [row[0] for row in queue._conn.execute("SELECT status FROM chunks WHERE job_id = ? ORDER BY chunk_index", (job_id,))]
+
+
+def test_job_runs_to_completion(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+    job_id = submit(queue)
+    worker = SlowWorker(queue, delay=0.0)
+    while worker.run_once():
+        pass
+    job = queue.get_job(job_id)
+    assert (job["status"], job["done_rows"], job["rows"]) == (DONE, 4, 4)
+    assert queue.results(job_id)["review"].tolist() == ["ok"] * 4
+
+
+def test_cancel_during_chunk(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), lease=0.3)
+    job_id = submit(queue)
+    worker = SlowWorker(queue, delay=5.0)
+    thread = threading.Thread(target=worker.run_once)
+    started = time.time()
+    thread.start()
+    time.sleep(0.3)
+    queue.cancel(job_id)
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert time.time() - started < 2.0
+    job = queue.get_job(job_id)
+    assert (job["status"], job["done_rows"]) == (CANCELED, 0)
+    assert queue.results(job_id).empty
+    assert get_chunk_statuses(queue, job_id) == [QUEUED, QUEUED]
+
+
+def test_canceled_result_is_not_stored(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"))
+    job_id = submit(queue, rows=2)
+    claimed_job_id, _, _, chunk_index, chunk = queue.claim("worker")
+    queue.cancel(job_id)
+    assert not queue.complete(job_id, chunk_index, "worker", chunk.assign(review="ok"))
+    assert queue.results(job_id).empty
+    queue.resume(job_id)
+    assert queue.get_job(job_id)["status"] == QUEUED
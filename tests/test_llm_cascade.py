@@ -0,0 +1,28 @@
+from const import EN, JA
+from llm_cascade import CascadeTranslator, FAST_MODEL
+from llm_translator import Translation
+
+
+class MismatchedTranslator(CascadeTranslator):
+    """
+    The fast model returns a count mismatch (e0200), and the strong model translates every sentence.
+    """
+    def translate_by_sentence(self, source_language, target_language, text, model, temperature, previous=None):
+        sources = ["あ。", "い。"]
+        if model == FAST_MODEL:
+            translation = Translation(translated_texts=["A. B."], is_success=True, error="mismatch", error_no="e0200")
+            translation.set_source_texts(sources[1:])
+            return translation
+        translation = Translation(translated_texts=["A.", "B."], is_success=True)
+        translation.set_source_texts(sources)
+        return translation
+
+    def _make_qa(self, source_language, target_language):
+        raise AssertionError("QA must not run on mismatched sentences.")
+
+
+def test_count_mismatch_escalates_everything(stub_server):
+    translation = MismatchedTranslator().cascade_translate_by_sentence(JA, EN, "あ。い。", 0.0)
+    assert translation.translated_texts == ["A.", "B."]
+    assert translation.escalated_indexes == [0, 1]
+    assert translation.error_no == ""
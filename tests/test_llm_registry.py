@@ -0,0 +1,32 @@
+import os
+import subprocess
+import sys
+
+from llm_registry import LLMRegistry
+
+
+def test_precompile_builds_the_template_on_warm_up():
+    registry = LLMRegistry()
+    registry.precompile("You translate {text}.", "{text}")
+    assert registry.stats()["prompts"] == 0
+    registry.warm_up()
+    assert registry.stats()["prompts"] == 1
+    prompt = registry.get_prompt("You translate {text}.", "{text}")
+    assert prompt is registry.get_prompt("You translate {text}.", "{text}")
+    assert registry.stats()["prompt_hits"] == 2
+    assert registry.stats()["prompt_misses"] == 0
+
+
+def test_cold_build_is_a_miss():
+    registry = LLMRegistry()
+    registry.get_prompt("System {text}.", "{text}")
+    registry.get_prompt("System {text}.", "{text}")
+    assert registry.stats()["prompt_misses"] == 1
+    assert registry.stats()["prompt_hits"] == 1
+
+
+def test_import_does_not_load_langchain():
+    code = "import sys, llm_translator, llm_qa, llm_trans_compare; print('langchain' in sys.modules)"
+    src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=src)
+    assert result.stdout.strip() == "False"
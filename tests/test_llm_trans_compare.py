@@ -0,0 +1,46 @@
+import asyncio
+
+import numpy as np
+import pandas as pd
+
+from llm_trans_compare import TranslationCompare
+
+
+def make_compare():
+    return TranslationCompare(source_language="English", target_language="Japanese", model="gpt-3.5-turbo", temperature=0.0)
+
+
+def test_pair_key_accepts_missing_and_numeric_values(stub_server):
+    compare = make_compare()
+    assert compare._make_pair_key("source", np.nan, 1.5) == (("source", "", "1.5"), False)
+    assert compare._make_pair_key("source", "b", None) == (("source", "", "b"), True)
+
+
+def test_nway_with_missing_values(stub_server):
+    compare = make_compare()
+    data = pd.DataFrame({"source": ["Hello.", "Bye."], "e1": ["こんにちは。", np.nan], "e2": ["やあ。", "さようなら。"], "e3": [None, 2.0]})
+    result = asyncio.run(compare.acheck_translation_nway(data, ["e1", "e2", "e3"]))
+    assert result[["engine1", "engine2"]].values.tolist() == [["e1", "e2"], ["e2", "e3"]]
+    assert result["target2"].tolist() == ["やあ。", "2"]
+
+
+def test_failed_pair_is_not_cached(stub_server, monkeypatch):
+    compare = make_compare()
+    calls = []
+    original = compare._acall
+
+    async def flaky_call(source, target1, target2):
+        calls.append((source, target1, target2))
+        if len(calls) == 1:
+            raise ConnectionError("connection reset")
+        return await original(source=source, target1=target1, target2=target2)
+
+    monkeypatch.setattr(compare, "_acall", flaky_call)
+    data = pd.DataFrame({"source": ["Hello."], "e1": ["こんにちは。"], "e2": ["やあ。"]})
+    first = asyncio.run(compare.acheck_translation_nway(data, ["e1", "e2"]))
+    assert first["total"].tolist() == [-1]
+    second = asyncio.run(compare.acheck_translation_nway(data, ["e1", "e2"]))
+    assert second["total"].tolist() != [-1]
+    assert len(calls) == 2
+    asyncio.run(compare.acheck_translation_nway(data, ["e1", "e2"]))
+    assert len(calls) == 2
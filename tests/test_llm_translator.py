@@ -0,0 +1,57 @@
+from const import JA
+from llm_translator import Translation, Translator
+
+
+class MalformedStreamTranslator(Translator):
+    """
+    Streams a response whose second item is malformed, and translates the re-requested tail locally.
+    """
+    def _stream_llm_chain(self, chain, operation="llm", cache="", usage=None, **kwargs):
+        yield '{"translated_texts": ["A.", '
+        yield 'B. oops", "C."]}'
+        usage.update(cost=0.01, tokens=100)
+
+    def _translate_chunk(self, source_language, target_language, chunk, model, temperature):
+        texts, _ = chunk
+        return Translation(translated_texts=[f"T:{text}" for text in texts], is_success=True, cost=0.02, tokens=10)
+
+
+class MergingTranslator(Translator):
+    """
+    Streams the first two sentences merged into one, then realigns the chunk as _stream_translate_chunk does.
+    """
+    def _stream_translate_chunk(self, source_language, target_language, chunk, model, temperature, translation: Translation):
+        texts, _ = chunk
+        yield "A. B."
+        yield "C."
+        translation.translated_texts = ["A.", "B.", "C."]
+        translation.is_success = True
+
+
+def test_stream_replaces_realigned_rows(stub_server):
+    translator = MergingTranslator()
+    items = list(translator.stream_translate_by_sentence(JA, "English", "あ。い。う。", "gpt-3.5-turbo", 0.0))
+    rows = []
+    for index, source_text, translated_text in items[:-1]:
+        if index == len(rows):
+            rows.append([source_text, translated_text])
+        else:
+            rows[index] = [source_text, translated_text]
+    assert rows == [["あ。", "A."], ["い。", "B."], ["う。", "C."]]
+    assert items[-1].translated_texts == ["A.", "B.", "C."]
+
+
+def test_non_object_response_is_a_format_error(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "stub")
+    translator = Translator()
+    for result in (["A."], "A.", 1):
+        translation = translator._verify_translation(JA, "English", "あ。", "gpt-3.5-turbo", 0.0, "table", result, 0.0, 0)
+        assert (translation.is_success, translation.error_no) == (False, "e0000")
+
+
+def test_stream_recovers_from_a_malformed_item(stub_server):
+    translator = MalformedStreamTranslator()
+    items = list(translator.stream_translate_by_sentence(JA, "English", "あ。い。う。", "gpt-3.5-turbo", 0.0))
+    assert [item[2] for item in items[:-1]] == ["A.", "T:い。", "T:う。"]
+    assert items[-1].translated_texts == ["A.", "T:い。", "T:う。"]
+    assert abs(items[-1].cost - 0.03) < 1e-9
@@ -0,0 +1,48 @@
+import json
+import time
+
+import pytest
+
+import metrics
+from metrics import MetricsCollector, CallMetric, CACHE_HIT, CACHE_MISS
+
+
+def test_cache_hits_are_not_counted_as_calls(tmp_path):
+    collector = MetricsCollector(jsonl_path=str(tmp_path / "metrics.jsonl"))
+    collector.started_at = time.time() - 60
+    metric = CallMetric(operation="translate", model="m", wall_time=0.5, cost=0.01, cache=CACHE_MISS)
+    metric.timestamp = collector.started_at
+    collector.record(metric)
+    collector.record(CallMetric(operation="translate", model="m", wall_time=0.001, cache=CACHE_HIT))
+    collector.record_cache("translate", 1, 1)
+    collector.record_error("translate", "e0200")
+    collector.record_alignment("translate", 3, 1)
+    row = collector.summary()[0]
+    assert (row["calls"], row["served_from_cache"], row["cache_hits"], row["cache_misses"]) == (1, 1, 1, 1)
+    assert (row["aligned"], row["unaligned"]) == (3, 1)
+    assert row["latency_p99"] == 0.5
+
+    # 同じファイルに書き込んだ別プロセスの集計を再現できる
+    loaded = MetricsCollector(jsonl_path="").load_json_lines(str(tmp_path / "metrics.jsonl"))
+    loaded_row = loaded.summary()[0]
+    assert loaded_row.pop("calls_per_second") == pytest.approx(row.pop("calls_per_second"), rel=0.01)
+    assert loaded_row == row
+
+    collector.reset(clear_file=True)
+    assert MetricsCollector(jsonl_path="").load_json_lines(str(tmp_path / "metrics.jsonl")).summary() == []
+
+
+def test_translation_memory_hits_carry_cache_status(tmp_path, stub_server, monkeypatch):
+    from llm_translator import Translator
+    from translation_memory import TranslationMemory
+    path = tmp_path / "metrics.jsonl"
+    monkeypatch.setattr(metrics.METRICS, "jsonl_path", str(path))
+    translator = Translator(translation_memory=TranslationMemory(":memory:"))
+    text = "Hello, how are you? I'm fine, thank you."
+    assert translator.translate_by_sentence("English", "Japanese", text, "gpt-3.5-turbo", 0.0).is_success
+    assert translator.translate_by_sentence("English", "Japanese", text, "gpt-3.5-turbo", 0.0).is_success
+    events = [json.loads(line) for line in path.read_text().splitlines()]
+    calls = [event for event in events if event.get("operation") == "translate" and "wall_time" in event]
+    hits = [event for event in events if event.get("operation") == "translate_by_sentence" and "wall_time" in event]
+    assert [event["cache"] for event in calls] == [CACHE_MISS]
+    assert [event["cache"] for event in hits] == [CACHE_HIT, CACHE_HIT]
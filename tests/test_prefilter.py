@@ -0,0 +1,59 @@
+import pandas as pd
+
+from llm_qa import QualityAssurance
+from prefilter import Prefilter, chrf, chrf_upper_bound, EMPTY, LENGTH, NUMBER, SAME, SIMILAR
+
+
+def make_data():
+    sources = [f"This is source sentence number {i} of the file." for i in range(20)]
+    targets = [f"これはファイルの原文 {i} 番です。" for i in range(20)]
+    # 全体では長さの比が外れているが、この行だけの chunk では中央値そのものになる
+    targets[19] = "19"
+    return sources, targets
+
+
+def test_fitted_decisions_do_not_depend_on_chunking():
+    sources, targets = make_data()
+    df = pd.DataFrame({"source": sources, "target": targets})
+    whole = Prefilter().check_translations(sources, targets)
+    assert whole[19] == LENGTH
+    for chunksize in (1, 3, 7, 20):
+        prefilter = Prefilter().fit((df[i:i + chunksize] for i in range(0, 20, chunksize)), ["target"])
+        chunked = sum((prefilter.check_translations(sources[i:i + chunksize], targets[i:i + chunksize]) for i in range(0, 20, chunksize)), [])
+        assert chunked == whole
+
+
+def test_number_mismatch():
+    reasons = Prefilter().check_translations(["Pay 3,400 yen by 2024.", "Call 12.", "It costs 5 dollars."],
+                                             ["2024年までに3400円払う。", "13 に電話。", "5ドルかかる。"])
+    assert reasons == ["", NUMBER, ""]
+
+
+def test_numbers_are_compared_by_value():
+    reasons = Prefilter().check_translations(["2024-05-01", "09:30", "3.0 kg", "2024.05.01"],
+                                             ["2024年5月1日", "9時30分", "3kg", "2024年5月1日"])
+    assert reasons == ["", "", "", ""]
+
+
+def test_numeric_target_cell_is_not_empty(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "stub")
+    qa = QualityAssurance("English", "Japanese", "gpt-3.5-turbo", 0.0, prefilter=Prefilter())
+    pairs, reasons = qa._prefilter_pairs(pd.DataFrame({"source": ["2024", "Hello."], "target": [2024, None]}), "qa")
+    assert pairs == [("2024", "2024"), ("Hello.", "")]
+    assert reasons[1] == EMPTY and reasons[0] != EMPTY
+
+
+def test_chrf_upper_bound_holds():
+    pairs = [("abcdef", "abcdeg"), ("short", "a much longer text"), ("", ""), ("same", "same"), ("ab", "abc")]
+    bounds = chrf_upper_bound([len(h) for h, _ in pairs], [len(r) for _, r in pairs], beta=1.0)
+    for (hypothesis, reference), bound in zip(pairs, bounds):
+        assert chrf(hypothesis, reference, beta=1.0) <= bound + 1e-9
+
+
+def test_compare_translations():
+    verdicts = Prefilter().compare_translations(["Hello world."] * 3,
+                                                ["こんにちは、世界。", "こんにちは 、世界。", "やあ"],
+                                                ["こんにちは、世界。", "こんにちは、世界。", "世界さん、こんにちは"])
+    assert verdicts[0] == (0, SAME)
+    assert verdicts[1] == (0, SIMILAR)
+    assert verdicts[2] == (None, "")
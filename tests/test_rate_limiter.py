@@ -0,0 +1,22 @@
+import asyncio
+
+from rate_limiter import RateLimiter
+
+
+def test_failed_call_gives_back_its_tokens():
+    limiter = RateLimiter(":memory:", requests_per_minute=0, tokens_per_minute=1000)
+    limiter.acquire(800)
+    assert limiter._try_acquire("waiter", 800, 0) > 0
+    limiter.settle(800, 0, is_success=False)
+    assert limiter._try_acquire("waiter", 800, 0) == 0
+
+
+def test_async_failed_call_gives_back_its_tokens():
+    limiter = RateLimiter(":memory:", requests_per_minute=0, tokens_per_minute=1000)
+
+    async def main():
+        await limiter.aacquire(800)
+        await limiter.asettle(800, 0, is_success=False)
+        await limiter.aacquire(800)
+
+    asyncio.run(asyncio.wait_for(main(), timeout=1))
@@ -0,0 +1,27 @@
+import functools
+
+import pandas as pd
+
+from llm_qa import QualityAssurance, COLUMNS
+from llm_registry import REGISTRY
+from result_pipeline import ColumnarResult, iter_check_results
+
+
+def test_chunks_share_one_event_loop(stub_server, monkeypatch):
+    loops = set()
+    get_async_client = REGISTRY._get_async_client
+
+    def recording_get_async_client(loop):
+        loops.add(loop)
+        return get_async_client(loop)
+
+    monkeypatch.setattr(REGISTRY, "_get_async_client", recording_get_async_client)
+    qa = QualityAssurance(source_language="English", target_language="Japanese", model="gpt-3.5-turbo", temperature=0.0, debug=False)
+    data = pd.DataFrame({"source": [f"Sentence {i}." for i in range(6)], "target": [f"文 {i}。" for i in range(6)]})
+    chunks = [data[i:i + 2] for i in range(0, 6, 2)]
+    result = ColumnarResult(COLUMNS)
+    for _ in range(2):
+        for chunk_df in iter_check_results(functools.partial(qa.acheck_translation, concurrency=2), chunks):
+            result.extend(chunk_df)
+    assert len(result) == 12
+    assert len(loops) <= 1
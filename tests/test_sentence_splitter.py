@@ -0,0 +1,17 @@
+import pytest
+
+from sentence_splitter import JapaneseSplitter, get_bunkai
+
+TEXTS = [
+    "一文目。\n二文目？\n三文目！\n\n",
+    "一文目。\n\n\n二文目。",
+    "\n\n一文目。二文目。\n\n三文目。\n",
+    "一文目。\n \n　\n二文目。\n",
+]
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_groups_split_like_the_whole_text(text):
+    # 段落ごとに分割しても、テキスト全体を Bunkai で分割したときと同じ文になる
+    expected = [sentence for sentence in get_bunkai()(text) if sentence.strip() != ""]
+    assert JapaneseSplitter(group_size=1).split(text) == expected
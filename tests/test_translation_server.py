@@ -0,0 +1,54 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from const import EN, JA
+from llm_translator import Translation, Translator
+from translation_memory import TranslationMemory
+from translation_server import MicroBatcher, TranslationService, make_handler
+
+
+class TableTranslator(Translator):
+    """
+    Translates a table by prefixing each text, and counts the table requests.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.tables = []
+
+    def translate(self, source_language, target_language, text, model="gpt-3.5-turbo", temperature=0.0, format_type="text", **kwargs):
+        assert format_type == "table"
+        texts = json.loads(text)
+        self.tables.append(texts)
+        return Translation(translated_texts=[f"T:{t}" for t in texts], is_success=True)
+
+
+def test_batched_text_uses_translation_memory(stub_server):
+    translator = TableTranslator(translation_memory=TranslationMemory(":memory:"))
+    translator.translation_memory.put(JA, EN, "gpt-3.5-turbo", 0.0, "cached", "C")
+    batcher = MicroBatcher(translator, window=0.01)
+    futures = [batcher.submit(JA, EN, text, "gpt-3.5-turbo", 0.0) for text in ["cached", "new 1", "new 2"]]
+    assert [f.result(timeout=5).translated_texts for f in futures] == ["C", "T:new 1", "T:new 2"]
+    assert translator.tables == [["new 1", "new 2"]]
+
+    assert batcher.submit(JA, EN, "new 1", "gpt-3.5-turbo", 0.0).result(timeout=5).translated_texts == "T:new 1"
+    assert translator.tables == [["new 1", "new 2"]]
+
+
+def test_every_missing_field_is_reported(stub_server):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(TranslationService(TableTranslator())))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        host, port = server.server_address[:2]
+        request = urllib.request.Request(f"http://{host}:{port}/translate", data=json.dumps({"text": "あ"}).encode(), method="POST")
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(request, timeout=5)
+        assert e.value.code == 400
+        assert json.loads(e.value.read()) == {"error": "source_language, target_language are required."}
+    finally:
+        server.shutdown()
+        server.server_close()